@@ -9,12 +9,12 @@ import sys
 import time
 import traceback
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import List, Tuple
+from typing import Iterator, List, Tuple
 
 import pysilk
 
 from wxManager import MessageType, DataBaseInterface
-from wxManager.model import Contact, Me, Message
+from wxManager.model import Contact, Me, Message, MessageQuery
 
 from wxManager.log import logger
 from exporter.config import FileType
@@ -162,6 +162,47 @@ class ExporterBase(ExporterBaseBase):
         else:
             return True
 
+    def build_query(self, need_payload=True) -> MessageQuery:
+        """
+        把导出的筛选条件交给数据库，在SQL中先过滤一遍
+        @param need_payload: 导出结果是否需要图片/视频等媒体文件
+        @return:
+        """
+        return MessageQuery(
+            types=set(self.message_types) if self.message_types else None,
+            senders=set(self.group_members_set) if self.contact.is_chatroom() and self.group_members_set else None,
+            time_range=self.time_range,
+            need_payload=need_payload
+        )
+
+    def iter_messages(self, need_payload=True, batch_size=1000) -> Iterator[Message]:
+        """
+        按时间顺序逐批读取要导出的消息，不会一次把整个会话读进内存
+        @param need_payload: 同build_query
+        @param batch_size: 每次从数据库读取、解析的消息数量
+        @return:
+        """
+        return self.database.get_messages_iter(
+            self.contact.wxid, batch_size=batch_size, query=self.build_query(need_payload)
+        )
+
+    def message_count(self, query: MessageQuery = None) -> int:
+        """
+        要导出的消息数量（每个分库count(*)，不需要建立统计数据），只用来计算导出进度
+        @param query: 导出使用的查询条件，默认为build_query()
+        @return: 获取失败时返回0
+        """
+        try:
+            return self.database.get_messages_count(self.contact.wxid, query or self.build_query(False)) or 0
+        except:
+            logger.error(traceback.format_exc())
+            return 0
+
+    def report_progress(self, index, total):
+        # 总数是估计值，导出结束前进度最多到99%
+        if total:
+            self.update_progress_callback(min(index / total, 0.99))
+
     def is_selected(self, message):
         # 判断该消息是否应该导出
         return self._is_select_by_type(message) and self._is_select_by_contact(message)
@@ -1,6 +1,5 @@
 import os
 import re
-from collections import defaultdict
 
 from wxManager import Message
 from exporter.exporter import ExporterBase, get_new_filename, remove_privacy_info
@@ -24,28 +23,22 @@ class AiTxtExporter(ExporterBase):
         os.makedirs(origin_path, exist_ok=True)
         filename = os.path.join(origin_path, self.contact.remark + '_chat.txt')
         filename = get_new_filename(filename)
-        messages = self.database.get_messages(self.contact.wxid, time_range=self.time_range)
-        total_steps = len(messages)
-        # 创建一个默认字典，用于按日期分组
-        grouped_messages = defaultdict(list)
-        # 遍历消息，将其按日期分组
-        for index, message in enumerate(messages):
-            if index and index % 1000 == 0:
-                self.update_progress_callback(index / total_steps)
-            if not self.is_selected(message):
-                continue
-            date_key = message.str_time[:10]  # 以日期作为键
-            # 将消息添加到对应日期的列表中
-            grouped_messages[date_key].append(f'{self.title(message)}{remove_privacy_info(message.to_text())}')
-
+        total_steps = self.message_count()
         with open(filename, mode='w', newline='', encoding='utf-8') as f:
-            # 如果需要，可以将结果转换为普通字典
-            grouped_messages = dict(grouped_messages)
-            # 按日期排序并遍历结果
-            for date in sorted(grouped_messages.keys()):
-                msgs = grouped_messages[date]
-                f.write(f"\n\n{'*' * 20}{date}{'*' * 20}\n")
-                f.write('\n'.join(msgs))
+            # 消息按时间顺序读出，日期变化时写入新的日期标题，同一天的消息写在一起
+            last_date = None
+            for index, message in enumerate(self.iter_messages(need_payload=False)):
+                if index and index % 1000 == 0:
+                    self.report_progress(index, total_steps)
+                if not self.is_selected(message):
+                    continue
+                date_key = message.str_time[:10]  # 以日期作为键
+                if date_key != last_date:
+                    f.write(f"\n\n{'*' * 20}{date_key}{'*' * 20}\n")
+                    last_date = date_key
+                else:
+                    f.write('\n')
+                f.write(f'{self.title(message)}{remove_privacy_info(message.to_text())}')
         self.update_progress_callback(1)
         print(f"【完成导出 TXT {self.contact.remark}】")
         self.finish_callback(self.exporter_id)
@@ -274,8 +274,7 @@ class DocxExporter(ExporterBase):
     def export(self):
         print(f"【开始导出 DOCX {self.contact.remark}】")
         origin_path = self.origin_path
-        messages = self.database.get_messages(self.contact.wxid, time_range=self.time_range)
-        total_steps = len(messages)
+        total_steps = self.message_count()
         self.save_avatars()
 
         def newdoc():
@@ -288,13 +287,24 @@ class DocxExporter(ExporterBase):
             core_properties.comments = 'generated by MemoTrace'  # 注释
             docx_num += 1
 
+        def save_doc():
+            filename = os.path.join(origin_path, f"{self.contact.remark}_{docx_num}.docx")
+            filename = get_new_filename(filename)
+            try:
+                doc.save(filename)
+            except PermissionError:
+                filename = os.path.join(origin_path, f"{self.contact.remark}_{docx_num}_{str(time.time())}.docx")
+                doc.save(filename)
+            except:
+                pass
+
         doc = None
         docx_num = 0
         newdoc()
         selected_msg_cnt = 0
-        for index, message in enumerate(messages):
+        for index, message in enumerate(self.iter_messages()):
             if index and index % 1000 == 0:
-                self.update_progress_callback(index / total_steps)
+                self.report_progress(index, total_steps)
             if not self.is_selected(message):
                 continue
 
@@ -321,17 +331,12 @@ class DocxExporter(ExporterBase):
                                           message.display_name if self.contact.is_chatroom() else '')
                 except:
                     pass
-            if selected_msg_cnt % self.msg_num_per_docx == 0 or index == total_steps - 1:
-                filename = os.path.join(origin_path, f"{self.contact.remark}_{docx_num}.docx")
-                filename = get_new_filename(filename)
-                try:
-                    doc.save(filename)
-                except PermissionError:
-                    filename = os.path.join(origin_path, f"{self.contact.remark}_{docx_num}_{str(time.time())}.docx")
-                    doc.save(filename)
-                except:
-                    pass
+            if selected_msg_cnt % self.msg_num_per_docx == 0:
+                save_doc()
                 newdoc()
+        # 消息是流式读取的，事先不知道哪条是最后一条，剩下不满一个文件的消息在这里保存
+        if selected_msg_cnt % self.msg_num_per_docx:
+            save_doc()
         self.update_progress_callback(1)
         print(f"【完成导出 DOCX {self.contact.remark}】")
         self.finish_callback(self.exporter_id)
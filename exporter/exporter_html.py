@@ -1,10 +1,10 @@
-import copy
 import html
 import json
-import math
 import os
 import shutil
-import time
+from array import array
+from typing import Dict
+from urllib.parse import quote
 from wxManager.decrypt.decrypt_dat import batch_decode_image_multiprocessing
 from wxManager.log import logger
 from wxManager.model import MessageType, Me
@@ -20,8 +20,156 @@ icon_files = {
     'PDF': ['pdf'],
 }
 
+# 与template.html中的itemsPerPage一致
+ITEMS_PER_PAGE = 100
+# 分页导出时每个数据文件保存的消息数量（最好是ITEMS_PER_PAGE的整数倍）
+MSG_NUM_PER_SHARD = 1000
+# 待解密的图片（含缩略图）达到这个数量才启动一次进程池，文件、视频、语音每个分片都处理
+IMAGE_FLUSH_SIZE = 2000
+
+# 搜索索引每个文件大约保存的消息下标数量，以及文件数量上限
+SEARCH_POSTINGS_PER_SHARD = 50000
+MAX_SEARCH_SHARDS = 256
+
+# 页面上按分类查看时用到的消息下标，分类名与template.html中的menuItems一致
+CATEGORIES = ('Image', 'File', 'Link', 'Music', 'Transfer', 'MiniProgram', 'VideoNumber')
+
+
+def message_category(type_) -> str | None:
+    if type_ == MessageType.Image or type_ == MessageType.Video:
+        return 'Image'
+    if type_ == MessageType.File:
+        return 'File'
+    if type_ in {MessageType.LinkMessage, MessageType.LinkMessage2, MessageType.LinkMessage4, MessageType.LinkMessage5,
+                 MessageType.LinkMessage6}:
+        return 'Link'
+    if type_ == MessageType.Music:
+        return 'Music'
+    if type_ == MessageType.Transfer:
+        return 'Transfer'
+    if type_ == MessageType.Applet or type_ == MessageType.Applet2:
+        return 'MiniProgram'
+    if type_ == MessageType.WeChatVideo:
+        return 'VideoNumber'
+    return None
+
+
+def dict_to_js(dic: dict):
+    # 字符串转义，防止JS出现语法错误
+    for key, value in dic.items():
+        if isinstance(value, str):
+            if value.startswith('http'):
+                dic[key] = value
+            else:
+                dic[key] = html.escape(value)
+        elif isinstance(value, dict):
+            dic[key] = dict_to_js(value)
+    return dic
+
+
+def add_to_timeline(timeline: dict, str_time, page, server_id):
+    """
+    记录每个月第一条消息所在的页码和server_id
+    @param timeline: {年: {月: [页码, server_id]}}
+    @param str_time:
+    @param page:
+    @param server_id:
+    @return:
+    """
+    months = timeline.setdefault(str_time[:4], {})
+    month = int(str_time[5:7])
+    if month not in months:
+        months[month] = [page, str(server_id)]
+
+
+def write_js_call(filename, func, *args, mode='w'):
+    # 数据文件写成函数调用，页面用script标签加载（file://协议下不能用fetch读取本地文件）
+    with open(filename, mode, encoding='utf-8') as f:
+        f.write(f'{func}(')
+        for i, arg in enumerate(args):
+            if i:
+                f.write(',')
+            json.dump(arg, f, ensure_ascii=False, separators=(',', ':'))
+        f.write(');\n')
+
+
+def search_terms(text: str) -> set[str]:
+    """
+    搜索索引的分词，与template.html中的searchTerms一致
+    不依赖词典：按空白切分后取相邻的两个字，单字也单独索引，页面上可以搜索任意子串
+    @param text: 小写后的文本
+    @return:
+    """
+    terms = set()
+    for word in text.split():
+        terms.update(word[i:i + 2] for i in range(len(word) - 1))
+        terms.update(word)
+    return terms
+
+
+def term_shard(term: str, shard_num) -> int:
+    # FNV-1a（按UTF-16编码计算，与template.html中的termShard一致）
+    data = term.encode('utf-16-le')
+    value = 0x811c9dc5
+    for i in range(0, len(data), 2):
+        value = ((value ^ (data[i] | data[i + 1] << 8)) * 0x01000193) & 0xffffffff
+    return value % shard_num
+
+
+class SearchIndexBuilder:
+    """
+    导出时建立搜索索引，页面打开时不再需要在浏览器里给全部消息分词
+    词按哈希分到多个文件里，搜索时只加载用到的文件
+    """
+
+    def __init__(self):
+        self.postings: Dict[str, array] = {}
+
+    def add(self, msg_index, text):
+        postings = self.postings
+        for term in search_terms(text.lower()):
+            indexes = postings.get(term)
+            if indexes is None:
+                indexes = postings[term] = array('I')
+            indexes.append(msg_index)
+
+    def write(self, data_dir) -> int:
+        """
+        写入search_{n}.js，消息下标按差分保存
+        @param data_dir:
+        @return: 文件数量
+        """
+        posting_count = sum(map(len, self.postings.values()))
+        shard_num = min(MAX_SEARCH_SHARDS, posting_count // SEARCH_POSTINGS_PER_SHARD + 1)
+        shards = [{} for _ in range(shard_num)]
+        for term, indexes in self.postings.items():
+            deltas = [indexes[0]]
+            deltas.extend(b - a for a, b in zip(indexes, indexes[1:]))
+            shards[term_shard(term, shard_num)][term] = deltas
+        for shard, terms in enumerate(shards):
+            write_js_call(os.path.join(data_dir, f'search_{shard}.js'), 'loadSearchShard', shard, terms)
+        return shard_num
+
 
 class HtmlExporter(ExporterBase):
+    def __init__(
+            self,
+            database,
+            contact,
+            output_dir,
+            type_,  # 导出文件类型
+            message_types: set[MessageType] = None,  # 导出的消息类型
+            time_range=None,  # 导出的日期范围
+            group_members: set[str] = None,  # 群聊中只导出这些人的聊天记录
+            progress_callback=None,  # 进度回调函数，func(progress:float)
+            finish_callback=None,  # 导出完成回调函数
+            paged=True,  # 消息分片保存在数据文件里，页面按需加载；False时全部写在一个html文件里
+            msg_num_per_shard=MSG_NUM_PER_SHARD  # 每个数据文件的消息数量
+    ):
+        super().__init__(database, contact, output_dir, type_, message_types, time_range, group_members,
+                         progress_callback, finish_callback)  # 调用父类的构造函数
+        self.paged = paged
+        self.msg_num_per_shard = msg_num_per_shard
 
     def export(self):
         print(f"【开始导出 HTML {self.contact.remark}】")
@@ -46,29 +194,26 @@ class HtmlExporter(ExporterBase):
         html_head = html_head.replace("{{avatarUrls}}", json.dumps(avatar_urls)).replace('{{wxid}}',
                                                                                          f'"{self.contact.wxid}"')
         f.write(html_head)
-        messages = self.database.get_messages(self.contact.wxid, time_range=self.time_range)
 
-        # QMe().save_avatar(self.origin_path + '/avatar/' + Me().wxid + '.png')
-        # self.contact.save_avatar(self.origin_path + '/avatar/' + self.contact.wxid + '.png')
-        date_id_map = {}
+        # 每个html文件对应一个数据文件夹，重复导出时不会互相覆盖
+        data_dir_name = os.path.splitext(os.path.basename(filename))[0] + '_data'
+        data_dir = os.path.join(self.origin_path, data_dir_name)
+        if self.paged:
+            # html文件名是新的，同名的数据文件夹是以前残留的
+            shutil.rmtree(data_dir, ignore_errors=True)
+            os.makedirs(data_dir, exist_ok=True)
+
         timelineData = {}
         PageTimeline = {}
-        server_id_Page = {}
-        server_id_Idx = {}
-
-        AllIndex = []
-        ImageIndex = []
-        FileIndex = []
-        LinkIndex = []
-        MusicIndex = []
-        TransferIndex = []
-        MiniProgramIndex = []
-        VideoNumberIndex = []
         dateDataMap = {}
-        i = 0
-        itemsPerPage = 100
-        num = 1
-        html_json = []
+        search_index = SearchIndexBuilder()
+        categories = {name: [] for name in CATEGORIES}
+        category_timelines = {name: {} for name in CATEGORIES}
+        html_json = []  # 不分页时保存全部消息
+        html_data = []
+        shard = []  # 分页时只保存当前分片的消息
+        shard_num = 0
+        start_timestamp = end_timestamp = 0
         image_tasks = []
         video_tasks = []
         file_tasks = []
@@ -77,9 +222,8 @@ class HtmlExporter(ExporterBase):
         video_dir = os.path.join(self.origin_path, 'video')
         audio_dir = os.path.join(self.origin_path, 'voice')
         file_dir = os.path.join(self.origin_path, 'file')
-        total_steps = len(messages)
+        total_steps = self.message_count()
         select_msg_cnt = 0  # 要导出的消息数量
-        msg_index = 0
 
         def parser_merged(merged_message):
             for msg in merged_message.messages:
@@ -126,18 +270,49 @@ class HtmlExporter(ExporterBase):
                 elif type_ == MessageType.MergedMessages:
                     parser_merged(msg)
 
-        for index, message in enumerate(messages):
+        def flush_media(final=False):
+            # 媒体文件边导出边处理，任务列表不随消息数量增长
+            if image_tasks and (final or len(image_tasks) >= IMAGE_FLUSH_SIZE):
+                logger.info(f'解析图片{len(image_tasks)}')
+                # 使用多进程解密图片
+                batch_decode_image_multiprocessing(Me().xor_key, image_tasks)
+                image_tasks.clear()
+            if video_tasks or file_tasks:
+                logger.info(f'开始复制{len(video_tasks + file_tasks)}')
+                # 使用多线程，复制文件、视频到导出文件夹
+                copy_files(video_tasks + file_tasks)
+                video_tasks.clear()
+                file_tasks.clear()
+            # 语音是从数据库读出来的，不在内存里累积
+            decode_audios(audio_tasks)
+            audio_tasks.clear()
+
+        def flush_shard():
+            nonlocal shard, shard_num
+            if not shard:
+                return
+            write_js_call(os.path.join(data_dir, f'messages_{shard_num}.js'), 'loadChatShard', shard_num, shard)
+            # 定位引用的原消息时要由server_id找到消息下标，按server_id的最后两位分成100个文件，每个分片追加一次
+            buckets = {}
+            for i, item in enumerate(shard):
+                server_id = item['server_id']
+                buckets.setdefault(int(server_id[-2:]), {}).setdefault(server_id, shard_num * self.msg_num_per_shard + i)
+            for bucket, ids in buckets.items():
+                write_js_call(os.path.join(data_dir, f'ids_{bucket}.js'), 'loadMessageIds', ids, mode='a')
+            shard = []
+            shard_num += 1
+            flush_media()
+
+        for index, message in enumerate(self.iter_messages()):
             if not self._is_running:
                 break
             if index and index % 1000 == 0:
-                self.update_progress_callback(index / total_steps)
+                self.report_progress(index, total_steps)
             type_ = message.type
             if not self.is_selected(message):
-                msg_index -= 1
                 continue
             server_id = message.server_id
             if type_ == MessageType.Image:
-                ImageIndex.append(msg_index)
                 message.set_file_name()
                 image_tasks.append(
                     (
@@ -156,7 +331,6 @@ class HtmlExporter(ExporterBase):
                 message.path = f"./image/{message.str_time[:7]}/{message.file_name}"
                 message.thumb_path = f"./image/{message.str_time[:7]}/{message.file_name + '_t'}"
             elif type_ == MessageType.File:
-                FileIndex.append(msg_index)
                 origin_file_path = os.path.join(Me().wx_dir, message.path)
                 file_tasks.append(
                     (
@@ -168,7 +342,6 @@ class HtmlExporter(ExporterBase):
                 if os.path.isfile(origin_file_path):
                     message.path = f'./file/{message.str_time[:7]}/{os.path.basename(origin_file_path)}'
             elif type_ == MessageType.Video:
-                ImageIndex.append(msg_index)
                 message.set_file_name()
                 video_tasks.append(
                     (
@@ -189,111 +362,94 @@ class HtmlExporter(ExporterBase):
                     )
                 )
                 message.path = f'./voice/{message.str_time[:7]}/{message.file_name + ".mp3"}'
-            elif type_ == MessageType.LinkMessage or type_ == MessageType.LinkMessage2 or type_ == MessageType.LinkMessage4 or type_ == MessageType.LinkMessage5 or type_ == MessageType.LinkMessage6:
-                LinkIndex.append(msg_index)
-            elif type_ == MessageType.Music:
-                MusicIndex.append(msg_index)
-            elif type_ == MessageType.Transfer:
-                TransferIndex.append(msg_index)
-            elif type_ == MessageType.Applet or type_ == MessageType.Applet2:
-                MiniProgramIndex.append(msg_index)
-            elif type_ == MessageType.WeChatVideo:
-                VideoNumberIndex.append(msg_index)
             elif type_ == MessageType.MergedMessages:
                 parser_merged(message)
 
-            msg_index += 1
-            is_select = True
-            html_json.append(message.to_json())
-            if is_select:
-                select_msg_cnt += 1
-                # 把时间戳转换为格式化时间
-                str_time = message.str_time
-                # 2024-01-01
-                year = str_time[:4]
-                month = int(str_time[5:7])
-                curpage = math.ceil(select_msg_cnt / itemsPerPage)
-                if str_time[:10] not in date_id_map:
-                    date_id_map[str_time[:10]] = str(server_id)
-                if str_time[:10] not in dateDataMap:
-                    dateDataMap[str_time[:10]] = [curpage, str(server_id)]
-
-                if year not in timelineData:
-                    timelineData[year] = {}
-                if month not in timelineData[year]:
-                    timelineData[year][month] = []
-                    timelineData[year][month].append(curpage)
-                    timelineData[year][month].append(str(server_id))
-
+            # 消息在导出结果中的下标
+            msg_index = select_msg_cnt
+            select_msg_cnt += 1
+            # 把时间戳转换为格式化时间
+            str_time = message.str_time
+            curpage = msg_index // ITEMS_PER_PAGE + 1
+            category = message_category(type_)
+            if category:
+                indexes = categories[category]
+                add_to_timeline(category_timelines[category], str_time, len(indexes) // ITEMS_PER_PAGE + 1, server_id)
+                indexes.append(msg_index)
+            add_to_timeline(timelineData, str_time, curpage, server_id)
+            # 2024-01-01
+            if str_time[:10] not in dateDataMap:
+                dateDataMap[str_time[:10]] = [curpage, str(server_id)]
+            if not msg_index:
+                start_timestamp = message.timestamp
+            end_timestamp = message.timestamp
+            if self.paged:
+                data = message.to_json()
+                # 和页面上一样，显示文本不为空的消息都可以搜索（dict_to_js会转义，先取出原文）
+                if isinstance(data.get('text'), str) and data['text']:
+                    search_index.add(msg_index, data['text'])
+                shard.append(dict_to_js(data))
+                if len(shard) >= self.msg_num_per_shard:
+                    flush_shard()
+            else:
                 if curpage not in PageTimeline:
                     PageTimeline[curpage] = {}
-                    PageTimeline[curpage]['year'] = year
-                    PageTimeline[curpage]['month'] = month
-
-                server_id_Page[str(server_id)] = curpage
-                server_id_Idx[str(server_id)] = select_msg_cnt - 1
-
-        # print(image_tasks)
-        # print(file_tasks)
-        # print(video_tasks)
-        # print(audio_tasks)
-        logger.info('解析图片')
-        # 使用多进程，导出所有图片
-        batch_decode_image_multiprocessing(Me().xor_key, image_tasks)
-        print('开始复制文件')
-        logger.info(f'开始复制{len(video_tasks + file_tasks)}')
-        # 使用多线程，复制文件、视频到导出文件夹
-        copy_files(video_tasks + file_tasks)
-        print('开始导出语音')
-        logger.info('开始导出语音')
-        decode_audios(audio_tasks)
-
-        AllIndex = list(range(len(html_json)))
-
-        replace_map = {
+                    PageTimeline[curpage]['year'] = str_time[:4]
+                    PageTimeline[curpage]['month'] = int(str_time[5:7])
+                html_json.append(message.to_json())
+                html_data.append(dict_to_js(message.to_json()))
+                if select_msg_cnt % self.msg_num_per_shard == 0:
+                    flush_media()
+        if self.paged:
+            flush_shard()
+            for name, indexes in categories.items():
+                write_js_call(
+                    os.path.join(data_dir, f'index_{name}.js'), 'loadCategoryIndex', name, indexes,
+                    category_timelines[name]
+                )
+            search_shard_num = search_index.write(data_dir)
+            del search_index  # 索引可能很大，写完就释放
+
+        flush_media(final=True)
+
+        if self.paged:
+            # 页面里只写入消息数量、时间线等索引，分类的消息下标也在第一次打开分类时才加载
+            chat_index = {
+                'count': select_msg_cnt,
+                'shard_size': self.msg_num_per_shard,
+                'dir': f'./{quote(data_dir_name)}',
+                'start_timestamp': start_timestamp,
+                'end_timestamp': end_timestamp,
+                'search_shards': search_shard_num,
+            }
+            f.write('null')
+            replace_map = {
+                "{{chatIndex}}": chat_index,
+                "{{AllIndex}}": None,
+                **{f"{{{{{name}Index}}}}": None for name in CATEGORIES}
+            }
+        else:
+            f.write(json.dumps(html_data, ensure_ascii=False, indent=4))
+            replace_map = {
+                "{{chatIndex}}": None,
+                "{{AllIndex}}": list(range(len(html_data))),
+                **{f"{{{{{name}Index}}}}": indexes for name, indexes in categories.items()}
+            }
+        replace_map.update({
             "{{timelineData}}": timelineData,
             "{{PageTimeline}}": PageTimeline,
-            "{{server_id_Page}}": server_id_Page,
-            "{{server_id_Idx}}": server_id_Idx,
             "{{dateDataMap}}": dateDataMap,
-            "{{AllIndex}}": AllIndex,
-            "{{ImageIndex}}": ImageIndex,
-            "{{FileIndex}}": FileIndex,
-            "{{LinkIndex}}": LinkIndex,
-            "{{MusicIndex}}": MusicIndex,
-            "{{TransferIndex}}": TransferIndex,
-            "{{MiniProgramIndex}}": MiniProgramIndex,
-            "{{VideoNumberIndex}}": VideoNumberIndex
-        }
-
-        def dict_to_js(dic: dict):
-            for key, value in dic.items():
-                if isinstance(value, str):
-                    if value.startswith('http'):
-                        dic[key] = value
-                    else:
-                        dic[key] = html.escape(value)
-                elif isinstance(value, dict):
-                    dic[key] = dict_to_js(value)
-            return dic
-
-        print('开始字符串转义')
-        logger.info('开始字符串转义')
-        # 字符串转义，防止JS出现语法错误
-        html_data = []
-        for item in copy.deepcopy(html_json):
-            html_data.append(dict_to_js(item))
-
-        f.write(json.dumps(html_data, ensure_ascii=False, indent=4))
+        })
         for key, value in replace_map.items():
             html_end = html_end.replace(key, json.dumps(value))
 
         f.write(html_end)
         f.close()
 
-        with open(filename + '.json', 'w', encoding='utf-8') as f:
-            json.dump(html_json, f, ensure_ascii=False, indent=4)
+        if not self.paged:
+            with open(filename + '.json', 'w', encoding='utf-8') as f:
+                json.dump(html_json, f, ensure_ascii=False, indent=4)
 
         self.update_progress_callback(1)
-        print(f"【完成导出 HTML {self.contact.remark}】{len(messages)}")
+        print(f"【完成导出 HTML {self.contact.remark}】{select_msg_cnt}")
         self.finish_callback(self.exporter_id)
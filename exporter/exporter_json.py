@@ -1,8 +1,11 @@
 import json
 import random
 import os
+from collections import deque
+from typing import Iterator, List
 
 from wxManager import Me, MessageType
+from wxManager.model import Message, MessageQuery
 from exporter.exporter import ExporterBase, remove_privacy_info, get_new_filename
 
 
@@ -164,109 +167,115 @@ class JsonExporter(ExporterBase):
             return []
         return merge_content(conversions)
 
-    def split_by_time(self, length=300):
+    def iter_text_messages(self) -> Iterator[Message]:
+        """
+        按时间顺序逐批读取文本消息
+        @return:
+        """
+        return self.database.get_messages_iter(
+            self.contact.wxid,
+            query=MessageQuery(types={MessageType.Text}, time_range=self.time_range, need_payload=False)
+        )
+
+    def split_by_time(self, length=300) -> Iterator[List[Message]]:
         """
         通过第一条消息和最后一条消息的时间间隔分割数据集
         @param length:
-        @return:
+        @return: 逐个返回分好的消息组
         """
-        messages = self.database.get_messages_by_type(self.contact.wxid, type_=MessageType.Text,
-                                                      time_range=self.time_range)
+        messages = self.iter_text_messages()
+        message = next(messages, None)
+        exhausted = message is None  # 已经读到最后一条消息
         start_time = 0
-        res = []
-        i = 0
-        while i < len(messages):
-            message = messages[i]
+        while not exhausted:
             timestamp = message.timestamp
             is_send = message.is_sender
             group = []
-            while i < len(messages) and timestamp - start_time < length:
+            while timestamp - start_time < length:
                 group.append(message)
-                i += 1
-                if i >= len(messages):
+                following = next(messages, None)
+                if following is None:
+                    exhausted = True
                     break
-                message = messages[i]
+                message = following
                 timestamp = message.timestamp
                 is_send = message.is_sender
             while not self.is_user(is_send):
                 group.append(message)
-                i += 1
-                if i >= len(messages):
+                following = next(messages, None)
+                if following is None:
+                    exhausted = True
                     break
-                message = messages[i]
+                message = following
                 timestamp = message.timestamp
                 is_send = message.is_sender
             start_time = timestamp
             if len(group) > 4:
-                res.append(group)
-        return res
+                yield group
 
-    def split_by_intervals(self, max_diff_seconds=300):
+    def split_by_intervals(self, max_diff_seconds=300) -> Iterator[List[Message]]:
         """
         通过相邻两条消息的时间间隔分割数据集
         @param max_diff_seconds:
-        @return:
+        @return: 逐个返回分好的消息组
         """
-        messages = self.database.get_messages_by_type(self.contact.wxid, type_=MessageType.Text,
-                                                      time_range=self.time_range)
-        res = []
-        i = 0
-        current_group = []
-        while i < len(messages):
-            message = messages[i]
-            timestamp = message.timestamp
-            is_send = message.is_sender
-            while not self.is_user(is_send) and i + 1 < len(messages):
-                i += 1
-                message = messages[i]
-                is_send = message.is_sender
-            current_group = [messages[i]]
-            i += 1
-            while i < len(messages) and messages[i].timestamp - current_group[-1].timestamp <= max_diff_seconds:
-                current_group.append(messages[i])
-                i += 1
-            while i < len(messages) and not self.is_user(messages[i].is_sender):
-                current_group.append(messages[i])
-                i += 1
+        messages = self.iter_text_messages()
+        message = next(messages, None)
+        while message is not None:
+            # 跳过开头不是user发出的消息（最后一条消息除外）
+            following = next(messages, None)
+            while not self.is_user(message.is_sender) and following is not None:
+                message, following = following, next(messages, None)
+            current_group = [message]
+            message = following
+            while message is not None and message.timestamp - current_group[-1].timestamp <= max_diff_seconds:
+                current_group.append(message)
+                message = next(messages, None)
+            while message is not None and not self.is_user(message.is_sender):
+                current_group.append(message)
+                message = next(messages, None)
             if len(current_group) > 4:
-                res.append(current_group)
-        return res
+                yield current_group
 
-    def split_by_window(self, window_size=10, step=3):
+    def split_by_window(self, window_size=10, step=3) -> Iterator[List[Message]]:
         """
         滑动窗口切分数据集
         @param window_size:
         @param step:
-        @return:
+        @return: 逐个返回分好的消息组
         """
-        messages = self.database.get_messages_by_type(self.contact.wxid, type_=MessageType.Text,
-                                                      time_range=self.time_range)
-        res = []
-        i = 0
-        while i < len(messages):
-            message = messages[i]
-            timestamp = message.timestamp
-            is_send = message.is_sender
-            current_group = []
-            j = i
-            while not self.is_user(is_send) and j + 1 < len(messages) and j - i < window_size:
+        messages = self.iter_text_messages()
+        # 一个窗口最多用到从窗口开头算起的window_size+1条消息
+        window = deque()
+        while True:
+            while len(window) <= window_size:
+                message = next(messages, None)
+                if message is None:
+                    break
+                window.append(message)
+            if not window:
+                break
+            j = 0
+            while not self.is_user(window[j].is_sender) and j + 1 < len(window) and j < window_size:
                 j += 1
-                message = messages[j]
-                is_send = message.is_sender
-            current_group = [messages[j]]
+            current_group = [window[j]]
             j += 1
-            while j < len(messages) and j - i < window_size:
-                current_group.append(messages[j])
+            while j < len(window) and j < window_size:
+                current_group.append(window[j])
                 j += 1
-            res.append(current_group)
-            i += step
-        return res
+            yield current_group
+            for _ in range(step):
+                if window:
+                    window.popleft()
+                elif next(messages, None) is None:
+                    break
 
     def export(self):
         print(f"【开始导出 json {self.contact.remark}】")
         origin_path = self.origin_path
         filename = os.path.join(origin_path, f"{self.contact.remark}.json")
         filename = get_new_filename(filename)
+        # 消息组是边读边分的，只有生成的数据集保存在内存里（打乱顺序需要全部数据）
         messages_groups = []
         match self.json_config.strategy:
             case JsonStrategy.SPLIT_BY_INTERVALS:
@@ -141,18 +141,17 @@ class MarkdownExporter(ExporterBase):
         origin_path = self.origin_path
         os.makedirs(origin_path, exist_ok=True)
         filename = os.path.join(origin_path, self.contact.remark + '.md')
-        messages = self.database.get_messages(self.contact.wxid, time_range=self.time_range)
-        total_steps = len(messages)
+        total_steps = self.message_count()
         num = 1
         years = set()
         months = set()
         days = set()
         with open(filename, mode='w', newline='', encoding='utf-8') as f:
-            for index, message in enumerate(messages):
+            for index, message in enumerate(self.iter_messages()):
                 if not self._is_running:
                     break
                 if index and index % 1000 == 0:
-                    self.update_progress_callback(index / total_steps)
+                    self.report_progress(index, total_steps)
                 if not self.is_selected(message):
                     continue
                 type_ = message.type
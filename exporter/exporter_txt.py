@@ -21,17 +21,17 @@ class TxtExporter(ExporterBase):
         os.makedirs(origin_path, exist_ok=True)
         filename = os.path.join(origin_path, self.contact.remark + '.txt')
         filename = get_new_filename(filename)
-        messages = self.database.get_messages(self.contact.wxid, time_range=self.time_range)
-        total_steps = len(messages)
-        txt_res = []
-        for index, message in enumerate(messages):
-            if index and index % 1000 == 0:
-                self.update_progress_callback(index / total_steps)
-            if not self.is_selected(message):
-                continue
-            txt_res.append(f'{self.title(message)}\n{message.to_text()}')
+        total_steps = self.message_count()
         with open(filename, mode='w', newline='', encoding='utf-8') as f:
-            f.write('\n\n'.join(txt_res))
+            separator = ''
+            for index, message in enumerate(self.iter_messages(need_payload=False)):
+                if index and index % 1000 == 0:
+                    self.report_progress(index, total_steps)
+                if not self.is_selected(message):
+                    continue
+                # 边解析边写入，消息之间空一行
+                f.write(f'{separator}{self.title(message)}\n{message.to_text()}')
+                separator = '\n\n'
         self.update_progress_callback(1)
         print(f"【完成导出 TXT {self.contact.remark}】")
         self.finish_callback(self.exporter_id)
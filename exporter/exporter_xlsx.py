@@ -5,7 +5,7 @@ import traceback
 from wxManager import Me, MessageType
 from wxManager.decrypt.decrypt_dat import batch_decode_image_multiprocessing
 from wxManager.log import logger
-from wxManager.model import Message
+from wxManager.model import Message, MessageQuery
 from exporter.exporter import ExporterBase, copy_files, decode_audios, get_new_filename
 
 from PIL import JpegImagePlugin
@@ -111,14 +111,13 @@ class ExcelExporter(ExporterBase):
         filename = os.path.join(self.origin_path, f"{self.contact.remark}.xlsx")
         filename = get_new_filename(filename)
         columns = ['消息ID', '类型', '发送人', '时间', '内容', '备注', '昵称', '更多信息']
-        messages = self.database.get_messages(self.contact.wxid, time_range=self.time_range)
         new_workbook = openpyxl.Workbook()
         new_sheet = new_workbook.create_sheet("聊天记录", 0)
         member_sheet = new_workbook.create_sheet("成员信息", 1)
         self.add_member_info(member_sheet)
         new_sheet.append(columns)
         num = 1
-        total_num = len(messages)
+        total_num = self.message_count()
         image_tasks = []
         video_tasks = []
         file_tasks = []
@@ -127,7 +126,8 @@ class ExcelExporter(ExporterBase):
         video_dir = os.path.join(self.origin_path, 'video')
         audio_dir = os.path.join(self.origin_path, 'voice')
         file_dir = os.path.join(self.origin_path, 'file')
-        image_index = {}
+        # 图片消息所在的行和图片路径，插入图片时不需要再遍历一遍消息
+        image_rows = []
 
         def parser_merged(merged_message):
             for msg in merged_message.messages:
@@ -174,11 +174,11 @@ class ExcelExporter(ExporterBase):
                 elif type_ == MessageType.MergedMessages:
                     parser_merged(msg)
 
-        for index, message in enumerate(messages):
+        for index, message in enumerate(self.iter_messages()):
             if not self._is_running:
                 break
             if index % 1000 == 0:
-                self.update_progress_callback(index / total_num)
+                self.report_progress(index, total_num)
             if not self.is_selected(message):
                 continue
             try:
@@ -192,7 +192,6 @@ class ExcelExporter(ExporterBase):
             msgSvrId = message.server_id
             if type_ == MessageType.Image:
                 message.set_file_name()
-                image_index[message.server_id] = self.row
                 image_tasks.append(
                     (
                         os.path.join(Me().wx_dir, message.path),
@@ -209,6 +208,7 @@ class ExcelExporter(ExporterBase):
                 )
                 message.path = f"./image/{message.str_time[:7]}/{message.file_name}"
                 message.thumb_path = f"./image/{message.str_time[:7]}/{message.file_name + '_t'}"
+                image_rows.append((self.row, message.path, message.thumb_path))
             elif type_ == MessageType.File:
                 origin_file_path = os.path.join(Me().wx_dir, message.path)
                 file_tasks.append(
@@ -254,42 +254,40 @@ class ExcelExporter(ExporterBase):
 
         decode_audios(audio_tasks)
         if MessageType.Image in self.message_types:
-            for index, message in enumerate(messages):
-                if message.type == MessageType.Image:
-                    row = image_index[message.server_id]
-                    img_path = find_image_with_known_extensions(os.path.join(self.origin_path, message.path))
+            for row, path, thumb_path in image_rows:
+                img_path = find_image_with_known_extensions(os.path.join(self.origin_path, path))
+                if not img_path:
+                    img_path = find_image_with_known_extensions(os.path.join(self.origin_path, thumb_path))
                     if not img_path:
-                        img_path = find_image_with_known_extensions(os.path.join(self.origin_path, message.thumb_path))
-                        if not img_path:
-                            continue
-                    try:
-                        # 打开图片以获取其尺寸
-                        with PILImage.open(img_path) as img:
-                            width, height = img.size
-                        max_height = 500
-                        # 计算缩放比例
-                        scale = min(1.0, max_height / height)
-
-                        # 缩放后的图片尺寸
-                        scaled_width = int(width * scale)
-                        scaled_height = int(height * scale)
-
-                        # 插入图片
-                        img = Image(img_path)
-                        img.width = scaled_width
-                        img.height = scaled_height
-
-                        # 计算单元格的坐标
-                        cell = f"{get_column_letter(5)}{row}"
-
-                        # 将图片添加到工作表
-                        new_sheet.add_image(img, cell)
-
-                        # 设置行高
-                        new_sheet.row_dimensions[row].height = scaled_height * 0.75  # 0.75 是像素到 Excel 单位的转换因子
-                    except:
-                        logger.error(traceback.format_exc())
-                        pass
+                        continue
+                try:
+                    # 打开图片以获取其尺寸
+                    with PILImage.open(img_path) as img:
+                        width, height = img.size
+                    max_height = 500
+                    # 计算缩放比例
+                    scale = min(1.0, max_height / height)
+
+                    # 缩放后的图片尺寸
+                    scaled_width = int(width * scale)
+                    scaled_height = int(height * scale)
+
+                    # 插入图片
+                    img = Image(img_path)
+                    img.width = scaled_width
+                    img.height = scaled_height
+
+                    # 计算单元格的坐标
+                    cell = f"{get_column_letter(5)}{row}"
+
+                    # 将图片添加到工作表
+                    new_sheet.add_image(img, cell)
+
+                    # 设置行高
+                    new_sheet.row_dimensions[row].height = scaled_height * 0.75  # 0.75 是像素到 Excel 单位的转换因子
+                except:
+                    logger.error(traceback.format_exc())
+                    pass
         # 获取列的字母表示（A、B、C...）
         col_letter = get_column_letter(1)
         # 设置整列的单元格格式为文本
@@ -316,16 +314,17 @@ class ExcelExporter(ExporterBase):
         filename = os.path.join(self.origin_path, f"{self.contact.remark}.xlsx")
         filename = get_new_filename(filename)
         columns = ['日期', '时间', '标题', '描述', '链接', '更多信息']
-        messages = self.database.get_messages(self.contact.wxid, time_range=self.time_range)
+        query = MessageQuery(types={MessageType.LinkMessage}, time_range=self.time_range, need_payload=False)
+        messages = self.database.get_messages_iter(self.contact.wxid, query=query)
         new_workbook = openpyxl.Workbook()
         new_sheet = new_workbook.create_sheet("聊天记录", 0)
         new_sheet.append(columns)
-        total_num = len(messages)
+        total_num = self.message_count(query)
         for index, message in enumerate(messages):
             if not self._is_running:
                 break
             if index % 1000 == 0:
-                self.update_progress_callback(index / total_num)
+                self.report_progress(index, total_num)
             if not message.type in {MessageType.LinkMessage}:
                 continue
             try:
@@ -358,16 +357,17 @@ class ExcelExporter(ExporterBase):
         filename = os.path.join(self.origin_path, f"{self.contact.remark}.xlsx")
         filename = get_new_filename(filename)
         columns = ['类型', '收款单位', '日期', '时间', '金额', '付款方式', '收单机构', '更多信息']
-        messages = self.database.get_messages(self.contact.wxid, time_range=self.time_range)
+        query = MessageQuery(types={MessageType.LinkMessage}, time_range=self.time_range, need_payload=False)
+        messages = self.database.get_messages_iter(self.contact.wxid, query=query)
         new_workbook = openpyxl.Workbook()
         new_sheet = new_workbook.create_sheet("聊天记录", 0)
         new_sheet.append(columns)
-        total_num = len(messages)
+        total_num = self.message_count(query)
         for index, message in enumerate(messages):
             if not self._is_running:
                 break
             if index % 1000 == 0:
-                self.update_progress_callback(index / total_num)
+                self.report_progress(index, total_num)
             if not message.type in {MessageType.LinkMessage}:
                 continue
             try:
@@ -417,16 +417,17 @@ class ExcelExporter(ExporterBase):
         filename = os.path.join(self.origin_path, f"{self.contact.remark}.xlsx")
         filename = get_new_filename(filename)
         columns = ['类型', '日期', '时间', '金额', '详细信息', '汇总', '备注', '更多信息']
-        messages = self.database.get_messages(self.contact.wxid, time_range=self.time_range)
+        query = MessageQuery(types={MessageType.LinkMessage}, time_range=self.time_range, need_payload=False)
+        messages = self.database.get_messages_iter(self.contact.wxid, query=query)
         new_workbook = openpyxl.Workbook()
         new_sheet = new_workbook.create_sheet("聊天记录", 0)
         new_sheet.append(columns)
-        total_num = len(messages)
+        total_num = self.message_count(query)
         for index, message in enumerate(messages):
             if not self._is_running:
                 break
             if index % 1000 == 0:
-                self.update_progress_callback(index / total_num)
+                self.report_progress(index, total_num)
             if not message.type in {MessageType.LinkMessage}:
                 continue
             try:
@@ -468,16 +469,17 @@ class ExcelExporter(ExporterBase):
         filename = os.path.join(self.origin_path, f"{self.contact.remark}.xlsx")
         filename = get_new_filename(filename)
         columns = ['日期', '排名', '步数', '当日冠军', '当日冠军步数', '更多信息']
-        messages = self.database.get_messages(self.contact.wxid, time_range=self.time_range)
+        query = MessageQuery(types={MessageType.LinkMessage}, time_range=self.time_range, need_payload=False)
+        messages = self.database.get_messages_iter(self.contact.wxid, query=query)
         new_workbook = openpyxl.Workbook()
         new_sheet = new_workbook.create_sheet("聊天记录", 0)
         new_sheet.append(columns)
-        total_num = len(messages)
+        total_num = self.message_count(query)
         for index, message in enumerate(messages):
             if not self._is_running:
                 break
             if index and index % 1000 == 0:
-                self.update_progress_callback(index / total_num)
+                self.report_progress(index, total_num)
             if not message.type in {MessageType.LinkMessage}:
                 continue
             try:
@@ -18,7 +18,7 @@ from fastapi.staticfiles import StaticFiles
 import uvicorn
 
 # 导入核心功能模块
-from wxManager import DatabaseConnection, MessageType, Me
+from wxManager import database_registry, MessageType, Me
 from wxManager.decrypt import get_info_v3, decrypt_v3
 from exporter.config import FileType
 from exporter import HtmlExporter, TxtExporter, DocxExporter, MarkdownExporter, ExcelExporter
@@ -433,9 +433,8 @@ async def get_contacts():
         if not current_db_dir:
             raise Exception("请先解密微信数据")
         
-        # 创建数据库连接
-        conn = DatabaseConnection(current_db_dir, current_db_version)
-        current_database = conn.get_interface()
+        # 复用进程内共享的数据库连接，数据库文件变化时自动重新加载
+        current_database = database_registry.get(current_db_dir, current_db_version)
         
         if not current_database:
             raise Exception("数据库连接失败")
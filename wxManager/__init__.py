@@ -7,8 +7,15 @@
 @Version : Python3.10
 @comment : ···
 """
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Tuple
+
 from .log import logger
-from .model import Me, MessageType, Message, Person, Contact, TextMessage, ImageMessage
+from .model import Me, MessageType, Message, Person, Contact, TextMessage, ImageMessage, MessageQuery, \
+    set_connection_budget
 from .db_main import DataBaseInterface
 from .manager_v4 import DataBaseV4
 from .manager_v3 import DataBaseV3
@@ -16,24 +23,238 @@ from .manager_v3 import DataBaseV3
 __version__ = '3.0.0'
 
 
-class DatabaseConnection:
-    def __init__(self, db_dir, db_version=4):
-        self.db_dir = db_dir
-        self.db_version = db_version
-        self.database_interface = self._initialize_database()
+class DatabaseRegistry:
+    """
+    进程内共享的数据库对象，键为(db_dir, db_version)
+    - 同一个数据库目录只初始化一次，重复调用复用已打开的连接和缓存
+    - acquire/release 引用计数，refresh 时数据库文件有变化（mtime）就换成新的数据库对象，
+      旧对象在最后一个使用者release后关闭
+    - get 最多每check_interval秒检查一次文件签名，避免每次调用都stat所有分库
+    """
 
-    def _initialize_database(self) -> DataBaseInterface:
-        if self.db_version == 4:
+    def __init__(self, check_interval=2.0):
+        self.check_interval = check_interval
+        self.databases: Dict[Tuple[str, int], DataBaseInterface] = {}
+        self.signatures: Dict[Tuple[str, int], tuple] = {}
+        self.checked_at: Dict[Tuple[str, int], float] = {}  # 上次检查签名的时间（time.monotonic）
+        self.ref_counts: Dict[int, int] = {}  # id(数据库对象) -> 引用计数
+        self.retired: Dict[int, DataBaseInterface] = {}  # 已被替换或关闭、等待release的数据库对象
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def _key(db_dir, db_version):
+        return os.path.abspath(db_dir), 4 if db_version == 4 else 3
+
+    @staticmethod
+    def snapshot_signature(database: DataBaseInterface) -> tuple:
+        """
+        所有数据库文件的mtime和大小，以及所在目录下的.db文件名（检测新增分库）
+        不使用目录mtime：sqlite的-journal/-wal文件和索引旁路文件的创建删除都会改变目录mtime
+        @param database:
+        @return:
+        """
+        paths = set()
+        dirs = set()
+        for db in database.databases().values():
+            for db_path in db.db_paths:
+                paths.add(db_path)
+                dirs.add(os.path.dirname(db_path))
+        signature = []
+        for path in sorted(paths):
+            try:
+                stat = os.stat(path)
+                signature.append((path, stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                signature.append((path, 0, 0))
+        for path in sorted(dirs):
+            try:
+                names = tuple(sorted(name for name in os.listdir(path) if name.endswith('.db')))
+            except OSError:
+                names = ()
+            signature.append((path, names))
+        return tuple(signature)
+
+    @staticmethod
+    def _create(db_dir, db_version, warm_up=None):
+        if db_version == 4:
             database0 = DataBaseV4()
         else:
             database0 = DataBaseV3()
-        if database0.init_database(self.db_dir):
+        if database0.init_database(db_dir, warm_up):
             return database0
-        else:
-            logger.error(f'数据库初始化失败, 请检查路径或数据库版本是否正确, db_dir:{self.db_dir},db_version:{self.db_version}')
+        logger.error(f'数据库初始化失败, 请检查路径或数据库版本是否正确, db_dir:{db_dir},db_version:{db_version}')
+        return None
+
+    def get(self, db_dir, db_version=4, warm_up=None) -> DataBaseInterface:
+        """
+        获取共享的数据库对象（不增加引用计数），文件有变化时自动刷新
+        @param db_dir:
+        @param db_version:
+        @param warm_up: 第一次创建时预先打开的数据库，见DataBaseInterface.warm_up
+        @return: 初始化失败返回None
+        """
+        key = self._key(db_dir, db_version)
+        with self.lock:
+            database = self.databases.get(key)
+            if database is None:
+                database = self._create(db_dir, db_version, warm_up)
+                if database is None:
+                    return None
+                self.databases[key] = database
+                self.signatures[key] = self.snapshot_signature(database)
+                self.checked_at[key] = time.monotonic()
+                return database
+            if time.monotonic() - self.checked_at.get(key, 0) < self.check_interval:
+                return database
+        return self.refresh(db_dir, db_version)
+
+    def acquire(self, db_dir, db_version=4, warm_up=None) -> DataBaseInterface:
+        """
+        获取共享的数据库对象并增加引用计数，用完后调用release
+        @return:
+        """
+        with self.lock:
+            database = self.get(db_dir, db_version, warm_up)
+            if database is not None:
+                self.ref_counts[id(database)] = self.ref_counts.get(id(database), 0) + 1
+            return database
+
+    def release(self, database: DataBaseInterface):
+        """
+        减少引用计数，已被替换或关闭的数据库对象在引用计数为0时关闭
+        @param database:
+        @return:
+        """
+        if database is None:
+            return
+        with self.lock:
+            num = self.ref_counts.get(id(database), 0) - 1
+            if num > 0:
+                self.ref_counts[id(database)] = num
+                return
+            self.ref_counts.pop(id(database), None)
+            database = self.retired.pop(id(database), None)
+        if database is not None:
+            database.close()
+
+    @contextmanager
+    def session(self, db_dir, db_version=4, warm_up=None):
+        database = self.acquire(db_dir, db_version, warm_up)
+        try:
+            yield database
+        finally:
+            self.release(database)
+
+    def _retire(self, database: DataBaseInterface):
+        # 调用者需持有self.lock；仍被使用的对象等release时再关闭
+        if self.ref_counts.get(id(database)):
+            self.retired[id(database)] = database
             return None
+        return database
+
+    def refresh(self, db_dir, db_version=4, force=False) -> DataBaseInterface:
+        """
+        数据库文件有变化（例如增量解密、合并）时换成新的数据库对象
+        @param db_dir:
+        @param db_version:
+        @param force: 不检查mtime，强制刷新
+        @return: 当前的数据库对象
+        """
+        key = self._key(db_dir, db_version)
+        with self.lock:
+            database = self.databases.get(key)
+            if database is None:
+                return self.get(db_dir, db_version)
+            signature = self.snapshot_signature(database)
+            self.checked_at[key] = time.monotonic()
+            if not force and signature == self.signatures.get(key):
+                return database
+            new_database = self._create(db_dir, db_version)
+            if new_database is None:
+                return database
+            logger.info(f'数据库文件发生变化，重新加载：{db_dir}')
+            self.databases[key] = new_database
+            self.signatures[key] = self.snapshot_signature(new_database)
+            # 没有acquire的旧对象立即关闭；通过get拿到的旧对象再次使用时连接会自动重新打开（见LazyConnection）
+            database = self._retire(database)
+        if database is not None:
+            database.close()
+        return new_database
+
+    def update_signature(self, database: DataBaseInterface):
+        """
+        数据库对象自己修改了数据库文件（例如创建索引）后调用，记录新的签名，避免下次get时被当成文件变化而重新加载
+        @param database:
+        @return:
+        """
+        with self.lock:
+            for key, current in self.databases.items():
+                if current is database:
+                    self.signatures[key] = self.snapshot_signature(database)
+                    self.checked_at[key] = time.monotonic()
+
+    def close(self, db_dir, db_version=4):
+        """
+        从注册表移除，没有使用者时立即关闭，否则在最后一个使用者release后关闭
+        @param db_dir:
+        @param db_version:
+        @return:
+        """
+        key = self._key(db_dir, db_version)
+        with self.lock:
+            database = self.databases.pop(key, None)
+            self.signatures.pop(key, None)
+            self.checked_at.pop(key, None)
+            if database is None:
+                return
+            database = self._retire(database)
+        if database is not None:
+            database.close()
+
+    def close_all(self):
+        with self.lock:
+            keys = list(self.databases.keys())
+        for db_dir, db_version in keys:
+            self.close(db_dir, db_version)
+
+    def reset(self):
+        # fork出的子进程不能使用父进程打开的连接，丢弃后重新创建
+        self.databases = {}
+        self.signatures = {}
+        self.checked_at = {}
+        self.ref_counts = {}
+        self.retired = {}
+        self.lock = threading.RLock()
+
+
+database_registry = DatabaseRegistry()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=database_registry.reset)
+
+
+class DatabaseConnection:
+    def __init__(self, db_dir, db_version=4, warm_up=None, shared=True):
+        """
+        @param db_dir:
+        @param db_version:
+        @param warm_up: 预先打开的数据库，见DataBaseInterface.warm_up
+        @param shared: 使用进程内共享的数据库对象（database_registry），False时每次创建新的对象
+        """
+        self.db_dir = db_dir
+        self.db_version = db_version
+        self.warm_up = warm_up
+        self.shared = shared
+        self.database_interface = self._initialize_database()
+
+    def _initialize_database(self) -> DataBaseInterface:
+        if self.shared:
+            return database_registry.get(self.db_dir, self.db_version, self.warm_up)
+        return DatabaseRegistry._create(self.db_dir, self.db_version, self.warm_up)
 
     def get_interface(self) -> DataBaseInterface:
+        if self.shared:
+            # 文件没有变化时返回同一个对象
+            return database_registry.get(self.db_dir, self.db_version, self.warm_up)
         return self._initialize_database()
 
 
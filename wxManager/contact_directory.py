@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2026/10/20 1:30
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-contact_directory.py
+@Description : 联系人目录，联系人表、群聊表、标签表各查询一次，联系人对象和群成员列表用到时才解析
+"""
+import copy
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from wxManager.index.contact_snapshot import ContactSnapshot
+from wxManager.log import logger
+from wxManager.model.contact import Person, Me
+from wxManager.parser.util.proto_fields import chatroom_members
+
+
+class ContactDirectory:
+    """
+    - rows：{wxid: 联系人表的一行}，保持表中的排序
+    - contacts：已经构建的联系人对象，返回给调用者的是浅拷贝，调用者修改remark（群昵称）不影响缓存
+    - room_data：{群聊wxid: ChatRoomData二进制}，members：已经解析的群成员
+    - snapshot：get_contacts构建完整联系人列表后保存快照，数据库没有变化时下次直接加载
+    """
+
+    def __init__(
+            self,
+            load_contacts: Callable[[], Iterable[tuple]],
+            load_chatrooms: Callable[[], Iterable[Tuple[str, bytes]]],
+            load_labels: Callable[[], Iterable[Tuple[str, str]]],
+            create_contact: Callable[[tuple], Person],
+            snapshot: ContactSnapshot = None
+    ):
+        """
+        @param load_contacts: 返回联系人表所有行，第一列为wxid
+        @param load_chatrooms: 返回[(群聊wxid, ChatRoomData二进制)]
+        @param load_labels: 返回[(标签id, 标签名)]
+        @param create_contact: 由一行数据构建联系人对象
+        @param snapshot: 联系人快照，None表示不使用
+        """
+        self.load_contacts = load_contacts
+        self.load_chatrooms = load_chatrooms
+        self.load_labels = load_labels
+        self.create_contact = create_contact
+        self.rows: Dict[str, tuple] = {}
+        self.labels: Dict[str, str] = {}
+        self.room_data: Dict[str, bytes] = {}
+        self.contacts: Dict[str, Person] = {}
+        self.members: Dict[str, List[Tuple[str, str]]] = {}
+        self.loaded = False
+        self.signature = ''
+        self.snapshot = snapshot
+        self.snapshot_dirty = False  # 是否有快照中没有的联系人
+        self.lock = threading.RLock()
+
+    def load(self):
+        if self.loaded:
+            return
+        with self.lock:
+            if self.loaded:
+                return
+            if self.snapshot is not None:
+                self.signature = self.snapshot.signature(Me().wxid)
+                data = self.snapshot.load(self.signature)
+                if data is not None:
+                    self.rows = data['rows']
+                    self.room_data = data['room_data']
+                    self.labels = data['labels']
+                    self.contacts = data['contacts']
+                    self.members = data['members']
+                    self.snapshot_dirty = False
+                    self.loaded = True
+                    return
+            self.rows = {row[0]: row for row in self.load_contacts() if row and row[0]}
+            self.room_data = {username: data for username, data in self.load_chatrooms() if username}
+            self.labels = {str(label_id): label_name or '' for label_id, label_name in self.load_labels()}
+            self.snapshot_dirty = True
+            self.loaded = True
+            logger.info(f'联系人目录加载完成：{len(self.rows)}个联系人，{len(self.room_data)}个群聊')
+
+    def save_snapshot(self):
+        """
+        保存已经构建的联系人和群成员，没有新增内容时不写入
+        @return:
+        """
+        if self.snapshot is None:
+            return False
+        with self.lock:
+            if not self.loaded or not self.snapshot_dirty:
+                return False
+            data = {
+                'rows': self.rows,
+                'room_data': self.room_data,
+                'labels': self.labels,
+                'contacts': self.contacts,
+                'members': self.members,
+            }
+            if self.snapshot.save(self.signature, data):
+                self.snapshot_dirty = False
+                return True
+            return False
+
+    def invalidate(self):
+        """
+        联系人数据发生变化（修改备注、合并数据库）后调用，下次使用时重新加载
+        @return:
+        """
+        with self.lock:
+            if self.snapshot is not None:
+                self.snapshot.remove()
+            self.loaded = False
+            self.rows = {}
+            self.labels = {}
+            self.room_data = {}
+            self.contacts = {}
+            self.members = {}
+
+    def _get_contact(self, wxid) -> Optional[Person]:
+        contact = self.contacts.get(wxid)
+        if contact is None:
+            row = self.rows.get(wxid)
+            if row is None:
+                return None
+            contact = self.create_contact(row)
+            self.contacts[wxid] = contact
+            self.snapshot_dirty = True
+        return contact
+
+    def get_contact(self, wxid) -> Optional[Person]:
+        """
+        @param wxid:
+        @return: 联系人表中没有时返回None
+        """
+        self.load()
+        with self.lock:
+            contact = self._get_contact(wxid)
+        return copy.copy(contact) if contact is not None else None
+
+    def get_contacts(self, row_filter: Callable[[tuple], bool] = None) -> List[Person]:
+        """
+        按联系人表的排序返回联系人
+        @param row_filter: 过滤联系人表的行
+        @return:
+        """
+        self.load()
+        with self.lock:
+            contacts = [
+                copy.copy(self._get_contact(wxid))
+                for wxid, row in self.rows.items()
+                if row_filter is None or row_filter(row)
+            ]
+            if self.snapshot_dirty:
+                self.save_snapshot()
+        return contacts
+
+    def get_labels(self, label_id_list) -> str:
+        """
+        @param label_id_list: 逗号分隔的标签id
+        @return: 逗号分隔的标签名
+        """
+        if not label_id_list:
+            return ''
+        self.load()
+        return ','.join(self.labels.get(label_id, '') for label_id in label_id_list.strip(',').split(','))
+
+    def get_chatroom_members(self, chatroom_name) -> Optional[List[Tuple[str, str]]]:
+        """
+        @param chatroom_name:
+        @return: [(wxid, 群昵称)]，群聊表中没有时返回None
+        """
+        self.load()
+        with self.lock:
+            members = self.members.get(chatroom_name)
+            if members is not None:
+                return members
+            data = self.room_data.get(chatroom_name)
+            if data is None:
+                return None
+            try:
+                members = chatroom_members(data)
+            except Exception:
+                logger.error(f'{chatroom_name} 群成员解析失败')
+                return None
+            self.members[chatroom_name] = members
+            self.snapshot_dirty = True
+            return members
+
+
+if __name__ == '__main__':
+    pass
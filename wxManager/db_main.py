@@ -12,11 +12,15 @@
 from abc import ABC, abstractmethod
 
 import os
+from collections import Counter
 from datetime import date
+from itertools import islice
 from typing import List, Any, Tuple
 
 from wxManager import MessageType
 from wxManager.model.contact import Contact
+from wxManager.model.message_batch import MessageBatch, StringTable
+from wxManager.model.query import MessageQuery
 
 
 class DataBaseInterface(ABC):
@@ -24,12 +28,41 @@ class DataBaseInterface(ABC):
         self.chatroom_members_map = {}
         self.contacts_map = {}
 
-    def init_database(self, db_dir=''):
+    def init_database(self, db_dir='', warm_up=None):
+        """
+        初始化数据库，连接在第一次使用时才打开
+        @param db_dir:
+        @param warm_up: 预先打开的数据库，见warm_up
+        @return:
+        """
+        raise ValueError("子类必须实现该方法")
+
+    def databases(self) -> dict:
+        """
+        @return: {名称: DataBaseBase}
+        """
+        raise ValueError("子类必须实现该方法")
+
+    def warm_up(self, databases=None):
+        """
+        预先打开数据库连接，避免第一次查询时的打开开销
+        @param databases: True表示全部，或者数据库名称列表，例如 ['contact', 'message']
+        @return:
+        """
         raise ValueError("子类必须实现该方法")
 
     def close(self):
         raise ValueError("子类必须实现该方法")
 
+    def build_message_indexes(self, max_workers=None, analyze=True) -> dict:
+        """
+        为消息分库建立时间、类型、发送者索引（会修改解密后的数据库文件）
+        @param max_workers: 并行线程数
+        @param analyze: 是否执行ANALYZE
+        @return: {分库文件名: {"indexes": [...], "elapsed": 耗时}}
+        """
+        raise ValueError("子类必须实现该方法")
+
     def get_session(self):
         """
         获取聊天会话窗口，在聊天界面显示
@@ -41,9 +74,79 @@ class DataBaseInterface(ABC):
             self,
             username_: str,
             time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+            query: MessageQuery = None,
     ):
+        """
+        获取聊天记录
+        @param username_:
+        @param time_range:
+        @param query: 查询条件（消息类型、发送者、时间范围、是否需要媒体数据），尽量在SQL中过滤
+        @return: List[Message]
+        """
         raise ValueError("子类必须实现该方法")
 
+    def get_messages_iter(
+            self,
+            username_: str,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+            batch_size: int = 1000,
+            query: MessageQuery = None,
+    ):
+        """
+        按时间顺序逐批读取、解析聊天记录，不会一次把整个会话读入内存
+        @param username_:
+        @param time_range:
+        @param batch_size: 每批读取和解析的消息数量
+        @param query: 查询条件，同get_messages
+        @return: Iterator[Message]
+        """
+        raise ValueError("子类必须实现该方法")
+
+    def get_message_batch(
+            self,
+            username_: str,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+            query: MessageQuery = None,
+            strings: StringTable = None,
+            batch_size: int = 1000,
+    ) -> MessageBatch:
+        """
+        与get_messages相同，结果按列保存，适合同时保存大量消息或者只需要读取部分字段的统计分析
+        通过get_messages_iter逐批读取，不会同时持有整个会话的Message对象
+        @param username_:
+        @param time_range:
+        @param query:
+        @param strings: 多个会话共用的字符串表
+        @param batch_size: 每批读取和解析的消息数量
+        @return: MessageBatch
+        """
+        batch = MessageBatch(strings)
+        messages = self.get_messages_iter(username_, time_range, batch_size, query)
+        while True:
+            chunk = list(islice(messages, batch_size))
+            if not chunk:
+                break
+            batch.extend(chunk)
+        return batch
+
+    def get_sender_message_counts(
+            self,
+            username_: str,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+            batch: MessageBatch = None,
+    ) -> Counter:
+        """
+        每个发送者的消息数量（群成员发言统计）
+        @param username_:
+        @param time_range:
+        @param batch: 已经读取的MessageBatch，直接按sender_id列统计，不再查询数据库
+        @return: {发送者wxid: 消息数量}
+        """
+        if batch is not None:
+            return batch.value_counts('sender_id')
+        # 不解析消息，使用统计数据
+        return Counter(dict(self.get_messages_number_by_sender(username_, time_range)))
+
     def get_messages_by_num(self, username, start_sort_seq, msg_num=20):
         """
         获取小于start_sort_seq的msg_num个消息
@@ -56,10 +159,19 @@ class DataBaseInterface(ABC):
 
     def get_message_by_server_id(self, username, server_id):
         """
-        获取小于start_sort_seq的msg_num个消息
+        获取server_id对应的消息
         @param username:
         @param server_id:
-        @return: messages, 最后一条消息的start_sort_seq
+        @return: Message
+        """
+        raise ValueError("子类必须实现该方法")
+
+    def get_messages_by_server_ids(self, username, server_ids) -> dict:
+        """
+        批量获取server_id对应的消息
+        @param username:
+        @param server_ids:
+        @return: {server_id: Message}
         """
         raise ValueError("子类必须实现该方法")
 
@@ -86,6 +198,43 @@ class DataBaseInterface(ABC):
         raise ValueError("子类必须实现该方法")
 
     def get_messages_by_keyword(self, username_, keyword, num=5, max_len=10, time_range=None, year_='all'):
+        """
+        包含关键字的文本消息，按时间倒序
+        @param username_:
+        @param keyword:
+        @param num: 最多返回的消息数量
+        @param max_len: 消息的最大长度
+        @param time_range:
+        @param year_: 只检索某一年
+        @return: List[Message]
+        """
+        raise ValueError("子类必须实现该方法")
+
+    def build_search_index(self, max_workers=None) -> int:
+        """
+        建立/增量更新全文检索索引
+        @param max_workers: 并行提取文字的进程数
+        @return: 新增的文档数量
+        """
+        raise ValueError("子类必须实现该方法")
+
+    def search_messages(
+            self,
+            query: str,
+            talker: str = None,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+            page=1,
+            page_size=20
+    ) -> List:
+        """
+        全文检索聊天记录（文本、链接标题、文件名、引用内容），按相关度排序
+        @param query: 关键字
+        @param talker: 只检索某个聊天对象
+        @param time_range:
+        @param page: 页码，从1开始
+        @param page_size:
+        @return: List[Message]
+        """
         raise ValueError("子类必须实现该方法")
 
     def get_messages_calendar(self, username_):
@@ -121,6 +270,42 @@ class DataBaseInterface(ABC):
     ) -> int:
         raise ValueError("子类必须实现该方法")
 
+    def get_messages_count(self, username_, query: MessageQuery = None) -> int:
+        """
+        一个会话中满足查询条件的消息数量，直接在每个分库执行count(*)，不需要建立统计数据（get_messages_number）
+        按类型筛选时是SQL条件的数量（与get_messages_iter的SQL过滤相同，可能略多于解析后的结果）
+        @param username_:
+        @param query: 使用其中的消息类型、发送者和时间范围
+        @return:
+        """
+        raise ValueError("子类必须实现该方法")
+
+    def get_messages_number_by_type(
+            self,
+            username_,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+    ) -> list:
+        """
+        每种消息类型的数量
+        @param username_:
+        @param time_range:
+        @return: [(MessageType, 消息数量)]
+        """
+        raise ValueError("子类必须实现该方法")
+
+    def get_messages_number_by_sender(
+            self,
+            username_,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+    ) -> list:
+        """
+        每个发送者的消息数量
+        @param username_:
+        @param time_range:
+        @return: [(wxid, 消息数量)]
+        """
+        raise ValueError("子类必须实现该方法")
+
     def get_chatted_top_contacts(
             self,
             time_range: Tuple[int | float | str | date, int | float | str | date] = None,
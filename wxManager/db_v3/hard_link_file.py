@@ -19,6 +19,7 @@ import xml.etree.ElementTree as ET
 from wxManager.merge import increase_data
 from wxManager.model.db_model import DataBaseBase
 from wxManager.log import logger
+from wxManager.media_resolver import Md5Table
 
 file_root_path = "FileStorage\\File\\"
 
@@ -44,26 +45,38 @@ def get_md5_from_xml(content, type_="img"):
 
 
 class HardLinkFile(DataBaseBase):
-    def get_file_by_md5(self, md5: bytes | str):
-        if not md5:
-            return None
+    def __init__(self, db_file_name, is_series=False):
+        super().__init__(db_file_name, is_series)
+        # 整张表一次性读入内存，按md5查询不再访问数据库
+        self.md5_table = Md5Table(self._load_table, 'HardLinkFileAttribute')
+
+    def init_database(self, db_dir=''):
+        self.md5_table.invalidate()
+        return super().init_database(db_dir)
+
+    def _load_table(self):
         if not self.open_flag:
-            return None
-        if isinstance(md5, str):
-            md5 = binascii.unhexlify(md5)
+            return []
         sql = """
-            select Md5Hash,MD5,FileName,HardLinkFileID2.Dir as DirName2
+            select MD5,Md5Hash,MD5,FileName,HardLinkFileID2.Dir as DirName2
             from HardLinkFileAttribute
             join HardLinkFileID as HardLinkFileID2 on HardLinkFileAttribute.DirID2 = HardLinkFileID2.DirID
-            where MD5 = ?;
+            order by HardLinkFileAttribute.rowid;
             """
         cursor = self.DB.cursor()
         try:
-            cursor.execute(sql, [md5])
+            cursor.execute(sql)
         except sqlite3.OperationalError:
+            logger.error(f'HardLinkFileAttribute 读取失败\n{traceback.format_exc()}')
+            return []
+        return cursor.fetchall()
+
+    def get_file_by_md5(self, md5: bytes | str):
+        if not md5:
             return None
-        result = cursor.fetchone()
-        return result
+        if isinstance(md5, str):
+            md5 = binascii.unhexlify(md5)
+        return self.md5_table.get(md5)
 
     def get_file(self, md5: bytes | str) -> str:
         file_path = ''
@@ -83,6 +96,8 @@ class HardLinkFile(DataBaseBase):
         except:
             print(f"数据库操作错误: {traceback.format_exc()}")
             self.DB.rollback()
+        finally:
+            self.md5_table.invalidate()
 
 
 if __name__ == '__main__':
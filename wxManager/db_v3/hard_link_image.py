@@ -11,14 +11,16 @@
 import binascii
 import hashlib
 import os
+import sqlite3
 import traceback
 import xml.etree.ElementTree as ET
 
 from wxManager.merge import increase_data
 from wxManager.model.db_model import DataBaseBase
 from wxManager.log import logger
+from wxManager.media_resolver import Md5Table
 from wxManager.model.message import Message
-from wxManager.parser.util.protocbuf.msg_pb2 import MessageBytesExtra
+from wxManager.parser.util.proto_fields import bytes_extra_value
 
 image_root_path = "FileStorage\\MsgAttach\\"
 
@@ -46,42 +48,48 @@ def get_md5_from_xml(content, type_="img"):
 
 
 class HardLinkImage(DataBaseBase):
+    def __init__(self, db_file_name, is_series=False):
+        super().__init__(db_file_name, is_series)
+        # 整张表一次性读入内存，按md5查询不再访问数据库
+        self.md5_table = Md5Table(self._load_table, 'HardLinkImageAttribute')
+
     def get_image_path(self):
         pass
 
-    def get_image_by_md5(self, md5: bytes | str):
-        if not md5:
-            return None
+    def init_database(self, db_dir=''):
+        self.md5_table.invalidate()
+        return super().init_database(db_dir)
+
+    def _load_table(self):
         if not self.open_flag:
-            return None
-        if isinstance(md5, str):
-            md5 = binascii.unhexlify(md5)
+            return []
         sql = """
-            select Md5Hash,MD5,FileName,HardLinkImageID.Dir as DirName1,HardLinkImageID2.Dir as DirName2
+            select MD5,Md5Hash,MD5,FileName,HardLinkImageID.Dir as DirName1,HardLinkImageID2.Dir as DirName2
             from HardLinkImageAttribute
             join HardLinkImageID on HardLinkImageAttribute.DirID1 = HardLinkImageID.DirID
             join HardLinkImageID as HardLinkImageID2 on HardLinkImageAttribute.DirID2 = HardLinkImageID2.DirID
-            where MD5 = ?;
+            order by HardLinkImageAttribute.rowid;
         """
         cursor = self.DB.cursor()
         try:
-            cursor.execute(sql, [md5])
-        except AttributeError:
-            self.init_database()
-            cursor.execute(sql, [md5])
-        result = cursor.fetchone()
-        return result
+            cursor.execute(sql)
+        except sqlite3.OperationalError:
+            logger.error(f'HardLinkImageAttribute 读取失败\n{traceback.format_exc()}')
+            return []
+        return cursor.fetchall()
+
+    def get_image_by_md5(self, md5: bytes | str):
+        if not md5:
+            return None
+        if isinstance(md5, str):
+            md5 = binascii.unhexlify(md5)
+        return self.md5_table.get(md5)
 
     def get_image_original(self, content, bytesExtra) -> str:
-        msg_bytes = MessageBytesExtra()
-        msg_bytes.ParseFromString(bytesExtra)
         result = ''
-        for tmp in msg_bytes.message2:
-            if tmp.field1 != 4:
-                continue
-            pathh = tmp.field2  # wxid\FileStorage\...
-            pathh = "\\".join(pathh.split("\\")[1:])
-            return pathh
+        pathh = bytes_extra_value(bytesExtra, 4)  # wxid\FileStorage\...
+        if pathh is not None:
+            return "\\".join(pathh.split("\\")[1:])
         md5 = get_md5_from_xml(content)
         if not md5:
             pass
@@ -97,15 +105,10 @@ class HardLinkImage(DataBaseBase):
         return result
 
     def get_image_thumb(self, content, bytesExtra) -> str:
-        msg_bytes = MessageBytesExtra()
-        msg_bytes.ParseFromString(bytesExtra)
         result = ''
-        for tmp in msg_bytes.message2:
-            if tmp.field1 != 3:
-                continue
-            pathh = tmp.field2  # wxid\FileStorage\...
-            pathh = "\\".join(pathh.split("\\")[1:])
-            return pathh
+        pathh = bytes_extra_value(bytesExtra, 3)  # wxid\FileStorage\...
+        if pathh is not None:
+            return "\\".join(pathh.split("\\")[1:])
         md5 = get_md5_from_xml(content)
         if not md5:
             pass
@@ -151,6 +154,8 @@ class HardLinkImage(DataBaseBase):
         except:
             print(f"数据库操作错误: {traceback.format_exc()}")
             self.DB.rollback()
+        finally:
+            self.md5_table.invalidate()
 
 
 if __name__ == '__main__':
@@ -19,7 +19,8 @@ import xml.etree.ElementTree as ET
 from wxManager.merge import increase_data
 from wxManager.model.db_model import DataBaseBase
 from wxManager.log import logger
-from wxManager.parser.util.protocbuf.msg_pb2 import MessageBytesExtra
+from wxManager.media_resolver import Md5Table
+from wxManager.parser.util.proto_fields import bytes_extra_value
 
 video_root_path = "FileStorage\\Video\\"
 
@@ -45,26 +46,38 @@ def get_md5_from_xml(content, type_="img"):
 
 
 class HardLinkVideo(DataBaseBase):
-    def get_video_by_md5(self, md5: bytes | str):
-        if not md5:
-            return None
+    def __init__(self, db_file_name, is_series=False):
+        super().__init__(db_file_name, is_series)
+        # 整张表一次性读入内存，按md5查询不再访问数据库
+        self.md5_table = Md5Table(self._load_table, 'HardLinkVideoAttribute')
+
+    def init_database(self, db_dir=''):
+        self.md5_table.invalidate()
+        return super().init_database(db_dir)
+
+    def _load_table(self):
         if not self.open_flag:
-            return None
-        if isinstance(md5, str):
-            md5 = binascii.unhexlify(md5)
+            return []
         sql = """
-            select Md5Hash,MD5,FileName,HardLinkVideoID2.Dir as DirName2
+            select MD5,Md5Hash,MD5,FileName,HardLinkVideoID2.Dir as DirName2
             from HardLinkVideoAttribute
             join HardLinkVideoID as HardLinkVideoID2 on HardLinkVideoAttribute.DirID2 = HardLinkVideoID2.DirID
-            where MD5 = ?;
+            order by HardLinkVideoAttribute.rowid;
             """
         cursor = self.DB.cursor()
         try:
-            cursor.execute(sql, [md5])
+            cursor.execute(sql)
         except sqlite3.OperationalError:
+            logger.error(f'HardLinkVideoAttribute 读取失败\n{traceback.format_exc()}')
+            return []
+        return cursor.fetchall()
+
+    def get_video_by_md5(self, md5: bytes | str):
+        if not md5:
             return None
-        result = cursor.fetchone()
-        return result
+        if isinstance(md5, str):
+            md5 = binascii.unhexlify(md5)
+        return self.md5_table.get(md5)
 
     def get_video(self, content, bytesExtra, md5=None, thumb=False):
         if md5:
@@ -79,14 +92,9 @@ class HardLinkVideo(DataBaseBase):
                 return ''
         else:
             if bytesExtra:
-                msg_bytes = MessageBytesExtra()
-                msg_bytes.ParseFromString(bytesExtra)
-                for tmp in msg_bytes.message2:
-                    if tmp.field1 != (3 if thumb else 4):
-                        continue
-                    pathh = tmp.field2  # wxid\FileStorage\...
-                    pathh = "\\".join(pathh.split("\\")[1:])
-                    return pathh
+                pathh = bytes_extra_value(bytesExtra, 3 if thumb else 4)  # wxid\FileStorage\...
+                if pathh is not None:
+                    return "\\".join(pathh.split("\\")[1:])
                 md5 = get_md5_from_xml(content, type_="video")
                 if not md5:
                     return ''
@@ -113,6 +121,8 @@ class HardLinkVideo(DataBaseBase):
         except:
             print(f"数据库操作错误: {traceback.format_exc()}")
             self.DB.rollback()
+        finally:
+            self.md5_table.invalidate()
 
 
 if __name__ == '__main__':
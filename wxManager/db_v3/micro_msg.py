@@ -80,6 +80,59 @@ class MicroMsg(DataBaseBase):
             result = self.cursor.fetchall()
         return result
 
+    def get_all_contacts(self) -> list:
+        """
+        联系人表所有行（不过滤Type），列与get_contact相同，LabelIDList为标签id
+        @return:
+        """
+        if not self.open_flag:
+            return []
+        sql = '''SELECT UserName, Alias, Type, Remark, NickName, PYInitial, RemarkPYInitial, ContactHeadImgUrl.smallHeadImgUrl, ContactHeadImgUrl.bigHeadImgUrl,ExTraBuf,{}
+                FROM Contact
+                INNER JOIN ContactHeadImgUrl ON Contact.UserName = ContactHeadImgUrl.usrName
+                ORDER BY
+                    CASE
+                        WHEN RemarkQuanPin = '' THEN QuanPin
+                        ELSE RemarkQuanPin
+                    END ASC
+              '''
+        cursor = self.DB.cursor()
+        try:
+            cursor.execute(sql.format('LabelIDList'))
+        except sqlite3.OperationalError:
+            # 没有LabelIDList列
+            cursor.execute(sql.format('""'))
+        result = cursor.fetchall()
+        cursor.close()
+        return result
+
+    def get_chatroom_room_data(self) -> list:
+        """
+        @return: [(群聊wxid, RoomData二进制)]
+        """
+        if not self.open_flag:
+            return []
+        cursor = self.DB.cursor()
+        cursor.execute('SELECT ChatRoomName, RoomData FROM ChatRoom')
+        result = cursor.fetchall()
+        cursor.close()
+        return result
+
+    def get_label_map(self) -> list:
+        """
+        @return: [(标签id, 标签名)]
+        """
+        if not self.open_flag:
+            return []
+        try:
+            cursor = self.DB.cursor()
+            cursor.execute('select LabelId,LabelName from ContactLabel')
+            result = cursor.fetchall()
+            cursor.close()
+            return result
+        except sqlite3.OperationalError:
+            return []
+
     def get_contact_by_username(self, username) -> list:
         if not self.open_flag:
             return []
@@ -4,15 +4,21 @@ import sqlite3
 import traceback
 import concurrent
 import hashlib
+import heapq
 import threading
 from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date
+from operator import itemgetter
 from typing import Tuple
 
 from wxManager import MessageType
+from wxManager.index.message_index import MessageIndexRegistry, build_indexes, V3_INDEXES, v3_tables
+from wxManager.index.search import MessageSearchIndex, extract_v3_shard
+from wxManager.index.server_id import chunks
+from wxManager.index.stats import MessageStats, scan_v3_shard
 from wxManager.merge import increase_data, increase_update_data
 from wxManager.log import logger
-from wxManager.model import DataBaseBase
+from wxManager.model import DataBaseBase, Me
 
 
 def convert_to_timestamp_(time_input) -> int:
@@ -89,6 +95,99 @@ def get_local_type(type_: MessageType):
 
 
 class Msg(DataBaseBase):
+    def __init__(self, db_file_name, is_series=False):
+        super().__init__(db_file_name, is_series)
+        self.index_registry = MessageIndexRegistry('message_index.json')
+        self.stats = MessageStats('stats.db')
+        self.search_index = MessageSearchIndex('search.db')
+
+    def self_init(self):
+        self.stats.init_database(self.db_dir)
+        self.search_index.init_database(self.db_dir)
+        self.index_registry.init_database(self.db_dir)
+        self.index_registry.load(self.db_file_name)
+
+    def update_stats(self):
+        """
+        增量同步统计数据
+        @return: 新统计的消息条数
+        """
+        return self.stats.update(zip(self.db_file_name, self.db_paths, self.DB), scan_v3_shard(Me().wxid))
+
+    def get_stats(self) -> MessageStats:
+        if not self.stats.is_updated:
+            self.update_stats()
+        return self.stats
+
+    def update_search_index(self, max_workers=None):
+        """
+        增量同步全文检索索引
+        @param max_workers: 并行提取文字的进程数
+        @return: 新增的文档数量
+        """
+        return self.search_index.update(zip(self.db_file_name, self.db_paths), extract_v3_shard, max_workers)
+
+    def get_messages_by_locations(self, locations):
+        """
+        按(分库, localId)批量获取消息，结果顺序与locations一致
+        @param locations: [(talker, 分库文件名, 'MSG', localId)]
+        @return: [(talker, 消息元组)]
+        """
+        tasks = {}
+        for talker, shard, table_name, local_id in locations:
+            tasks.setdefault(shard, []).append(local_id)
+        rows = {}
+        for shard, local_ids in tasks.items():
+            if shard not in self.db_file_name:
+                continue
+            cursor = self.DB[self.db_file_name.index(shard)].cursor()
+            for batch in chunks(local_ids):
+                sql = f'''
+    select localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,MsgSvrID,BytesExtra,CompressContent,DisplayContent
+    from MSG
+    where localId in ({','.join('?' * len(batch))})
+'''
+                cursor.execute(sql, batch)
+                for message in cursor.fetchall():
+                    rows[(shard, message[0])] = message
+            cursor.close()
+        return [
+            (talker, rows[(shard, local_id)])
+            for talker, shard, table_name, local_id in locations
+            if (shard, local_id) in rows
+        ]
+
+    def search_messages(self, keyword, talker=None, time_range=None, local_types=None, page=1, page_size=20,
+                        order_by_time=False):
+        """
+        全文检索
+        @param keyword:
+        @param talker:
+        @param time_range:
+        @param local_types: SubType<<32 | Type
+        @param page:
+        @param page_size:
+        @param order_by_time: 按时间倒序，默认按相关度排序
+        @return: [(talker, 消息元组)]
+        """
+        if not self.search_index.is_updated:
+            self.update_search_index()
+        if time_range:
+            time_range = convert_to_timestamp(time_range)
+        locations = self.search_index.search(keyword, talker, time_range, local_types, page, page_size,
+                                             order_by_time)
+        return self.get_messages_by_locations(locations)
+
+    def build_indexes(self, max_workers=None, analyze=True):
+        """
+        为每个分库的MSG表建立(StrTalker, CreateTime)、(StrTalker, Type, SubType, CreateTime)、
+        (StrTalker, IsSender, CreateTime)索引，会修改解密后的数据库文件，需要主动调用
+        @param max_workers: 并行建立索引的线程数
+        @param analyze: 建立完成后是否执行ANALYZE
+        @return: {分库文件名: {"indexes": [...], "elapsed": 耗时}}
+        """
+        return build_indexes(zip(self.db_file_name, self.db_paths), V3_INDEXES, v3_tables, self.index_registry,
+                             max_workers, analyze)
 
     def _get_messages_by_num(self, cursor, username_, start_sort_seq, msg_num):
         sql = '''
@@ -130,31 +229,133 @@ class Msg(DataBaseBase):
         self.commit()
         return results
 
-    def _get_messages_by_username(self, cursor, username: str,
-                                  time_range: Tuple[int | float | str | date, int | float | str | date] = None, ):
+    def _where(self, cursor, username: str,
+               time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+               shard='', type_pairs=None):
+        """
+        @return: (索引提示, where条件, params)
+        """
+        conditions = ['StrTalker=?']
+        params = [username]
+        index_hint = self.index_registry.index_hint(cursor, shard, 'MSG', 'time')
         if time_range:
             start_time, end_time = convert_to_timestamp(time_range)
+            conditions.append('CreateTime>? AND CreateTime<?')
+            params.extend([start_time, end_time])
+        if type_pairs:
+            conditions.append(f"({' OR '.join(['(Type=? AND SubType=?)'] * len(type_pairs))})")
+            for pair in type_pairs:
+                params.extend(pair)
+            index_hint = self.index_registry.index_hint(cursor, shard, 'MSG', 'type_time')
+        return index_hint, ' AND '.join(conditions), params
+
+    def _messages_sql(self, cursor, username: str,
+                      time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+                      shard='', type_pairs=None, need_payload=True):
+        """
+        @param type_pairs: 只获取这些(Type, SubType)的消息
+        @param need_payload: 为False时不读取图片/视频xml和非49类消息的CompressContent
+        @return: (sql, params)
+        """
+        index_hint, conditions, params = self._where(cursor, username, time_range, shard, type_pairs)
+        if need_payload:
+            columns = 'StrContent'
+            compress_content = 'CompressContent'
+        else:
+            # BytesExtra里有群聊发送者，必须保留
+            columns = "CASE WHEN Type IN (3, 43) THEN '' ELSE StrContent END as StrContent"
+            compress_content = 'CASE WHEN Type=49 THEN CompressContent END as CompressContent'
         sql = f'''
-            select localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,MsgSvrID,BytesExtra,CompressContent,DisplayContent
-            from MSG
-            where StrTalker=?
-            {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
+            select localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,{columns},strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,MsgSvrID,BytesExtra,{compress_content},DisplayContent
+            from MSG {index_hint}
+            where {conditions}
             order by CreateTime
         '''
-        cursor.execute(sql, [username])
+        return sql, params
+
+    def count_messages_by_username(self, username: str,
+                                   time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+                                   type_pairs=None) -> int:
+        """
+        每个分库执行count(*)，条件与get_messages_by_username相同，不读取消息内容
+        @param username:
+        @param time_range:
+        @param type_pairs: (Type, SubType)集合，None表示全部类型
+        @return: 消息数量
+        """
+        type_pairs = sorted(type_pairs) if type_pairs else None
+        total = 0
+        for db, shard in zip(self.DB, self.db_file_name):
+            cursor = db.cursor()
+            try:
+                index_hint, conditions, params = self._where(cursor, username, time_range, shard, type_pairs)
+                cursor.execute(f'select count(*) from MSG {index_hint} where {conditions}', params)
+                total += cursor.fetchone()[0]
+            finally:
+                cursor.close()
+        return total
+
+    def _get_messages_by_username(self, cursor, username: str,
+                                  time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+                                  shard='', type_pairs=None, need_payload=True):
+        cursor.execute(*self._messages_sql(cursor, username, time_range, shard, type_pairs, need_payload))
         result = cursor.fetchall()
         if result:
             return result
         else:
             return []
 
+    def _iter_messages_by_username(self, db, username, time_range, shard, type_pairs, need_payload, batch_size):
+        cursor = db.cursor()
+        try:
+            cursor.execute(*self._messages_sql(cursor, username, time_range, shard, type_pairs, need_payload))
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield from rows
+        finally:
+            cursor.close()
+
+    def iter_messages_by_username(self, username: str,
+                                  time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+                                  type_pairs=None, need_payload=True, batch_size=1000):
+        """
+        按时间顺序逐条读取聊天记录，每个分库每次只取batch_size条，多个分库归并排序
+        @param username:
+        @param time_range:
+        @param type_pairs: (Type, SubType)集合，None表示全部类型
+        @param need_payload: 是否需要图片/视频xml等媒体数据
+        @param batch_size: 每个分库每次读取的条数
+        @return: 消息元组的迭代器
+        """
+        type_pairs = sorted(type_pairs) if type_pairs else None
+        return heapq.merge(
+            *[
+                self._iter_messages_by_username(db, username, time_range, shard, type_pairs, need_payload, batch_size)
+                for db, shard in zip(self.DB, self.db_file_name)
+            ],
+            key=itemgetter(5)
+        )
+
     def get_messages_by_username(self, username: str,
-                                 time_range: Tuple[int | float | str | date, int | float | str | date] = None, ):
+                                 time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+                                 type_pairs=None, need_payload=True):
+        """
+        获取聊天记录，筛选条件会在每个分库的SQL中执行
+        @param username:
+        @param time_range:
+        @param type_pairs: (Type, SubType)集合，None表示全部类型
+        @param need_payload: 是否需要图片/视频xml等媒体数据
+        @return:
+        """
+        type_pairs = sorted(type_pairs) if type_pairs else None
         with concurrent.futures.ThreadPoolExecutor() as executor:
             # 创建一个任务列表
             futures = [
-                executor.submit(self._get_messages_by_username, db.cursor(), username, time_range)
-                for db in self.DB
+                executor.submit(self._get_messages_by_username, db.cursor(), username, time_range, shard,
+                                type_pairs, need_payload)
+                for db, shard in zip(self.DB, self.db_file_name)
             ]
 
             # 等待所有任务完成，并获取结果
@@ -177,17 +378,42 @@ class Msg(DataBaseBase):
         sql = f'''
     select localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,MsgSvrID,BytesExtra,CompressContent,DisplayContent
     from MSG
-    where MsgSvrID=?
+    where MsgSvrID=? AND StrTalker=?
 '''
         for db in self.DB:
             cursor = db.cursor()
-            cursor.execute(sql, [server_id])
+            cursor.execute(sql, [server_id, username])
             result = cursor.fetchone()
             if result:
                 return result
 
         return None
 
+    def get_messages_by_server_ids(self, username, server_ids):
+        """
+        批量获取一个会话中的消息，MSG表自带MsgSvrID索引，每个分库按批次查询一次
+        @param username: 会话的wxid，只返回这个会话的消息
+        @param server_ids:
+        @return: {server_id: 消息元组}
+        """
+        server_ids = list({int(server_id) for server_id in server_ids if server_id})
+        result = {}
+        for db in self.DB:
+            if len(result) == len(server_ids):
+                break
+            cursor = db.cursor()
+            for batch in chunks([server_id for server_id in server_ids if server_id not in result]):
+                sql = f'''
+    select localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,MsgSvrID,BytesExtra,CompressContent,DisplayContent
+    from MSG
+    where MsgSvrID in ({','.join('?' * len(batch))}) AND StrTalker=?
+'''
+                cursor.execute(sql, batch + [username])
+                for message in cursor.fetchall():
+                    result[message[9]] = message
+            cursor.close()
+        return result
+
     def _get_messages_calendar(self, cursor, username):
         """
         获取某个人的聊天日历列表
@@ -213,13 +439,15 @@ class Msg(DataBaseBase):
         return res
 
     def _get_messages_by_type(self, cursor, username: str, type_: MessageType,
-                              time_range: Tuple[int | float | str | date, int | float | str | date] = None, ):
+                              time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+                              shard=''):
         if time_range:
             start_time, end_time = convert_to_timestamp(time_range)
         local_type, sub_type = get_local_type(type_)
+        index_hint = self.index_registry.index_hint(cursor, shard, 'MSG', 'type_time')
         sql = f'''
             select localId,TalkerId,Type,SubType,IsSender,CreateTime,Status,StrContent,strftime('%Y-%m-%d %H:%M:%S',CreateTime,'unixepoch','localtime') as StrTime,MsgSvrID,BytesExtra,CompressContent,DisplayContent
-            from MSG
+            from MSG {index_hint}
             where StrTalker=? and Type=? and SubType = ?
             {'AND CreateTime>' + str(start_time) + ' AND CreateTime<' + str(end_time) if time_range else ''}
             order by CreateTime
@@ -236,8 +464,8 @@ class Msg(DataBaseBase):
         with concurrent.futures.ThreadPoolExecutor() as executor:
             # 创建一个任务列表
             futures = [
-                executor.submit(self._get_messages_by_type, db.cursor(), username, type_, time_range)
-                for db in self.DB
+                executor.submit(self._get_messages_by_type, db.cursor(), username, type_, time_range, shard)
+                for db, shard in zip(self.DB, self.db_file_name)
             ]
 
             # 等待所有任务完成，并获取结果
@@ -270,6 +498,11 @@ class Msg(DataBaseBase):
         finally:
             lock.release()
 
+    def close(self):
+        self.stats.close()
+        self.search_index.close()
+        super().close()
+
     def merge(self, db_file_name):
         def task_(db_path, cursor, db):
             """
@@ -298,4 +531,8 @@ class Msg(DataBaseBase):
         # with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
         #     executor.map(lambda args: task_(*args), tasks)
         self.commit()
+        # 分库文件可能被替换，重新确认索引
+        self.index_registry.load(self.db_file_name)
+        self.update_stats()
+        self.update_search_index()
         print(len(tasks))
@@ -20,6 +20,7 @@ from typing import Tuple
 from wxManager import MessageType
 from wxManager.merge import increase_data, increase_update_data
 from wxManager.model.db_model import DataBaseBase
+from wxManager.parser.sql_functions import register_functions
 
 
 def convert_to_timestamp_(time_input) -> int:
@@ -66,6 +67,10 @@ class BizMessageDB(DataBaseBase):
         "create_time,'unixepoch','localtime') as StrTime,status,upload_status,server_seq,origin_source,source,"
         "message_content,compress_content")
 
+    def self_init(self):
+        # wx_unzstd、wx_xml_text、wx_msg_text，连接打开（包括被关闭后重新打开）时注册
+        self.add_open_hook(register_functions)
+
     def get_messages(self):
         pass
 
@@ -16,13 +16,20 @@ from wxManager.model.db_model import DataBaseBase
 
 
 class ContactDB(DataBaseBase):
+    def __init__(self, db_file_name, is_series=False):
+        super().__init__(db_file_name, is_series)
+        self.index_created = False
+
     def create_index(self):
+        if self.index_created:
+            return True
         sql = "CREATE INDEX IF NOT EXISTS contact_username ON contact(username);"
         try:
             cursor = self.DB.cursor()
             cursor.execute(sql)
             self.commit()
             cursor.close()
+            self.index_created = True
             return True
         except:
             return False
@@ -85,6 +92,55 @@ ORDER BY
         self.DB.commit()
         return results
 
+    def get_all_contacts(self) -> list:
+        """
+        联系人表所有行（不过滤local_type），列与get_contacts相同
+        @return:
+        """
+        if not self.open_flag:
+            return []
+        sql = '''
+SELECT username, alias, local_type, flag, remark, nick_name, pin_yin_initial, remark_pin_yin_initial, small_head_url, big_head_url,extra_buffer,head_img_md5,chat_room_notify,is_in_chat_room,description,chat_room_type
+FROM contact
+ORDER BY
+    CASE
+        WHEN remark_quan_pin = '' THEN quan_pin
+        ELSE remark_quan_pin
+    END ASC
+        '''
+        cursor = self.DB.cursor()
+        cursor.execute(sql)
+        result = cursor.fetchall()
+        cursor.close()
+        return result
+
+    def get_chatroom_room_data(self) -> list:
+        """
+        @return: [(群聊wxid, ChatRoomData二进制)]
+        """
+        if not self.open_flag:
+            return []
+        cursor = self.DB.cursor()
+        cursor.execute('select username,ext_buffer from chat_room')
+        result = cursor.fetchall()
+        cursor.close()
+        return result
+
+    def get_label_map(self) -> list:
+        """
+        @return: [(标签id, 标签名)]
+        """
+        if not self.open_flag:
+            return []
+        try:
+            cursor = self.DB.cursor()
+            cursor.execute('select label_id_,label_name_ from contact_label')
+            result = cursor.fetchall()
+            cursor.close()
+            return result
+        except:
+            return []
+
     def get_contact_by_username(self, username):
         sql = '''
 SELECT username, alias, local_type,flag, remark, nick_name, pin_yin_initial, remark_pin_yin_initial, small_head_url, big_head_url,extra_buffer,head_img_md5,chat_room_notify,is_in_chat_room,description,chat_room_type
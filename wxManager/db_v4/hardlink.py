@@ -10,6 +10,7 @@
 """
 import hashlib
 import os
+import sqlite3
 import traceback
 from lxml import etree
 
@@ -17,9 +18,9 @@ from wxManager import Me
 from wxManager.merge import increase_data
 from wxManager.model.db_model import DataBaseBase
 from wxManager.log import logger
+from wxManager.media_resolver import Md5Table, MediaFileTree, get_media_tree, V4_MEDIA_DIRS
 from wxManager.model.message import Message
-from wxManager.parser.util.protocbuf import file_info_pb2
-from google.protobuf.json_format import MessageToJson, MessageToDict
+from wxManager.parser.util.proto_fields import file_info_dir3
 
 image_root_path = "msg\\attach\\"
 video_root_path = "msg\\video\\"
@@ -49,82 +50,68 @@ def get_md5_from_xml(content, type_="img"):
         return None
 
 
+def get_dir3(extra_buffer) -> str:
+    """
+    合并转发的媒体文件保存在Rec目录下，extra_buffer中记录了子目录名
+    @param extra_buffer: FileInfoData
+    @return:
+    """
+    return file_info_dir3(extra_buffer)
+
+
 class HardLinkDB(DataBaseBase):
+    def __init__(self, db_file_name, is_series=False):
+        super().__init__(db_file_name, is_series)
+        # 三张hardlink表一次性读入内存，按md5查询不再访问数据库
+        self.image_table = Md5Table(lambda: self._load_table('image_hardlink_info_v3', False), 'image_hardlink_info_v3')
+        self.video_table = Md5Table(lambda: self._load_table('video_hardlink_info_v3'), 'video_hardlink_info_v3')
+        self.file_table = Md5Table(lambda: self._load_table('file_hardlink_info_v3'), 'file_hardlink_info_v3')
+
+    def init_database(self, db_dir=''):
+        self.image_table.invalidate()
+        self.video_table.invalidate()
+        self.file_table.invalidate()
+        return super().init_database(db_dir)
+
     def get_image_path(self):
         pass
 
-    def create_index(self):
-        sql = "CREATE INDEX IF NOT EXISTS image_hardlink_info_v3_md5 ON image_hardlink_info_v3(md5);"
+    def _load_table(self, table_name, optional_dir2=True):
+        """
+        @param table_name:
+        @param optional_dir2: 视频、文件的dir2可能为0，图片的dir2必须存在
+        @return: [(md5, file_size, type, file_name, dir1, dir2, rowid, modify_time, extra_buffer)]
+        """
+        dir2_join = 'LEFT JOIN dir2id AS dir2id2 ON dir2id2.rowid = dir2 AND dir2 != 0' if optional_dir2 else \
+            'join dir2id as dir2id2 on dir2id2.rowid=dir2'
+        sql = f'''
+        select md5,file_size,type,file_name,dir2id.username,dir2id2.username,{table_name}._rowid_,modify_time,extra_buffer
+        from {table_name}
+        join dir2id on dir2id.rowid = dir1
+        {dir2_join}
+        order by {table_name}._rowid_
+        '''
+        if not self.open_flag:
+            return []
+        cursor = self.DB.cursor()
         try:
-            cursor = self.DB.cursor()
             cursor.execute(sql)
-            self.commit()
-            cursor.close()
-        except:
-            pass
+        except sqlite3.OperationalError:
+            logger.error(f'{table_name} 读取失败\n{traceback.format_exc()}')
+            return []
+        return cursor.fetchall()
 
-        sql = "CREATE INDEX IF NOT EXISTS video_hardlink_info_v3_md5 ON video_hardlink_info_v3(md5);"
-        try:
-            cursor = self.DB.cursor()
-            cursor.execute(sql)
-            self.commit()
-            cursor.close()
-        except:
-            pass
-
-        sql = "CREATE INDEX IF NOT EXISTS file_hardlink_info_v3_md5 ON file_hardlink_info_v3(md5);"
-        try:
-            cursor = self.DB.cursor()
-            cursor.execute(sql)
-            self.commit()
-            cursor.close()
-        except:
-            pass
+    def media_tree(self) -> MediaFileTree:
+        return get_media_tree(Me().wx_dir, V4_MEDIA_DIRS)
 
     def get_image_by_md5(self, md5: str):
-        sql = '''
-        select file_size,type,file_name,dir2id.username,dir2id2.username,_rowid_,modify_time,extra_buffer
-        from image_hardlink_info_v3
-        join dir2id on dir2id.rowid = dir1
-        join dir2id as dir2id2 on dir2id2.rowid=dir2
-        where md5=?
-        '''
-        cursor = self.DB.cursor()
-        cursor.execute(sql, [md5])
-        result = cursor.fetchall()
-        if result:
-            return result[0]
-        return None
+        return self.image_table.get(md5)
 
     def get_video_by_md5(self, md5: str):
-        sql = '''
-        SELECT file_size, type, file_name, dir2id.username, dir2id2.username, _rowid_, modify_time, extra_buffer
-        FROM video_hardlink_info_v3
-        JOIN dir2id ON dir2id.rowid = dir1
-        LEFT JOIN dir2id AS dir2id2 ON dir2id2.rowid = dir2 AND dir2 != 0
-        WHERE md5 = ?
-        '''
-        cursor = self.DB.cursor()
-        cursor.execute(sql, [md5])
-        result = cursor.fetchall()
-        if result:
-            return result[0]
-        return None
+        return self.video_table.get(md5)
 
     def get_file_by_md5(self, md5: str):
-        sql = '''
-        select file_size,type,file_name,dir2id.username,dir2id2.username,_rowid_,modify_time,extra_buffer
-        from file_hardlink_info_v3
-        join dir2id on dir2id.rowid = dir1
-        LEFT JOIN dir2id AS dir2id2 ON dir2id2.rowid = dir2 AND dir2 != 0
-        where md5=?
-        '''
-        cursor = self.DB.cursor()
-        cursor.execute(sql, [md5])
-        result = cursor.fetchall()
-        if result:
-            return result[0]
-        return None
+        return self.file_table.get(md5)
 
     def get_video(self, md5, thumb=False):
         video_info = self.get_video_by_md5(md5)
@@ -133,13 +120,7 @@ class HardLinkDB(DataBaseBase):
             if type_ == 5:
                 dir1 = video_info[3]
                 dir2 = video_info[4]
-                extra_buffer = video_info[7]
-                # 创建顶级消息对象
-                message = file_info_pb2.FileInfoData()
-                # 解析二进制数据
-                message.ParseFromString(extra_buffer)
-                extra_dic = MessageToDict(message)
-                dir3 = extra_dic.get('dir3', '')
+                dir3 = get_dir3(video_info[7])
                 file_name = video_info[2]
                 result = os.path.join(video_root_path, dir1, dir2, 'Rec', dir3, 'V', file_name)
             else:
@@ -179,7 +160,7 @@ class HardLinkDB(DataBaseBase):
         create_time = message.timestamp
         data_image = f'{message.file_name}_W.dat' if message.file_name else f'{local_id}_{create_time}_W.dat'
         path1 = os.path.join(image_root_path, dir1, dir2, dir0, data_image)
-        if os.path.exists(os.path.join(Me().wx_dir, path1)):
+        if self.media_tree().exists(path1):
             return path1
         else:
             data_image = f'{message.file_name}.dat' if message.file_name else f'{local_id}_{create_time}.dat'
@@ -197,12 +178,11 @@ class HardLinkDB(DataBaseBase):
         @return:
         """
         result = '.'
-        self.create_index()
         if thumb:
             return self.get_image_thumb(message, talker_username)
         else:
             result = self.get_image_by_time(message, talker_username)
-            if os.path.exists(os.path.join(Me().wx_dir, result)):
+            if self.media_tree().exists(result):
                 return result
         if not md5:
             md5 = get_md5_from_xml(content)
@@ -213,13 +193,7 @@ class HardLinkDB(DataBaseBase):
                 if type_ == 4:
                     dir1 = imginfo[3]
                     dir2 = imginfo[4]
-                    extra_buffer = imginfo[7]
-                    # 创建顶级消息对象
-                    message = file_info_pb2.FileInfoData()
-                    # 解析二进制数据
-                    message.ParseFromString(extra_buffer)
-                    extra_dic = MessageToDict(message)
-                    dir3 = extra_dic.get('dir3', '')
+                    dir3 = get_dir3(imginfo[7])
                     file_name = imginfo[2]
                     result = os.path.join(image_root_path, dir1, dir2, 'Rec', dir3, 'Img', file_name)
                 else:
@@ -242,13 +216,7 @@ class HardLinkDB(DataBaseBase):
             if type_ == 6:
                 dir1 = file_info[3]
                 dir2 = file_info[4]
-                extra_buffer = file_info[7]
-                # 创建顶级消息对象
-                message = file_info_pb2.FileInfoData()
-                # 解析二进制数据
-                message.ParseFromString(extra_buffer)
-                extra_dic = MessageToDict(message)
-                dir3 = extra_dic.get('dir3', '')
+                dir3 = get_dir3(file_info[7])
                 file_name = file_info[2]
                 filepath = os.path.join(image_root_path, dir1, dir2, dir3, file_name)
             else:
@@ -271,6 +239,10 @@ class HardLinkDB(DataBaseBase):
         except:
             print(f"数据库操作错误: {traceback.format_exc()}")
             self.DB.rollback()
+        finally:
+            self.image_table.invalidate()
+            self.video_table.invalidate()
+            self.file_table.invalidate()
 
 
 if __name__ == '__main__':
@@ -10,16 +10,23 @@
 """
 import concurrent
 import hashlib
+import heapq
 import os
 import shutil
 import threading
 import traceback
 from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime
+from operator import itemgetter
 from typing import Tuple
 
 from wxManager import MessageType
+from wxManager.index.message_index import MessageIndexRegistry, build_indexes, V4_INDEXES, v4_tables
+from wxManager.index.search import MessageSearchIndex, extract_v4_shard
+from wxManager.index.server_id import ServerIdIndex, chunks
+from wxManager.index.stats import MessageStats, scan_v4_shard
 from wxManager.merge import increase_data, increase_update_data
+from wxManager.parser.sql_functions import register_functions
 from wxManager.model.db_model import DataBaseBase
 
 
@@ -66,6 +73,19 @@ class MessageDB(DataBaseBase):
         "local_id,server_id,local_type,sort_seq,Name2Id.user_name as sender_username,create_time,strftime('%Y-%m-%d %H:%M:%S',"
         "create_time,'unixepoch','localtime') as StrTime,status,upload_status,server_seq,origin_source,source,"
         "message_content,compress_content,packed_info_data")
+    # 不需要媒体数据时的查询列：图片、视频的xml只用于定位文件，packed_info_data只保留语音（语音转文字）
+    columns_without_payload = (
+        "local_id,server_id,local_type,sort_seq,Name2Id.user_name as sender_username,create_time,strftime('%Y-%m-%d %H:%M:%S',"
+        "create_time,'unixepoch','localtime') as StrTime,status,upload_status,server_seq,origin_source,source,"
+        f"CASE WHEN local_type IN ({MessageType.Image},{MessageType.Video}) THEN '' ELSE message_content END as message_content,"
+        f"NULL as compress_content,CASE WHEN local_type={MessageType.Audio} THEN packed_info_data ELSE x'' END as packed_info_data")
+
+    def __init__(self, db_file_name, is_series=False):
+        super().__init__(db_file_name, is_series)
+        self.server_id_index = ServerIdIndex('server_id.db')
+        self.index_registry = MessageIndexRegistry('message_index.json')
+        self.stats = MessageStats('stats.db')
+        self.search_index = MessageSearchIndex('search.db')
 
     def get_messages(self):
         pass
@@ -77,34 +97,158 @@ class MessageDB(DataBaseBase):
         # 如果结果不为空，表存在；否则表不存在
         return result
 
-    def _get_messages_by_username(self, cursor, username: str,
-                                  time_range: Tuple[int | float | str | date, int | float | str | date] = None, ):
+    def _where(self, cursor, username: str,
+               time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+               shard='', local_types=None, senders=None):
+        """
+        @return: (表名, 索引提示, where条件, params)，该分库没有这个会话时返回None
+        """
         table_name = f'Msg_{hashlib.md5(username.encode("utf-8")).hexdigest()}'
         if not self.table_exists(cursor, table_name):
             return None
+        conditions = []
+        params = []
+        index_hint = ''
         if time_range:
             start_time, end_time = convert_to_timestamp(time_range)
+            conditions.append('create_time>? AND create_time<?')
+            params.extend([start_time, end_time])
+            index_hint = self.index_registry.index_hint(cursor, shard, table_name, 'time')
+        if senders:
+            conditions.append(
+                f'real_sender_id IN (select rowid from Name2Id where user_name IN ({",".join("?" * len(senders))}))'
+            )
+            params.extend(senders)
+            index_hint = self.index_registry.index_hint(cursor, shard, table_name, 'sender_time')
+        if local_types:
+            conditions.append(f'local_type IN ({",".join("?" * len(local_types))})')
+            params.extend(local_types)
+            index_hint = self.index_registry.index_hint(cursor, shard, table_name, 'type_time')
+        where = 'where ' + ' AND '.join(conditions) if conditions else ''
+        return table_name, index_hint, where, params
+
+    def _messages_sql(self, cursor, username: str,
+                      time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+                      shard='', local_types=None, senders=None, need_payload=True):
+        """
+        @param local_types: 只获取这些local_type的消息
+        @param senders: 只获取这些发送者的消息
+        @param need_payload: 为False时不读取图片/视频xml和packed_info_data
+        @return: (sql, params)，该分库没有这个会话时返回None
+        """
+        where = self._where(cursor, username, time_range, shard, local_types, senders)
+        if where is None:
+            return None
+        table_name, index_hint, conditions, params = where
         sql = f'''
-select {MessageDB.columns}
-from {table_name} as msg
+select {MessageDB.columns if need_payload else MessageDB.columns_without_payload}
+from {table_name} as msg {index_hint}
 join Name2Id on msg.real_sender_id = Name2Id.rowid
-{'where create_time>' + str(start_time) + ' AND create_time<' + str(end_time) if time_range else ''}
+{conditions}
 order by sort_seq
         '''
-        cursor.execute(sql)
+        return sql, params
+
+    def count_messages_by_username(self, username: str,
+                                   time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+                                   local_types=None, senders=None) -> int:
+        """
+        每个分库执行count(*)，条件与get_messages_by_username相同，不读取消息内容
+        @param username:
+        @param time_range:
+        @param local_types: local_type集合，None表示全部类型
+        @param senders: 发送者wxid集合，None表示全部发送者
+        @return: 消息数量
+        """
+        local_types = sorted(local_types) if local_types else None
+        senders = sorted(senders) if senders else None
+        total = 0
+        for db, shard in zip(self.DB, self.db_file_name):
+            cursor = db.cursor()
+            try:
+                where = self._where(cursor, username, time_range, shard, local_types, senders)
+                if where is None:
+                    continue
+                table_name, index_hint, conditions, params = where
+                cursor.execute(f'select count(*) from {table_name} as msg {index_hint} {conditions}', params)
+                total += cursor.fetchone()[0]
+            finally:
+                cursor.close()
+        return total
+
+    def _get_messages_by_username(self, cursor, username: str,
+                                  time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+                                  shard='', local_types=None, senders=None, need_payload=True):
+        query = self._messages_sql(cursor, username, time_range, shard, local_types, senders, need_payload)
+        if query is None:
+            return None
+        cursor.execute(*query)
         result = cursor.fetchall()
         if result:
             return result
         else:
             return None
 
+    def _iter_messages_by_username(self, db, username, time_range, shard, local_types, senders, need_payload,
+                                   batch_size):
+        cursor = db.cursor()
+        try:
+            query = self._messages_sql(cursor, username, time_range, shard, local_types, senders, need_payload)
+            if query is None:
+                return
+            cursor.execute(*query)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield from rows
+        finally:
+            cursor.close()
+
+    def iter_messages_by_username(self, username: str,
+                                  time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+                                  local_types=None, senders=None, need_payload=True, batch_size=1000):
+        """
+        按sort_seq顺序逐条读取聊天记录，每个分库每次只取batch_size条，多个分库归并排序
+        @param username:
+        @param time_range:
+        @param local_types: local_type集合，None表示全部类型
+        @param senders: 发送者wxid集合，None表示全部发送者
+        @param need_payload: 是否需要图片/视频xml和packed_info_data
+        @param batch_size: 每个分库每次读取的条数
+        @return: 消息元组的迭代器
+        """
+        local_types = sorted(local_types) if local_types else None
+        senders = sorted(senders) if senders else None
+        return heapq.merge(
+            *[
+                self._iter_messages_by_username(db, username, time_range, shard, local_types, senders, need_payload,
+                                                batch_size)
+                for db, shard in zip(self.DB, self.db_file_name)
+            ],
+            key=itemgetter(3)
+        )
+
     def get_messages_by_username(self, username: str,
-                                 time_range: Tuple[int | float | str | date, int | float | str | date] = None, ):
+                                 time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+                                 local_types=None, senders=None, need_payload=True):
+        """
+        获取聊天记录，筛选条件会在每个分库的SQL中执行
+        @param username:
+        @param time_range:
+        @param local_types: local_type集合，None表示全部类型
+        @param senders: 发送者wxid集合，None表示全部发送者
+        @param need_payload: 是否需要图片/视频xml和packed_info_data
+        @return:
+        """
+        local_types = sorted(local_types) if local_types else None
+        senders = sorted(senders) if senders else None
         with concurrent.futures.ThreadPoolExecutor() as executor:
             # 创建一个任务列表
             futures = [
-                executor.submit(self._get_messages_by_username, db.cursor(), username, time_range)
-                for db in self.DB
+                executor.submit(self._get_messages_by_username, db.cursor(), username, time_range, shard,
+                                local_types, senders, need_payload)
+                for db, shard in zip(self.DB, self.db_file_name)
             ]
 
             # 等待所有任务完成，并获取结果
@@ -140,6 +284,46 @@ order by sort_seq
         self.commit()
         return results
 
+    def _get_messages_by_condition(self, cursor, username, condition, params, time_range=None):
+        table_name = f'Msg_{hashlib.md5(username.encode("utf-8")).hexdigest()}'
+        if not self.table_exists(cursor, table_name):
+            return []
+        params = list(params)
+        if time_range:
+            start_time, end_time = convert_to_timestamp(time_range)
+            condition = f'({condition}) AND create_time>? AND create_time<?'
+            params.extend([start_time, end_time])
+        sql = f'''
+select {MessageDB.columns}
+from {table_name} as msg
+join Name2Id on msg.real_sender_id = Name2Id.rowid
+where {condition}
+order by sort_seq
+        '''
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+    def get_messages_by_condition(self, username, condition, params=(), time_range=None):
+        """
+        用SQL条件筛选消息，条件中可以使用wx_unzstd、wx_xml_text、wx_msg_text，只有匹配的消息会返回到Python
+        例如某个域名的链接：
+            "local_type=? AND wx_xml_text(message_content, 'appmsg/url') LIKE ?", [MessageType.LinkMessage, '%github.com%']
+        @param username:
+        @param condition: where条件
+        @param params: 条件参数
+        @param time_range:
+        @return: 消息元组列表
+        """
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            futures = [
+                executor.submit(self._get_messages_by_condition, db.cursor(), username, condition, params, time_range)
+                for db in self.DB
+            ]
+            results = []
+            for future in concurrent.futures.as_completed(futures):
+                results.extend(future.result())
+        return results
+
     def _get_messages_by_num(self, cursor, username, start_sort_seq, msg_num):
         table_name = f'Msg_{hashlib.md5(username.encode("utf-8")).hexdigest()}'
         if not self.table_exists(cursor, table_name):
@@ -159,28 +343,193 @@ order by sort_seq
         else:
             return []
 
-    def get_message_by_server_id(self, username, server_id):
+    def self_init(self):
+        # wx_unzstd、wx_xml_text、wx_msg_text，连接打开（包括被关闭后重新打开）时注册
+        self.add_open_hook(register_functions)
+        self.server_id_index.init_database(self.db_dir)
+        self.stats.init_database(self.db_dir)
+        self.search_index.init_database(self.db_dir)
+        self.index_registry.init_database(self.db_dir)
+        self.index_registry.load(self.db_file_name)
+
+    def build_indexes(self, max_workers=None, analyze=True):
         """
-        获取小于start_sort_seq的msg_num个消息
-        @param username:
-        @param server_id:
-        @return: messages, 最后一条消息的start_sort_seq
+        为每个分库的消息表建立(create_time)、(local_type, create_time)、(real_sender_id, create_time)索引
+        会修改解密后的数据库文件，需要主动调用
+        @param max_workers: 并行建立索引的线程数
+        @param analyze: 建立完成后是否执行ANALYZE
+        @return: {分库文件名: {"indexes": [...], "elapsed": 耗时}}
         """
-        table_name = f'Msg_{hashlib.md5(username.encode("utf-8")).hexdigest()}'
-        sql = f'''
+        return build_indexes(zip(self.db_file_name, self.db_paths), V4_INDEXES, v4_tables, self.index_registry,
+                             max_workers, analyze)
+
+    def update_server_id_index(self):
+        """
+        增量同步server_id索引
+        @return: 新增的索引条数
+        """
+        return self.server_id_index.update(zip(self.db_file_name, self.db_paths, self.DB))
+
+    def update_stats(self):
+        """
+        增量同步统计数据
+        @return: 新统计的消息条数
+        """
+        return self.stats.update(zip(self.db_file_name, self.db_paths, self.DB), scan_v4_shard)
+
+    def get_stats(self) -> MessageStats:
+        if not self.stats.is_updated:
+            self.update_stats()
+        return self.stats
+
+    def update_search_index(self, max_workers=None):
+        """
+        增量同步全文检索索引
+        @param max_workers: 并行提取文字的进程数
+        @return: 新增的文档数量
+        """
+        return self.search_index.update(zip(self.db_file_name, self.db_paths), extract_v4_shard, max_workers)
+
+    def get_messages_by_locations(self, locations):
+        """
+        按(分库, 表, local_id)批量获取消息，结果顺序与locations一致
+        @param locations: [(talker, 分库文件名, 表名, local_id)]
+        @return: [(talker, 消息元组)]
+        """
+        tasks = {}
+        for talker, shard, table_name, local_id in locations:
+            tasks.setdefault((shard, table_name), []).append(local_id)
+        rows = {}
+        for (shard, table_name), local_ids in tasks.items():
+            if shard not in self.db_file_name:
+                continue
+            cursor = self.DB[self.db_file_name.index(shard)].cursor()
+            for batch in chunks(local_ids):
+                sql = f'''
 select {MessageDB.columns}
 from {table_name} as msg
 join Name2Id on msg.real_sender_id = Name2Id.rowid
-where server_id = ?
+where local_id in ({','.join('?' * len(batch))})
 '''
+                cursor.execute(sql, batch)
+                for message in cursor.fetchall():
+                    rows[(shard, table_name, message[0])] = message
+            cursor.close()
+        return [
+            (talker, rows[(shard, table_name, local_id)])
+            for talker, shard, table_name, local_id in locations
+            if (shard, table_name, local_id) in rows
+        ]
+
+    def search_messages(self, keyword, talker=None, time_range=None, local_types=None, page=1, page_size=20,
+                        order_by_time=False):
+        """
+        全文检索
+        @param keyword:
+        @param talker:
+        @param time_range:
+        @param local_types:
+        @param page:
+        @param page_size:
+        @param order_by_time: 按时间倒序，默认按相关度排序
+        @return: [(talker, 消息元组)]
+        """
+        if not self.search_index.is_updated:
+            self.update_search_index()
+        if time_range:
+            time_range = convert_to_timestamp(time_range)
+        locations = self.search_index.search(keyword, talker, time_range, local_types, page, page_size,
+                                             order_by_time)
+        return self.get_messages_by_locations(locations)
+
+    def _scan_messages_by_server_ids(self, username, server_ids):
+        # 没有索引可用时逐个分库查找这个会话的表
+        table_name = f'Msg_{hashlib.md5(username.encode("utf-8")).hexdigest()}'
+        server_ids = list(server_ids)
+        result = {}
         for db in self.DB:
             cursor = db.cursor()
             if not self.table_exists(cursor, table_name):
                 continue
-            cursor.execute(sql, [server_id])
-            result = cursor.fetchone()
-            if result:
-                return result
+            for batch in chunks([server_id for server_id in server_ids if server_id not in result]):
+                sql = f'''
+select {MessageDB.columns}
+from {table_name} as msg
+join Name2Id on msg.real_sender_id = Name2Id.rowid
+where server_id in ({','.join('?' * len(batch))})
+'''
+                cursor.execute(sql, batch)
+                for message in cursor.fetchall():
+                    result.setdefault(message[1], message)
+            cursor.close()
+            if len(result) == len(server_ids):
+                break
+        return result
+
+    def get_messages_by_server_ids(self, username, server_ids):
+        """
+        通过server_id索引批量获取一个会话中的消息，每个分库只查询一次
+        索引不可用（未打开、更新失败）或者记录的位置已失效（分库被替换）时逐库查找
+        @param username: 会话的wxid，只在这个会话的表中查找
+        @param server_ids:
+        @return: {server_id: 消息元组}
+        """
+        table_name = f'Msg_{hashlib.md5(username.encode("utf-8")).hexdigest()}'
+        server_ids = {int(server_id) for server_id in server_ids if server_id}
+        if not server_ids:
+            return {}
+        index = self.server_id_index
+        locations = {}
+        if index.open_flag:
+            updated_now = not index.is_updated
+            if updated_now:
+                self.update_server_id_index()
+            locations = index.get_locations(server_ids, table_name)
+            missing = server_ids - locations.keys()
+            if missing and not updated_now:
+                # 可能是之后新收到的消息，增量同步一次（只扫描发生变化的分库）
+                self.update_server_id_index()
+                locations.update(index.get_locations(missing, table_name))
+        tasks = {}
+        for shard, _, local_id in locations.values():
+            tasks.setdefault(shard, []).append(local_id)
+        result = {}
+        for shard, local_ids in tasks.items():
+            if shard not in self.db_file_name:
+                continue
+            db = self.DB[self.db_file_name.index(shard)]
+            cursor = db.cursor()
+            for batch in chunks(local_ids):
+                sql = f'''
+select {MessageDB.columns}
+from {table_name} as msg
+join Name2Id on msg.real_sender_id = Name2Id.rowid
+where local_id in ({','.join('?' * len(batch))})
+'''
+                cursor.execute(sql, batch)
+                for message in cursor.fetchall():
+                    if message[1] in locations:
+                        result[message[1]] = message
+            cursor.close()
+        # 索引没有同步成功时，索引里查不到的消息都要逐库查找；同步成功时只查找位置失效的消息
+        if index.open_flag and index.is_updated:
+            scan = locations.keys() - result.keys()
+        else:
+            scan = server_ids - result.keys()
+        if scan:
+            result.update(self._scan_messages_by_server_ids(username, scan))
+        return result
+
+    def get_message_by_server_id(self, username, server_id):
+        """
+        获取server_id对应的消息
+        @param username:
+        @param server_id:
+        @return: 消息元组
+        """
+        if not server_id:
+            return None
+        return self.get_messages_by_server_ids(username, [server_id]).get(int(server_id))
 
     def get_messages_by_num(self, username, start_sort_seq, msg_num=20):
         results = []
@@ -234,16 +583,18 @@ where server_id = ?
         return res
 
     def _get_messages_by_type(self, cursor, username: str, type_: MessageType,
-                              time_range: Tuple[int | float | str | date, int | float | str | date] = None, ):
+                              time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+                              shard=''):
         table_name = f'Msg_{hashlib.md5(username.encode("utf-8")).hexdigest()}'
         if not self.table_exists(cursor, table_name):
             return None
         if time_range:
             start_time, end_time = convert_to_timestamp(time_range)
         local_type = get_local_type(type_)
+        index_hint = self.index_registry.index_hint(cursor, shard, table_name, 'type_time')
         sql = f'''
 select {MessageDB.columns}
-from {table_name} as msg
+from {table_name} as msg {index_hint}
 join Name2Id on msg.real_sender_id = Name2Id.rowid
 where local_type=? {'and create_time>' + str(start_time) + ' AND create_time<' + str(end_time) if time_range else ''}
 order by sort_seq
@@ -260,8 +611,8 @@ order by sort_seq
         with concurrent.futures.ThreadPoolExecutor() as executor:
             # 创建一个任务列表
             futures = [
-                executor.submit(self._get_messages_by_type, db.cursor(), username, type_, time_range)
-                for db in self.DB
+                executor.submit(self._get_messages_by_type, db.cursor(), username, type_, time_range, shard)
+                for db, shard in zip(self.DB, self.db_file_name)
             ]
 
             # 等待所有任务完成，并获取结果
@@ -274,6 +625,12 @@ order by sort_seq
 
         return results
 
+    def close(self):
+        self.server_id_index.close()
+        self.stats.close()
+        self.search_index.close()
+        super().close()
+
     def merge(self, db_file_name):
         def task_(db_path, cursor, db):
             """
@@ -309,6 +666,11 @@ order by sort_seq
         # with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
         #     executor.map(lambda args: task_(*args), tasks)
         self.commit()
+        # 分库文件可能被替换，重新确认索引
+        self.index_registry.load(self.db_file_name)
+        self.update_server_id_index()
+        self.update_stats()
+        self.update_search_index()
         print(len(tasks))
 
 
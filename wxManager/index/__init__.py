@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2026/10/19 20:12
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-__init__.py.py
+@Description : 旁路索引（sidecar），保存在 db_dir/index 目录下，不修改微信原始数据库
+"""
+import os
+
+INDEX_DIR_NAME = 'index'
+
+
+def get_index_path(db_dir, file_name):
+    """
+    获取旁路索引文件的路径，目录不存在时自动创建
+    @param db_dir: 解密后的数据库目录
+    @param file_name: 索引文件名
+    @return:
+    """
+    index_dir = os.path.join(db_dir, INDEX_DIR_NAME)
+    os.makedirs(index_dir, exist_ok=True)
+    return os.path.join(index_dir, file_name)
+
+
+def file_signature(path) -> str:
+    """
+    数据库文件签名（修改时间+文件大小），用于判断快照是否发生变化
+    @param path:
+    @return:
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return ''
+    return f'{stat.st_mtime_ns}-{stat.st_size}'
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2026/10/20 2:00
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-contact_snapshot.py
+@Description : 联系人目录快照 db_dir/index/{file_name}，联系人数据库没有变化时直接加载构建好的联系人
+"""
+import os
+import pickle
+import time
+import traceback
+
+from wxManager.index import get_index_path, file_signature
+from wxManager.log import logger
+from wxManager.model.db_model import DataBaseBase
+
+# 联系人对象或快照内容的结构变化时加一，旧快照自动失效
+SNAPSHOT_VERSION = 1
+
+
+class ContactSnapshot:
+    def __init__(self, database: DataBaseBase, file_name='contact_snapshot.pkl'):
+        """
+        @param database: 联系人所在的数据库（ContactDB、MicroMsg），快照以它的文件签名为键
+        @param file_name:
+        """
+        self.database = database
+        self.file_name = file_name
+
+    def _path(self):
+        if not self.database.db_dir or not self.database.db_paths:
+            return ''
+        return get_index_path(self.database.db_dir, self.file_name)
+
+    def signature(self, me_wxid='') -> str:
+        # 群聊名称会跳过自己，自己的wxid也作为签名的一部分
+        if not self.database.db_paths:
+            return ''
+        return f'{SNAPSHOT_VERSION}-{me_wxid}-{file_signature(self.database.db_paths[0])}'
+
+    def load(self, signature) -> dict | None:
+        """
+        @param signature:
+        @return: 签名不一致或者快照不存在时返回None
+        """
+        path = self._path()
+        if not path or not signature or not os.path.exists(path):
+            return None
+        st = time.time()
+        try:
+            with open(path, 'rb') as f:
+                data = pickle.load(f)
+        except Exception:
+            logger.error(f'联系人快照读取失败\n{traceback.format_exc()}')
+            return None
+        if not isinstance(data, dict) or data.get('signature') != signature:
+            return None
+        logger.info(f'加载联系人快照：{len(data.get("contacts", {}))}个联系人，耗时{time.time() - st:.3f}s')
+        return data
+
+    def save(self, signature, data: dict):
+        path = self._path()
+        if not path or not signature:
+            return False
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump({**data, 'signature': signature}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            # 先写临时文件再替换，其他进程不会读到写了一半的快照
+            os.replace(tmp_path, path)
+            return True
+        except Exception:
+            logger.error(f'联系人快照保存失败\n{traceback.format_exc()}')
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return False
+
+    def remove(self):
+        path = self._path()
+        if path and os.path.exists(path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2026/10/19 21:05
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-message_index.py
+@Description : 按需为解密后的消息分库建立二级索引（时间范围、消息类型、发送者），并记录已建立的索引
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+from wxManager.index import get_index_path, file_signature
+from wxManager.log import logger
+
+INDEX_PREFIX = 'wx_idx'
+
+# v4：每个聊天对象一张表 Msg_{md5(username)}
+V4_INDEXES = {
+    'time': '(create_time)',
+    'type_time': '(local_type, create_time)',
+    'sender_time': '(real_sender_id, create_time)',
+}
+
+# v3：所有聊天对象共用MSG表，用StrTalker区分
+V3_INDEXES = {
+    'time': '(StrTalker, CreateTime)',
+    'type_time': '(StrTalker, Type, SubType, CreateTime)',
+    'sender_time': '(StrTalker, IsSender, CreateTime)',
+}
+
+
+def get_index_name(table_name, kind):
+    return f'{INDEX_PREFIX}_{table_name}_{kind}'
+
+
+def v4_tables(cursor) -> List[str]:
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'Msg\\_%' ESCAPE '\\';")
+    return [row[0] for row in cursor.fetchall()]
+
+
+def v3_tables(cursor) -> List[str]:
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='MSG';")
+    return [row[0] for row in cursor.fetchall()]
+
+
+def existing_indexes(cursor) -> List[str]:
+    """
+    分库中由本工具建立的索引
+    @param cursor:
+    @return:
+    """
+    cursor.execute(f"SELECT name FROM sqlite_master WHERE type='index' AND name LIKE '{INDEX_PREFIX}\\_%' ESCAPE '\\';")
+    return [row[0] for row in cursor.fetchall()]
+
+
+class MessageIndexRegistry:
+    """
+    记录每个分库里已经建立的索引，查询时据此决定是否使用 INDEXED BY
+    - 记录文件只用来判断分库是否建立过索引，生成INDEXED BY之前还要以sqlite_master为准确认一次
+      （分库被重新解密或合并替换后记录文件可能还在，索引不存在时INDEXED BY会导致查询报错）
+    记录文件：db_dir/index/{file_name}
+    {
+        "message_0.db": {"signature": "...", "indexes": [...], "elapsed": 1.23}
+    }
+    """
+
+    def __init__(self, file_name='message_index.json'):
+        self.file_name = file_name
+        self.path = ''
+        self.data: Dict[str, dict] = {}
+        self.indexes: Dict[str, set] = {}  # 分库文件名 -> 索引名集合
+        self.verified: Dict[str, set] = {}  # 分库文件名 -> sqlite_master中实际存在的索引
+        self.lock = threading.Lock()
+
+    def init_database(self, db_dir=''):
+        try:
+            self.path = get_index_path(db_dir, self.file_name)
+        except OSError:
+            self.path = ''
+            return False
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self.data = json.load(f)
+            except (OSError, ValueError):
+                self.data = {}
+        return True
+
+    def load(self, shards):
+        """
+        加载分库的索引记录，已确认的索引清空，下次生成INDEXED BY时重新确认
+        分库文件被替换（例如合并数据库）后需要重新调用
+        @param shards: [分库文件名]
+        @return:
+        """
+        with self.lock:
+            self.indexes = {shard: set(self.data[shard].get('indexes', [])) for shard in shards if self.data.get(shard)}
+            self.verified = {}
+
+    def has_index(self, shard, index_name) -> bool:
+        return index_name in self.indexes.get(shard, ())
+
+    def index_hint(self, cursor, shard, table_name, kind) -> str:
+        """
+        生成 INDEXED BY 子句，索引不存在时返回空字符串（交给SQLite自行选择）
+        @param cursor: 分库的游标，每个分库第一次使用时用来查询sqlite_master
+        @param shard: 分库文件名
+        @param table_name:
+        @param kind: time/type_time/sender_time
+        @return:
+        """
+        index_name = get_index_name(table_name, kind)
+        if not self.has_index(shard, index_name):
+            return ''
+        verified = self.verified.get(shard)
+        if verified is None:
+            verified = set(existing_indexes(cursor))
+            with self.lock:
+                self.verified[shard] = verified
+            missing = self.indexes.get(shard, set()) - verified
+            if missing:
+                logger.warning(f'{shard} 中缺少{len(missing)}个已记录的索引，查询时不再指定这些索引')
+        if index_name in verified:
+            return f'INDEXED BY {index_name}'
+        return ''
+
+    def record(self, shard, db_path, indexes, elapsed):
+        with self.lock:
+            self.data[shard] = {
+                'signature': file_signature(db_path),
+                'indexes': sorted(indexes),
+                'elapsed': round(elapsed, 3),
+            }
+            self.indexes[shard] = set(indexes)
+            self.verified[shard] = set(indexes)
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            with open(self.path, 'w', encoding='utf-8') as f:
+                json.dump(self.data, f, ensure_ascii=False, indent=4)
+
+
+def build_shard_indexes(db_path, index_specs: Dict[str, str], list_tables: Callable, analyze=True):
+    """
+    为一个分库建立索引，使用独立连接，可在线程池中并行执行
+    @param db_path: 分库路径
+    @param index_specs: {索引类型: 列定义}
+    @param list_tables: 获取需要建立索引的表
+    @param analyze: 是否执行ANALYZE更新统计信息
+    @return: (索引名列表, 耗时)
+    """
+    st = time.time()
+    db = sqlite3.connect(db_path, timeout=60)
+    try:
+        cursor = db.cursor()
+        for table_name in list_tables(cursor):
+            for kind, columns in index_specs.items():
+                index_name = get_index_name(table_name, kind)
+                cursor.execute(f'CREATE INDEX IF NOT EXISTS {index_name} ON {table_name}{columns};')
+        db.commit()
+        if analyze:
+            cursor.execute('ANALYZE;')
+            db.commit()
+        indexes = existing_indexes(cursor)
+        cursor.close()
+    finally:
+        db.close()
+    return indexes, time.time() - st
+
+
+def build_indexes(shards, index_specs: Dict[str, str], list_tables: Callable, registry: MessageIndexRegistry,
+                  max_workers=None, analyze=True) -> Dict[str, dict]:
+    """
+    并行为每个分库建立索引，已存在的索引不会重复建立
+    建立索引会改写分库文件、改变文件签名，server_id、统计、全文检索索引下次同步时会重新检查这些分库
+    （只读取记录位置之后的消息，不会全量重建）；最好在解密后、第一次同步这些索引之前建立
+    @param shards: [(分库文件名, 分库路径)]
+    @param index_specs:
+    @param list_tables:
+    @param registry: 建立完成后写入记录
+    @param max_workers:
+    @param analyze:
+    @return: {分库文件名: {"indexes": [...], "elapsed": 耗时}}
+    """
+    st = time.time()
+    result = {}
+    shards = list(shards)
+    if not shards:
+        return result
+    with ThreadPoolExecutor(max_workers=max_workers or min(len(shards), os.cpu_count() or 4)) as executor:
+        futures = {
+            executor.submit(build_shard_indexes, db_path, index_specs, list_tables, analyze): (shard, db_path)
+            for shard, db_path in shards
+        }
+        for future, (shard, db_path) in futures.items():
+            try:
+                indexes, elapsed = future.result()
+            except sqlite3.Error:
+                logger.error(f'{shard} 建立索引失败\n{traceback.format_exc()}')
+                continue
+            registry.record(shard, db_path, indexes, elapsed)
+            result[shard] = {'indexes': indexes, 'elapsed': elapsed}
+            logger.info(f'{shard} 索引建立完成：{len(indexes)}个索引，耗时{elapsed:.2f}s')
+    registry.save()
+    logger.info(f'消息索引建立完成：{len(result)}个分库，总耗时{time.time() - st:.2f}s')
+    return result
+
+
+if __name__ == '__main__':
+    pass
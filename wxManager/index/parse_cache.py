@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2026/10/20 6:00
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-parse_cache.py
+@Description : 消息解析缓存 db_dir/index/parse_cache.db
+               图片、链接、合并转发等消息的解析结果（解压、xml、protobuf、路径查找之后的Message）序列化后保存，
+               键为 (聊天对象, local_id, 原始行的内容哈希)，分库之间local_id重复或者消息内容变化时哈希不同，不会读到旧结果
+               - 只缓存一天以前的消息，最近的消息媒体文件可能还没有下载
+               - 联系人昵称、头像、引用的消息不保存，读取时按当前数据重新设置
+               - 解析器版本、账号、微信目录变化时清空；超过max_entries条时淘汰最久未使用的
+               - 每个进程（包括多进程解析的子进程）各自打开连接，WAL模式下可以同时读写
+"""
+import copy
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import traceback
+from typing import Callable, Dict, List, Tuple
+
+from wxManager.index import get_index_path
+from wxManager.log import logger
+from wxManager.model import Message, MessageType, QuoteMessage, ImageMessage, VideoMessage, FileMessage
+
+# 解析器或者消息对象结构变化时加一，旧缓存自动清空
+PARSE_CACHE_VERSION = 2
+MAX_ENTRIES = 500000
+# 超过上限时淘汰到上限的90%，避免每次写入都要淘汰
+EVICT_RATIO = 0.9
+MIN_AGE = 24 * 3600
+# 文本、系统消息解析很快，读缓存并不会更快
+UNCACHED_TYPES = {MessageType.Text, MessageType.Text2, MessageType.System}
+
+# 读取时更新last_used的间隔，同一天内反复读取不需要写数据库
+TOUCH_INTERVAL = 24 * 3600
+
+# SQLite 单条语句的参数个数有上限（旧版本为999）
+MAX_VARIABLE_NUMBER = 900
+
+
+def content_hash(row: tuple) -> int:
+    """
+    原始行的内容哈希（包括压缩后的消息内容、packed_info_data等所有列）
+    @param row:
+    @return: 64位有符号整数，可以直接作为SQLite的INTEGER
+    """
+    digest = hashlib.blake2b(pickle.dumps(row, protocol=pickle.HIGHEST_PROTOCOL), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True)
+
+
+def cacheable_message(message: Message) -> bool:
+    # 媒体文件没找到时不缓存，下次重新查找（文件可能之后才下载）
+    if isinstance(message, (ImageMessage, VideoMessage, FileMessage)) and not message.path:
+        return False
+    return True
+
+
+def dump_message(message: Message) -> bytes:
+    """
+    @param message:
+    @return: 不包括联系人昵称、头像和引用的消息
+    """
+    message = copy.copy(message)
+    message.display_name = ''
+    message.avatar_src = ''
+    quote_server_id = None
+    if isinstance(message, QuoteMessage):
+        quote_server_id = message.quote_message.server_id if message.quote_message else 0
+        message.quote_message = None
+    return pickle.dumps((message, quote_server_id), protocol=pickle.HIGHEST_PROTOCOL)
+
+
+class ParseCache:
+    def __init__(self, file_name='parse_cache.db', max_entries=MAX_ENTRIES, min_age=MIN_AGE):
+        self.file_name = file_name
+        self.max_entries = max_entries
+        self.min_age = min_age
+        self.path = ''
+        self.signature = ''
+        self.DB = None
+        self.pid = 0
+        self.count = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._lock_pid = os.getpid()
+
+    @property
+    def lock(self):
+        # fork时其他线程可能正持有锁，子进程使用新的锁
+        if self._lock_pid != os.getpid():
+            self._lock = threading.Lock()
+            self._lock_pid = os.getpid()
+        return self._lock
+
+    def init_database(self, db_dir='', signature=''):
+        """
+        @param db_dir: 解密后的数据库目录
+        @param signature: 账号、微信目录等，变化时清空缓存
+        @return:
+        """
+        self.close()
+        self.path = get_index_path(db_dir, self.file_name) if db_dir else ''
+        self.signature = f'{PARSE_CACHE_VERSION}-{signature}'
+        return True
+
+    def _connect(self):
+        # 子进程不能使用父进程的连接，按进程号重新打开
+        if self.DB is not None and self.pid == os.getpid():
+            return self.DB
+        self.DB = None
+        if not self.path:
+            return None
+        try:
+            db = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.executescript('''
+CREATE TABLE IF NOT EXISTS meta(
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS parse_cache(
+    talker TEXT,
+    local_id INTEGER,
+    content_hash INTEGER,
+    payload BLOB,
+    last_used INTEGER,
+    PRIMARY KEY (talker, local_id, content_hash)
+);
+CREATE INDEX IF NOT EXISTS parse_cache_last_used ON parse_cache(last_used);
+            ''')
+            row = db.execute("SELECT value FROM meta WHERE key='signature'").fetchone()
+            if row is None or row[0] != self.signature:
+                db.execute('DELETE FROM parse_cache')
+                db.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('signature', ?)", [self.signature])
+            db.commit()
+            self.count = db.execute('SELECT COUNT(*) FROM parse_cache').fetchone()[0]
+        except (sqlite3.Error, OSError):
+            logger.error(f'解析缓存打开失败，不使用缓存\n{traceback.format_exc()}')
+            self.path = ''
+            return None
+        self.DB = db
+        self.pid = os.getpid()
+        return db
+
+    def cutoff(self) -> int:
+        """
+        @return: 早于这个时间戳的消息才缓存
+        """
+        return int(time.time()) - self.min_age
+
+    def lookup(self, talker, rows: List[tuple], cacheable_row: Callable[[tuple, int], bool]) \
+            -> Tuple[Dict[int, tuple], Dict[int, Tuple[int, int]]]:
+        """
+        @param talker: 聊天对象wxid
+        @param rows: 从数据库读取的一批消息，第一列为local_id
+        @param cacheable_row: cacheable_row(row, cutoff)，这条消息是否使用缓存
+        @return: (命中 {下标: (消息, 引用消息的server_id)}, 未命中 {下标: (local_id, 内容哈希)})
+        """
+        hits = {}
+        misses = {}
+        if not self.path:
+            return hits, misses
+        cutoff = self.cutoff()
+        for index, row in enumerate(rows):
+            if cacheable_row(row, cutoff):
+                misses[index] = (row[0], content_hash(row))
+        if not misses:
+            return hits, misses
+        with self.lock:
+            db = self._connect()
+            if db is None:
+                return {}, {}
+            try:
+                found = {}
+                items = list(misses.items())
+                for i in range(0, len(items), MAX_VARIABLE_NUMBER):
+                    chunk = items[i:i + MAX_VARIABLE_NUMBER]
+                    cursor = db.execute(
+                        f'SELECT rowid, local_id, content_hash, payload, last_used FROM parse_cache '
+                        f'WHERE talker=? AND local_id IN ({",".join("?" * len(chunk))})',
+                        [talker, *(key[0] for _, key in chunk)]
+                    )
+                    for rowid, local_id, hash_, payload, last_used in cursor:
+                        found[(local_id, hash_)] = (rowid, payload, last_used)
+                now = int(time.time())
+                used = []
+                for index, key in items:
+                    value = found.get(key)
+                    if value is None:
+                        continue
+                    try:
+                        hits[index] = pickle.loads(value[1])
+                    except Exception:
+                        continue
+                    if value[2] < now - TOUCH_INTERVAL:
+                        used.append(value[0])
+                    del misses[index]
+                if used:
+                    for i in range(0, len(used), MAX_VARIABLE_NUMBER):
+                        chunk = used[i:i + MAX_VARIABLE_NUMBER]
+                        db.execute(
+                            f'UPDATE parse_cache SET last_used=? WHERE rowid IN ({",".join("?" * len(chunk))})',
+                            [now, *chunk]
+                        )
+                    db.commit()
+            except sqlite3.Error:
+                logger.error(f'解析缓存读取失败\n{traceback.format_exc()}')
+                return {}, {}
+        self.hits += len(hits)
+        self.misses += len(misses)
+        return hits, misses
+
+    def store(self, talker, misses: Dict[int, Tuple[int, int]], messages: List[Message]):
+        """
+        保存lookup未命中、解析完成的消息
+        @param talker:
+        @param misses: lookup返回的未命中 {下标: (local_id, 内容哈希)}
+        @param messages: 解析结果，与lookup的rows一一对应
+        @return: 保存的条数
+        """
+        if not misses or not self.path:
+            return 0
+        now = int(time.time())
+        values = []
+        for index, (local_id, hash_) in misses.items():
+            message = messages[index]
+            if not cacheable_message(message):
+                continue
+            try:
+                values.append((talker, local_id, hash_, dump_message(message), now))
+            except Exception:
+                continue
+        if not values:
+            return 0
+        with self.lock:
+            db = self._connect()
+            if db is None:
+                return 0
+            try:
+                db.executemany(
+                    'INSERT OR REPLACE INTO parse_cache(talker, local_id, content_hash, payload, last_used) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    values
+                )
+                db.commit()
+                self.count += len(values)
+                if self.count > self.max_entries:
+                    self._evict(db)
+            except sqlite3.Error:
+                logger.error(f'解析缓存写入失败\n{traceback.format_exc()}')
+                return 0
+        return len(values)
+
+    def _evict(self, db):
+        # 其他进程也在写入，以数据库中的实际条数为准
+        self.count = db.execute('SELECT COUNT(*) FROM parse_cache').fetchone()[0]
+        if self.count <= self.max_entries:
+            return
+        num = self.count - int(self.max_entries * EVICT_RATIO)
+        db.execute(
+            'DELETE FROM parse_cache WHERE rowid IN (SELECT rowid FROM parse_cache ORDER BY last_used LIMIT ?)',
+            [num]
+        )
+        db.commit()
+        self.count -= num
+        logger.info(f'解析缓存淘汰{num}条')
+
+    def invalidate(self):
+        """
+        合并数据库等媒体路径可能变化的操作之后调用
+        @return:
+        """
+        with self.lock:
+            db = self._connect()
+            if db is None:
+                return
+            try:
+                db.execute('DELETE FROM parse_cache')
+                db.commit()
+                self.count = 0
+            except sqlite3.Error:
+                logger.error(f'解析缓存清空失败\n{traceback.format_exc()}')
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
+
+    def close(self):
+        with self.lock:
+            if self.DB is not None and self.pid == os.getpid():
+                try:
+                    self.DB.close()
+                except sqlite3.Error:
+                    pass
+            self.DB = None
+
+
+if __name__ == '__main__':
+    import tempfile
+
+    import zstandard as zstd
+
+    from wxManager.model import LinkMessage
+    from wxManager.parser.link_parser import parser_link
+
+    # 模拟一批一天以前的链接消息：解压+xml解析+构建Message，与从缓存读取比较
+    compressor = zstd.ZstdCompressor()
+    link_xml = (
+        '<msg><appmsg appid="wx{i}" sdkver="0"><title>标题{i}</title><des>描述{i}</des><type>5</type>'
+        '<url>https://mp.weixin.qq.com/s/{i}</url><thumburl>https://mmbiz.qpic.cn/{i}.jpg</thumburl>'
+        + ''.join(f'<field{j}><sub a="1">{j}</sub></field{j}>' for j in range(40))
+        + '</appmsg><appinfo><appname>应用</appname></appinfo></msg>'
+    )
+    created = int(time.time()) - 30 * 24 * 3600
+    rows = [
+        (i, 10 ** 12 + i, 49, i, 'wxid_friend', created + i, '2024-01-01 00:00:00', 2,
+         compressor.compress(link_xml.format(i=i).encode('utf-8')))
+        for i in range(1, 20001)
+    ]
+    decompressor = zstd.ZstdDecompressor()
+
+    def parse(row):
+        xml_content = decompressor.decompress(row[8]).decode('utf-8')
+        info = parser_link(xml_content)
+        return LinkMessage(
+            local_id=row[0], server_id=row[1], sort_seq=row[3], timestamp=row[5], str_time=row[6],
+            type=MessageType.LinkMessage, talker_id='wxid_friend', is_sender=False, sender_id=row[4],
+            display_name='', avatar_src='', status=row[7], xml_content=xml_content,
+            href=info['url'], title=info['title'], description=info['desc'], cover_path='',
+            cover_url=info['cover_url'], app_name=info['appname'], app_icon='', app_id=info['appid'],
+        )
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        cache = ParseCache(max_entries=30000)
+        cache.init_database(db_dir, 'benchmark')
+        cacheable = lambda row, cutoff: row[5] < cutoff  # noqa: E731
+
+        st = time.perf_counter()
+        hits, misses = cache.lookup('wxid_friend', rows, cacheable)
+        expected = [parse(row) for row in rows]
+        cache.store('wxid_friend', misses, expected)
+        t_cold = time.perf_counter() - st
+
+        st = time.perf_counter()
+        hits, misses = cache.lookup('wxid_friend', rows, cacheable)
+        cached = [hits[index][0] for index in range(len(rows))]
+        t_warm = time.perf_counter() - st
+        assert not misses and [m.to_json() for m in cached] == [m.to_json() for m in expected]
+
+        # 内容变化（例如重新合并了数据库）时不会读到旧的结果
+        changed = [rows[0][:8] + (compressor.compress(b'<msg><appmsg><title>new</title></appmsg></msg>'),)]
+        assert cache.lookup('wxid_friend', changed, cacheable)[0] == {}
+        # 超过上限时淘汰
+        cache.store('wxid_friend', {0: (10 ** 6, 0)} | {i: (10 ** 6 + i, i) for i in range(1, 15000)}, expected)
+        assert cache.count <= 30000
+        st = time.perf_counter()
+        parsed = [parse(row) for row in rows]
+        t_parse = time.perf_counter() - st
+        print(f'{len(rows)}条链接消息：直接解析 {t_parse:.3f}s，首次解析并写入缓存 {t_cold:.3f}s，'
+              f'读取缓存 {t_warm:.3f}s（{t_parse / t_warm:.1f}x），缓存{cache.count}条')
+        cache.close()
@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2026/10/19 23:45
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-search.py
+@Description : 聊天记录全文检索，FTS5 trigram分词（中文不需要额外分词），索引提取出的文字而不是原始xml
+               trigram不能检索少于3个字的关键字，另外把单字和相邻两个字作为词写入message_gram，检索一两个字的关键字
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from wxManager.index import get_index_path, file_signature
+from wxManager.log import logger
+from wxManager.parser.sql_functions import register_functions
+from wxManager.parser.text_parser import message_text, decompress_lz4, TEXT_TYPE, APP_MESSAGE_TYPE
+
+# trigram分词器要求关键字至少3个字符，更短的关键字检索message_gram
+TRIGRAM_MIN_LENGTH = 3
+# 索引表结构或增量依据变化时加1，旧的索引会被清空重建
+SEARCH_VERSION = 2
+
+
+def text_grams(text) -> str:
+    """
+    文字中的单字和相邻两个字，用空格分隔后写入message_gram（unicode61分词器按空格和标点切分）
+    只保留由字母、数字、汉字组成的词，含标点的短关键字逐条比较
+    @param text:
+    @return:
+    """
+    grams = set()
+    for word in text.lower().split():
+        grams.update(char for char in word if char.isalnum())
+        grams.update(word[i:i + 2] for i in range(len(word) - 1) if word[i:i + 2].isalnum())
+    return ' '.join(grams)
+
+
+def extract_v4_shard(db_path, table_state: Dict[str, int]) -> Tuple[List[tuple], Dict[str, int]]:
+    """
+    提取v4一个分库中新增消息的文字，在子进程中执行
+    @param db_path: 分库路径
+    @param table_state: {表名: 已索引的最大local_id}（local_id是自增主键，之后合并进来的旧消息也不会漏掉）
+    @return: ([(talker, table_name, local_id, server_id, local_type, create_time, text)], 新的table_state)
+    """
+    db = sqlite3.connect(db_path)
+    register_functions(db)
+    docs = []
+    new_state = {}
+    try:
+        cursor = db.cursor()
+        cursor.execute('SELECT user_name FROM Name2Id')
+        talkers = {
+            f'Msg_{hashlib.md5(row[0].encode("utf-8")).hexdigest()}': row[0]
+            for row in cursor.fetchall() if row[0]
+        }
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'Msg\\_%' ESCAPE '\\';")
+        tables = [row[0] for row in cursor.fetchall()]
+        for table_name in tables:
+            talker = talkers.get(table_name)
+            if not talker:
+                continue
+            cursor.execute(f'SELECT max(local_id) FROM {table_name}')
+            max_local_id = cursor.fetchone()[0]
+            if not max_local_id or max_local_id <= table_state.get(table_name, 0):
+                continue
+            cursor.execute(
+                f'''
+                SELECT local_id, server_id, local_type, create_time,
+                    wx_msg_text(local_type, message_content, Name2Id.user_name) as text
+                FROM {table_name} as msg
+                LEFT JOIN Name2Id on msg.real_sender_id = Name2Id.rowid
+                WHERE local_id > ? AND local_id <= ? AND (local_type = ? OR (local_type & 4294967295) = ?)
+                    AND text != ''
+                ''',
+                [table_state.get(table_name, 0), max_local_id, TEXT_TYPE, APP_MESSAGE_TYPE]
+            )
+            docs.extend((talker, table_name, *row) for row in cursor.fetchall())
+            new_state[table_name] = max_local_id
+        cursor.close()
+    finally:
+        db.close()
+    return docs, new_state
+
+
+def extract_v3_shard(db_path, table_state: Dict[str, int]) -> Tuple[List[tuple], Dict[str, int]]:
+    """
+    提取v3一个分库中新增消息的文字，在子进程中执行
+    @param db_path: 分库路径
+    @param table_state: {'MSG': 已索引的最大localId}
+    @return: ([(talker, 'MSG', localId, MsgSvrID, SubType<<32|Type, CreateTime, text)], 新的table_state)
+    """
+    db = sqlite3.connect(db_path)
+    docs = []
+    max_local_id = table_state.get('MSG', 0)
+    try:
+        cursor = db.cursor()
+        cursor.execute('SELECT max(localId) FROM MSG')
+        new_max_local_id = cursor.fetchone()[0] or 0
+        cursor.execute(
+            '''
+            SELECT localId, MsgSvrID, (SubType << 32) | Type, CreateTime, StrTalker, StrContent, CompressContent
+            FROM MSG
+            WHERE localId > ? AND localId <= ? AND Type IN (?, ?)
+            ''',
+            [max_local_id, new_max_local_id, TEXT_TYPE, APP_MESSAGE_TYPE]
+        )
+        for local_id, server_id, local_type, create_time, talker, str_content, compress_content in cursor:
+            if local_type == TEXT_TYPE:
+                content = str_content
+            else:
+                content = decompress_lz4(compress_content) or str_content
+            text = message_text(local_type, content)
+            if text:
+                docs.append((talker, 'MSG', local_id, server_id, local_type, create_time, text))
+        max_local_id = max(new_max_local_id, max_local_id)
+        cursor.close()
+    finally:
+        db.close()
+    return docs, {'MSG': max_local_id}
+
+
+def fts_phrase(keyword) -> str:
+    # 作为整体短语匹配，避免关键字中的 AND/OR/* 等被当作FTS语法
+    return '"' + keyword.replace('"', '""') + '"'
+
+
+class MessageSearchIndex:
+    """
+    全文检索索引 db_dir/index/{index_file_name}
+    - message_doc：消息位置（聊天对象、分库、表、local_id）和时间，rowid与message_fts一致
+    - message_fts：提取出的文字
+    - message_gram：文字中的单字和相邻两个字（只保存索引，不保存内容），用于检索一两个字的关键字
+    """
+
+    def __init__(self, index_file_name='search.db'):
+        self.index_file_name = index_file_name
+        self.DB = None
+        self.open_flag = False
+        self.is_updated = False  # 本进程内是否已经同步过一次
+        self.tokenizer = 'trigram'
+        self.lock = threading.Lock()
+
+    def init_database(self, db_dir=''):
+        try:
+            index_path = get_index_path(db_dir, self.index_file_name)
+            self.DB = sqlite3.connect(index_path, check_same_thread=False, timeout=30)
+            if self.DB.execute('PRAGMA user_version').fetchone()[0] != SEARCH_VERSION:
+                self.DB.executescript(f'''
+DROP TABLE IF EXISTS message_fts;
+DROP TABLE IF EXISTS message_gram;
+DROP TABLE IF EXISTS message_doc;
+DROP TABLE IF EXISTS table_state;
+DROP TABLE IF EXISTS shard_state;
+PRAGMA user_version = {SEARCH_VERSION};
+                ''')
+            self.DB.executescript('''
+CREATE TABLE IF NOT EXISTS message_doc(
+    id INTEGER PRIMARY KEY,
+    talker TEXT,
+    shard TEXT,
+    table_name TEXT,
+    local_id INTEGER,
+    server_id INTEGER,
+    local_type INTEGER,
+    create_time INTEGER,
+    UNIQUE (shard, table_name, local_id)
+);
+CREATE INDEX IF NOT EXISTS message_doc_talker ON message_doc(talker, create_time);
+CREATE TABLE IF NOT EXISTS table_state(
+    shard TEXT,
+    table_name TEXT,
+    max_seq INTEGER,
+    PRIMARY KEY (shard, table_name)
+);
+CREATE TABLE IF NOT EXISTS shard_state(
+    shard TEXT PRIMARY KEY,
+    signature TEXT
+);
+            ''')
+            try:
+                self.DB.execute("CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5(text, tokenize='trigram');")
+            except sqlite3.OperationalError:
+                # SQLite < 3.34 没有trigram分词器
+                self.tokenizer = 'unicode61'
+                self.DB.execute("CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5(text);")
+            self.DB.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS message_gram USING "
+                "fts5(text, content='', detail='none', tokenize='unicode61 remove_diacritics 0');"
+            )
+            self.DB.commit()
+            self.open_flag = True
+        except (sqlite3.Error, OSError):
+            logger.error(f'全文检索索引初始化失败\n{traceback.format_exc()}')
+            self.open_flag = False
+        return self.open_flag
+
+    def update(self, shards: Iterable[Tuple[str, str]], extract_shard: Callable, max_workers=None):
+        """
+        多进程并行提取每个分库的新增消息，由当前线程统一写入索引
+        @param shards: [(分库文件名, 分库路径)]
+        @param extract_shard: extract_shard(db_path, table_state) -> (文档, 新的table_state)，必须是模块级函数
+        @param max_workers:
+        @return: 新增的文档数量
+        """
+        if not self.open_flag:
+            return 0
+        st = time.time()
+        num = 0
+        with self.lock:
+            cursor = self.DB.cursor()
+            cursor.execute('SELECT shard, signature FROM shard_state')
+            shard_state = dict(cursor.fetchall())
+            tasks = []
+            for shard, db_path in shards:
+                signature = file_signature(db_path)
+                if signature and shard_state.get(shard) == signature:
+                    continue
+                cursor.execute('SELECT table_name, max_seq FROM table_state WHERE shard=?', [shard])
+                tasks.append((shard, db_path, signature, dict(cursor.fetchall())))
+            if not tasks:
+                self.is_updated = True
+                return 0
+            with ProcessPoolExecutor(max_workers=max_workers or min(len(tasks), os.cpu_count() or 4)) as executor:
+                futures = {
+                    executor.submit(extract_shard, db_path, table_state): (shard, signature)
+                    for shard, db_path, signature, table_state in tasks
+                }
+                for future, (shard, signature) in futures.items():
+                    try:
+                        docs, new_state = future.result()
+                        num += self._insert(cursor, shard, docs)
+                        cursor.executemany(
+                            'INSERT OR REPLACE INTO table_state(shard, table_name, max_seq) VALUES (?, ?, ?)',
+                            ((shard, table_name, max_seq) for table_name, max_seq in new_state.items())
+                        )
+                        cursor.execute(
+                            'INSERT OR REPLACE INTO shard_state(shard, signature) VALUES (?, ?)',
+                            [shard, signature]
+                        )
+                        self.DB.commit()
+                    except (sqlite3.Error, OSError):
+                        logger.error(f'{shard} 全文检索索引更新失败\n{traceback.format_exc()}')
+                        self.DB.rollback()
+            cursor.close()
+            self.is_updated = True
+        logger.info(f'全文检索索引更新完成：新增{num}条，耗时{time.time() - st:.2f}s')
+        return num
+
+    def _insert(self, cursor, shard, docs) -> int:
+        num = 0
+        for talker, table_name, local_id, server_id, local_type, create_time, text in docs:
+            cursor.execute(
+                '''
+                INSERT OR IGNORE INTO message_doc(talker, shard, table_name, local_id, server_id, local_type, create_time)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''',
+                [talker, shard, table_name, local_id, server_id, local_type, create_time]
+            )
+            if not cursor.rowcount:
+                continue
+            doc_id = cursor.lastrowid
+            cursor.execute('INSERT INTO message_fts(rowid, text) VALUES (?, ?)', [doc_id, text])
+            cursor.execute('INSERT INTO message_gram(rowid, text) VALUES (?, ?)', [doc_id, text_grams(text)])
+            num += 1
+        return num
+
+    def search(self, keyword, talker=None, time_range=None, local_types=None, page=1, page_size=20,
+               order_by_time=False) -> List[Tuple[str, str, str, int]]:
+        """
+        检索消息
+        @param keyword:
+        @param talker: 只检索某个聊天对象
+        @param time_range: (开始时间戳, 结束时间戳)
+        @param local_types: 只检索这些消息类型
+        @param page: 页码，从1开始
+        @param page_size:
+        @param order_by_time: 按时间倒序，默认按相关度排序
+        @return: [(talker, 分库文件名, 表名, local_id)]
+        """
+        keyword = keyword.strip() if keyword else ''
+        if not self.open_flag or not keyword:
+            return []
+        conditions = []
+        params = []
+        fts_table = 'message_fts'
+        if len(keyword) >= TRIGRAM_MIN_LENGTH or self.tokenizer != 'trigram':
+            conditions.append('message_fts MATCH ?')
+            params.append(fts_phrase(keyword))
+            order = 'message_doc.create_time DESC' if order_by_time else 'message_fts.rank'
+        elif keyword.isalnum():
+            # 一两个字的关键字正好是message_gram中的一个词
+            fts_table = 'message_gram'
+            conditions.append('message_gram MATCH ?')
+            params.append(fts_phrase(keyword.lower()))
+            order = 'message_doc.create_time DESC'
+        else:
+            # 含标点的短关键字逐条比较。trigram表上少于3个字的LIKE会交给FTS5处理，中文匹配不到结果，这里用instr
+            conditions.append('instr(lower(message_fts.text), ?) > 0')
+            params.append(keyword.lower())
+            order = 'message_doc.create_time DESC'
+        if talker:
+            conditions.append('message_doc.talker = ?')
+            params.append(talker)
+        if time_range:
+            conditions.append('message_doc.create_time > ? AND message_doc.create_time < ?')
+            params.extend(time_range)
+        if local_types:
+            conditions.append(f'message_doc.local_type IN ({",".join("?" * len(local_types))})')
+            params.extend(local_types)
+        sql = f'''
+            SELECT message_doc.talker, message_doc.shard, message_doc.table_name, message_doc.local_id
+            FROM {fts_table}
+            JOIN message_doc ON message_doc.id = {fts_table}.rowid
+            WHERE {' AND '.join(conditions)}
+            ORDER BY {order}
+            LIMIT ? OFFSET ?
+        '''
+        params.extend([page_size, (max(page, 1) - 1) * page_size])
+        with self.lock:
+            cursor = self.DB.cursor()
+            cursor.execute(sql, params)
+            result = cursor.fetchall()
+            cursor.close()
+        return result
+
+    def close(self):
+        if self.open_flag:
+            self.open_flag = False
+            try:
+                self.DB.close()
+            except sqlite3.Error:
+                pass
+
+    def __del__(self):
+        self.close()
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2026/10/19 20:15
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-server_id.py
+@Description : server_id -> (分库文件, 表名, local_id) 的旁路索引，用于引用消息的快速定位
+"""
+import os
+import sqlite3
+import threading
+import traceback
+from typing import Dict, Iterable, Tuple
+
+from wxManager.index import get_index_path, file_signature
+from wxManager.log import logger
+
+# SQLite 单条语句的参数个数有上限（旧版本为999）
+MAX_VARIABLE_NUMBER = 900
+
+
+def chunks(lst, n=MAX_VARIABLE_NUMBER):
+    for i in range(0, len(lst), n):
+        yield lst[i:i + n]
+
+
+class ServerIdIndex:
+    """
+    为分库的消息数据库（message_0.db、message_1.db······）建立server_id索引
+    - 首次使用时对每个分库扫描一遍建立索引
+    - 之后只扫描发生变化的分库中local_id大于上次记录值的新消息（增量更新）
+    """
+
+    def __init__(self, index_file_name='server_id.db'):
+        self.index_file_name = index_file_name
+        self.DB = None
+        self.open_flag = False
+        self.is_updated = False  # 本进程内是否已经同步过一次
+        self.lock = threading.Lock()
+
+    def init_database(self, db_dir=''):
+        try:
+            index_path = get_index_path(db_dir, self.index_file_name)
+            self.DB = sqlite3.connect(index_path, check_same_thread=False, timeout=30)
+            self.DB.executescript('''
+CREATE TABLE IF NOT EXISTS server_id_index(
+    server_id INTEGER PRIMARY KEY,
+    shard TEXT,
+    table_name TEXT,
+    local_id INTEGER
+);
+CREATE TABLE IF NOT EXISTS table_state(
+    shard TEXT,
+    table_name TEXT,
+    max_local_id INTEGER,
+    PRIMARY KEY (shard, table_name)
+);
+CREATE TABLE IF NOT EXISTS shard_state(
+    shard TEXT PRIMARY KEY,
+    signature TEXT
+);
+            ''')
+            self.DB.commit()
+            self.open_flag = True
+        except (sqlite3.Error, OSError):
+            logger.error(f'server_id索引初始化失败，将退化为逐库查询\n{traceback.format_exc()}')
+            self.open_flag = False
+        return self.open_flag
+
+    def _update_shard(self, shard, db):
+        """
+        增量扫描一个分库
+        @param shard: 分库文件名，例如message_0.db
+        @param db: 分库的数据库连接
+        @return: 新增的索引条数
+        """
+        cursor = self.DB.cursor()
+        cursor.execute('SELECT table_name, max_local_id FROM table_state WHERE shard=?', [shard])
+        table_state = dict(cursor.fetchall())
+        src_cursor = db.cursor()
+        src_cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'Msg\\_%' ESCAPE '\\';")
+        tables = [row[0] for row in src_cursor.fetchall()]
+        num = 0
+        for table_name in tables:
+            max_local_id = table_state.get(table_name, 0)
+            src_cursor.execute(
+                f'SELECT server_id, local_id FROM {table_name} WHERE local_id > ? ORDER BY local_id',
+                [max_local_id]
+            )
+            rows = src_cursor.fetchall()
+            if not rows:
+                continue
+            cursor.executemany(
+                'INSERT OR REPLACE INTO server_id_index(server_id, shard, table_name, local_id) VALUES (?, ?, ?, ?)',
+                ((server_id, shard, table_name, local_id) for server_id, local_id in rows if server_id)
+            )
+            cursor.execute(
+                'INSERT OR REPLACE INTO table_state(shard, table_name, max_local_id) VALUES (?, ?, ?)',
+                [shard, table_name, rows[-1][1]]
+            )
+            num += len(rows)
+        src_cursor.close()
+        cursor.close()
+        return num
+
+    def update(self, shards: Iterable[Tuple[str, str, sqlite3.Connection]]):
+        """
+        同步索引，只处理文件签名发生变化的分库
+        @param shards: [(分库文件名, 分库路径, 数据库连接)]
+        @return: 新增的索引条数
+        """
+        if not self.open_flag:
+            return 0
+        num = 0
+        with self.lock:
+            try:
+                cursor = self.DB.cursor()
+                cursor.execute('SELECT shard, signature FROM shard_state')
+                shard_state = dict(cursor.fetchall())
+                for shard, db_path, db in shards:
+                    signature = file_signature(db_path)
+                    if signature and shard_state.get(shard) == signature:
+                        continue
+                    num += self._update_shard(shard, db)
+                    cursor.execute(
+                        'INSERT OR REPLACE INTO shard_state(shard, signature) VALUES (?, ?)',
+                        [shard, signature]
+                    )
+                self.DB.commit()
+                cursor.close()
+            except sqlite3.Error:
+                # 更新失败时不标记为已同步，下次查询时重试，查不到的消息由调用者逐库查找
+                logger.error(f'server_id索引更新失败\n{traceback.format_exc()}')
+                self.DB.rollback()
+                return 0
+            self.is_updated = True
+        return num
+
+    def get_locations(self, server_ids, table_name=None) -> Dict[int, Tuple[str, str, int]]:
+        """
+        批量查找server_id所在的位置
+        @param server_ids:
+        @param table_name: 只返回这张表（会话）中的消息，None表示不限
+        @return: {server_id: (分库文件名, 表名, local_id)}
+        """
+        result = {}
+        if not self.open_flag:
+            return result
+        server_ids = list({int(server_id) for server_id in server_ids if server_id})
+        with self.lock:
+            cursor = self.DB.cursor()
+            for batch in chunks(server_ids):
+                cursor.execute(
+                    f'''
+                    SELECT server_id, shard, table_name, local_id
+                    FROM server_id_index
+                    WHERE server_id IN ({','.join('?' * len(batch))}) {'AND table_name=?' if table_name else ''}
+                    ''',
+                    batch + [table_name] if table_name else batch
+                )
+                for server_id, shard, table, local_id in cursor.fetchall():
+                    result[server_id] = (shard, table, local_id)
+            cursor.close()
+        return result
+
+    def close(self):
+        if self.open_flag:
+            self.open_flag = False
+            try:
+                self.DB.close()
+            except sqlite3.Error:
+                pass
+
+    def __del__(self):
+        self.close()
+
+
+if __name__ == '__main__':
+    pass
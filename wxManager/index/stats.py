@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2026/10/19 22:50
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-stats.py
+@Description : 消息统计旁路表，按(聊天对象, 时间段, 消息类型, 发送者)保存消息数量，年度报告、聊天排行等统计直接查这张表
+"""
+import hashlib
+import sqlite3
+import threading
+import traceback
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from wxManager.index import get_index_path, file_signature
+from wxManager.log import logger
+from wxManager.parser.util.proto_fields import bytes_extra_value
+
+# 按15分钟分桶（create_time/900），查询时再转换成本地时间。
+# 现行时区的偏移都是15分钟的整数倍（包括+5:30、+5:45这样的非整小时时区和夏令时），按天、按小时统计与按本地时间分桶完全一致
+SLOT = 900
+# 统计表结构或增量依据变化时加1，旧的统计数据会被清空重建
+STATS_VERSION = 2
+
+
+def chatroom_sender(bytes_extra):
+    """
+    v3群聊消息的发送者保存在BytesExtra里，注册为SQLite函数后在GROUP BY中使用
+    @param bytes_extra:
+    @return: wxid
+    """
+    if not bytes_extra:
+        return ''
+    try:
+        wxid = bytes_extra_value(bytes_extra, 1, last=True) or ''
+    except Exception:
+        return ''
+    return wxid.split(':')[0]
+
+
+def scan_v4_shard(db, table_state: Dict[str, int]) -> Tuple[List[tuple], Dict[str, int]]:
+    """
+    对v4的一个分库做一次分组统计，只统计local_id大于上次记录值的消息
+    local_id是自增主键，之后合并进来的旧消息也会分配更大的local_id，不会漏统计（sort_seq按时间排序，不能作为增量依据）
+    @param db: 分库连接
+    @param table_state: {表名: 已统计的最大local_id}
+    @return: ([(talker, slot, local_type, sender, num)], 新的table_state)
+    """
+    cursor = db.cursor()
+    cursor.execute('SELECT user_name FROM Name2Id')
+    # 表名是聊天对象wxid的md5
+    talkers = {
+        f'Msg_{hashlib.md5(row[0].encode("utf-8")).hexdigest()}': row[0]
+        for row in cursor.fetchall() if row[0]
+    }
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'Msg\\_%' ESCAPE '\\';")
+    tables = [row[0] for row in cursor.fetchall()]
+    rows = []
+    new_state = {}
+    for table_name in tables:
+        talker = talkers.get(table_name)
+        if not talker:
+            continue
+        cursor.execute(
+            f'''
+            SELECT create_time/{SLOT} as slot, local_type, Name2Id.user_name, count(*), max(local_id)
+            FROM {table_name} as msg
+            JOIN Name2Id on msg.real_sender_id = Name2Id.rowid
+            WHERE local_id > ?
+            GROUP BY slot, local_type, real_sender_id
+            ''',
+            [table_state.get(table_name, 0)]
+        )
+        result = cursor.fetchall()
+        if not result:
+            continue
+        rows.extend((talker, slot, local_type, sender or '', num) for slot, local_type, sender, num, _ in result)
+        new_state[table_name] = max(row[4] for row in result)
+    cursor.close()
+    return rows, new_state
+
+
+def scan_v3_shard(me_wxid) -> Callable:
+    """
+    v3所有聊天对象共用MSG表，增量依据为localId，消息类型编码为 SubType<<32 | Type（与MessageType一致）
+    @param me_wxid: 自己的wxid，IsSender=1的消息发送者
+    @return: 分库扫描函数
+    """
+
+    def scan(db, table_state: Dict[str, int]) -> Tuple[List[tuple], Dict[str, int]]:
+        db.create_function('wx_chatroom_sender', 1, chatroom_sender, deterministic=True)
+        cursor = db.cursor()
+        cursor.execute(
+            f'''
+            SELECT StrTalker, CreateTime/{SLOT} as slot, (SubType << 32) | Type as local_type,
+                CASE WHEN IsSender=1 THEN ?
+                     WHEN StrTalker LIKE '%@chatroom' THEN wx_chatroom_sender(BytesExtra)
+                     ELSE StrTalker END as sender,
+                count(*), max(localId)
+            FROM MSG
+            WHERE localId > ?
+            GROUP BY StrTalker, slot, local_type, sender
+            ''',
+            [me_wxid, table_state.get('MSG', 0)]
+        )
+        result = cursor.fetchall()
+        cursor.close()
+        if not result:
+            return [], {}
+        rows = [(talker, slot, local_type, sender or '', num) for talker, slot, local_type, sender, num, _ in result]
+        return rows, {'MSG': max(row[5] for row in result)}
+
+    return scan
+
+
+def time_condition(time_range) -> Tuple[str, list]:
+    """
+    时间范围 -> 时间段的查询条件（精度为15分钟）
+    @param time_range: (开始时间戳, 结束时间戳)
+    @return:
+    """
+    if not time_range:
+        return '', []
+    start_time, end_time = time_range
+    return ' AND slot >= ? AND slot <= ?', [int(start_time) // SLOT, int(end_time) // SLOT]
+
+
+class MessageStats:
+    """
+    - 每个分库一次分组查询生成统计数据，结果写入 db_dir/index/{index_file_name}
+    - 分库文件签名变化后只统计新增的消息（v4按local_id，v3按localId）
+    """
+
+    def __init__(self, index_file_name='stats.db'):
+        self.index_file_name = index_file_name
+        self.DB = None
+        self.open_flag = False
+        self.is_updated = False  # 本进程内是否已经同步过一次
+        self.lock = threading.Lock()
+
+    def init_database(self, db_dir=''):
+        try:
+            index_path = get_index_path(db_dir, self.index_file_name)
+            self.DB = sqlite3.connect(index_path, check_same_thread=False, timeout=30)
+            if self.DB.execute('PRAGMA user_version').fetchone()[0] != STATS_VERSION:
+                self.DB.executescript(f'''
+DROP TABLE IF EXISTS message_stats;
+DROP TABLE IF EXISTS table_state;
+DROP TABLE IF EXISTS shard_state;
+PRAGMA user_version = {STATS_VERSION};
+                ''')
+            self.DB.executescript('''
+CREATE TABLE IF NOT EXISTS message_stats(
+    talker TEXT,
+    slot INTEGER,
+    local_type INTEGER,
+    sender TEXT,
+    num INTEGER,
+    PRIMARY KEY (talker, slot, local_type, sender)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS message_stats_slot ON message_stats(slot);
+CREATE TABLE IF NOT EXISTS table_state(
+    shard TEXT,
+    table_name TEXT,
+    max_seq INTEGER,
+    PRIMARY KEY (shard, table_name)
+);
+CREATE TABLE IF NOT EXISTS shard_state(
+    shard TEXT PRIMARY KEY,
+    signature TEXT
+);
+            ''')
+            self.DB.commit()
+            self.open_flag = True
+        except (sqlite3.Error, OSError):
+            logger.error(f'统计数据初始化失败\n{traceback.format_exc()}')
+            self.open_flag = False
+        return self.open_flag
+
+    def update(self, shards: Iterable[Tuple[str, str, sqlite3.Connection]], scan_shard: Callable):
+        """
+        同步统计数据，只处理文件签名发生变化的分库
+        @param shards: [(分库文件名, 分库路径, 数据库连接)]
+        @param scan_shard: scan_shard(db, table_state) -> (统计行, 新的table_state)
+        @return: 新统计的消息条数
+        """
+        if not self.open_flag:
+            return 0
+        num = 0
+        with self.lock:
+            try:
+                cursor = self.DB.cursor()
+                cursor.execute('SELECT shard, signature FROM shard_state')
+                shard_state = dict(cursor.fetchall())
+                for shard, db_path, db in shards:
+                    signature = file_signature(db_path)
+                    if signature and shard_state.get(shard) == signature:
+                        continue
+                    cursor.execute('SELECT table_name, max_seq FROM table_state WHERE shard=?', [shard])
+                    rows, new_state = scan_shard(db, dict(cursor.fetchall()))
+                    cursor.executemany(
+                        '''
+                        INSERT INTO message_stats(talker, slot, local_type, sender, num) VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT(talker, slot, local_type, sender) DO UPDATE SET num = num + excluded.num
+                        ''',
+                        rows
+                    )
+                    cursor.executemany(
+                        'INSERT OR REPLACE INTO table_state(shard, table_name, max_seq) VALUES (?, ?, ?)',
+                        ((shard, table_name, max_seq) for table_name, max_seq in new_state.items())
+                    )
+                    cursor.execute(
+                        'INSERT OR REPLACE INTO shard_state(shard, signature) VALUES (?, ?)',
+                        [shard, signature]
+                    )
+                    num += sum(row[4] for row in rows)
+                self.DB.commit()
+                cursor.close()
+            except sqlite3.Error:
+                # 更新失败时不标记为已同步，下次get_stats时重试
+                logger.error(f'统计数据更新失败\n{traceback.format_exc()}')
+                self.DB.rollback()
+                return 0
+            self.is_updated = True
+        return num
+
+    def _query(self, sql, params) -> list:
+        if not self.open_flag:
+            return []
+        with self.lock:
+            cursor = self.DB.cursor()
+            cursor.execute(sql, params)
+            result = cursor.fetchall()
+            cursor.close()
+        return result
+
+    def _group_by_time(self, fmt, talker='', sender='', time_range=None, year_='all') -> List[Tuple[str, int]]:
+        conditions = '1=1'
+        params = []
+        if talker:
+            conditions += ' AND talker=?'
+            params.append(talker)
+        if sender:
+            conditions += ' AND sender=?'
+            params.append(sender)
+        time_sql, time_params = time_condition(time_range)
+        conditions += time_sql
+        params.extend(time_params)
+        if year_ and year_ != 'all':
+            conditions += f" AND strftime('%Y', slot*{SLOT}, 'unixepoch', 'localtime')=?"
+            params.append(str(year_))
+        sql = f'''
+            SELECT strftime('{fmt}', slot*{SLOT}, 'unixepoch', 'localtime') as bucket, sum(num)
+            FROM message_stats
+            WHERE {conditions}
+            GROUP BY bucket
+            ORDER BY bucket
+        '''
+        return self._query(sql, params)
+
+    def count_by_day(self, talker, time_range=None) -> List[Tuple[str, int]]:
+        return self._group_by_time('%Y-%m-%d', talker=talker, time_range=time_range)
+
+    def count_by_month(self, talker, time_range=None) -> List[Tuple[str, int]]:
+        return self._group_by_time('%Y-%m', talker=talker, time_range=time_range)
+
+    def count_by_hour(self, talker='', sender='', time_range=None, year_='all') -> List[Tuple[str, int]]:
+        return self._group_by_time('%H', talker=talker, sender=sender, time_range=time_range, year_=year_)
+
+    def _group_by_column(self, column, talker='', sender='', time_range=None) -> List[Tuple]:
+        conditions = '1=1'
+        params = []
+        if talker:
+            conditions += ' AND talker=?'
+            params.append(talker)
+        if sender:
+            conditions += ' AND sender=?'
+            params.append(sender)
+        time_sql, time_params = time_condition(time_range)
+        conditions += time_sql
+        params.extend(time_params)
+        sql = f'''
+            SELECT {column}, sum(num) as total
+            FROM message_stats
+            WHERE {conditions}
+            GROUP BY {column}
+            ORDER BY total DESC
+        '''
+        return self._query(sql, params)
+
+    def count_by_type(self, talker, time_range=None) -> List[Tuple[int, int]]:
+        return self._group_by_column('local_type', talker=talker, time_range=time_range)
+
+    def count_by_sender(self, talker, time_range=None) -> List[Tuple[str, int]]:
+        return self._group_by_column('sender', talker=talker, time_range=time_range)
+
+    def count(self, talker='', sender='', time_range=None) -> int:
+        conditions = '1=1'
+        params = []
+        if talker:
+            conditions += ' AND talker=?'
+            params.append(talker)
+        if sender:
+            conditions += ' AND sender=?'
+            params.append(sender)
+        time_sql, time_params = time_condition(time_range)
+        params.extend(time_params)
+        result = self._query(f'SELECT sum(num) FROM message_stats WHERE {conditions}{time_sql}', params)
+        return (result[0][0] or 0) if result else 0
+
+    def top_talkers(self, time_range=None, contain_chatroom=False, top_n=10) -> List[Tuple[str, int]]:
+        """
+        聊天最多的联系人
+        @param time_range:
+        @param contain_chatroom: 是否包含群聊
+        @param top_n:
+        @return: [(wxid, 消息数量)]
+        """
+        conditions = "talker != 'filehelper' AND talker NOT LIKE 'gh\\_%' ESCAPE '\\'"
+        if not contain_chatroom:
+            conditions += " AND talker NOT LIKE '%@chatroom'"
+        time_sql, params = time_condition(time_range)
+        sql = f'''
+            SELECT talker, sum(num) as total
+            FROM message_stats
+            WHERE {conditions}{time_sql}
+            GROUP BY talker
+            ORDER BY total DESC
+            LIMIT ?
+        '''
+        return self._query(sql, params + [top_n])
+
+    def close(self):
+        if self.open_flag:
+            self.open_flag = False
+            try:
+                self.DB.close()
+            except sqlite3.Error:
+                pass
+
+    def __del__(self):
+        self.close()
+
+
+if __name__ == '__main__':
+    pass
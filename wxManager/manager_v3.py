@@ -11,9 +11,11 @@
 import concurrent
 import os
 import traceback
-from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
-from typing import Tuple, List, Any
+from functools import partial
+from operator import itemgetter
+from typing import Tuple, List, Any, Iterator
 
 import xmltodict
 
@@ -24,7 +26,7 @@ from wxManager.db_v3.hard_link_image import HardLinkImage
 from wxManager.db_v3.hard_link_video import HardLinkVideo
 
 from wxManager.db_v3.misc import Misc
-from wxManager.db_v3.msg import Msg
+from wxManager.db_v3.msg import Msg, convert_to_timestamp
 from wxManager.db_v3.media_msg import MediaMsg
 from wxManager.db_v3.emotion import Emotion
 from wxManager.db_v3.open_im_contact import OpenIMContactDB
@@ -34,10 +36,17 @@ from wxManager.db_v3.public_msg import PublicMsg
 from wxManager.db_v3.micro_msg import MicroMsg
 from wxManager.db_v3.favorite import Favorite
 from wxManager.log import logger
+from wxManager.page_cache import MessagePageCache
+from wxManager.parse_pool import iter_batches, parse_in_pool, shutdown_parser_pools
+from wxManager.parser.reference import ReferenceResolver, invalid_message
+from wxManager.contact_directory import ContactDirectory
+from wxManager.index.contact_snapshot import ContactSnapshot
+from wxManager.index.parse_cache import ParseCache, UNCACHED_TYPES
 from wxManager.model.contact import Contact, Me, ContactType, Person
+from wxManager.model.message import LazyMessage, Message
+from wxManager.model.query import MessageQuery
 from wxManager.parser.file_parser import get_image_type
-from wxManager.parser.util.protocbuf.roomdata_pb2 import ChatRoomData
-from wxManager.parser.wechat_v3 import FACTORY_REGISTRY, parser_sub_type, Singleton
+from wxManager.parser.wechat_v3 import FACTORY_REGISTRY, PARSED_TYPES, parser_sub_type, Singleton
 
 type_name_dict = {
     (1, 0): MessageType.Text,
@@ -80,6 +89,17 @@ type_name_dict = {
 }
 
 
+def get_type_pairs(source_types):
+    """
+    MessageType -> 数据库中的(Type, SubType)
+    @param source_types: 原始消息类型集合，None表示全部
+    @return:
+    """
+    if source_types is None:
+        return None
+    return {pair for pair, type_ in type_name_dict.items() if type_ in source_types}
+
+
 def decodeExtraBuf(extra_buf_content: bytes):
     if not extra_buf_content:
         return {
@@ -139,9 +159,15 @@ def decodeExtraBuf(extra_buf_content: bytes):
         }
 
 
-def parser_messages(messages, username, db_dir=''):
-    context = DataBaseV3()
-    context.init_database(db_dir)
+def parser_messages(messages, username, db_dir='', context=None, deferred=False, lazy=False):
+    """
+    @param deferred: 整批解析完后再批量处理引用消息和Rec目录（ReferenceResolver），适合一次解析大量消息
+    @param lazy: 返回LazyMessage，只需要时间、类型、发送者等字段时不解析消息内容
+    """
+    if context is None:
+        # 子进程中复用同一个数据库对象
+        from wxManager import database_registry
+        context = database_registry.get(db_dir, 3)
     if username.endswith('@chatroom'):
         contacts = context.get_chatroom_members(username)
     else:
@@ -151,21 +177,90 @@ def parser_messages(messages, username, db_dir=''):
         }
     # FACTORY_REGISTRY[-1].set_contacts(contacts)
     Singleton.set_contacts(contacts)
+    if lazy:
+        for message in messages:
+            yield _lazy_message(message, username, context)
+        return
+    if deferred:
+        parse_cache = getattr(context, 'parse_cache', None)
+        hits, misses = {}, {}
+        if parse_cache is not None:
+            if not isinstance(messages, list):
+                messages = list(messages)
+            hits, misses = parse_cache.lookup(
+                username, messages, lambda message, cutoff: _cacheable_row(message, cutoff, username)
+            )
+        resolver = ReferenceResolver()
+        with Singleton.defer_references(resolver):
+            result = [
+                _restore_message(*hits[index], username, context) if index in hits
+                else _create_message(message, username, context)
+                for index, message in enumerate(messages)
+            ]
+        resolver.resolve(result, username, context, Singleton.messages)
+        if misses:
+            parse_cache.store(username, misses, result)
+        yield from result
+        return
     for message in messages:
-        type_ = message[2]
-        sub_type = parser_sub_type(message[7]) if username.endswith('@openim') else message[3]
-        msg_type = type_name_dict.get((type_, sub_type))
-        if msg_type not in FACTORY_REGISTRY:
-            msg_type = -1
-        yield FACTORY_REGISTRY[msg_type].create(message, username, context)
+        yield _create_message(message, username, context)
+
+
+def _message_type(message, username):
+    type_ = message[2]
+    sub_type = parser_sub_type(message[7]) if username.endswith('@openim') else message[3]
+    return type_name_dict.get((type_, sub_type))
+
+
+def _create_message(message, username, context):
+    msg_type = _message_type(message, username)
+    if msg_type not in FACTORY_REGISTRY:
+        msg_type = -1
+    return FACTORY_REGISTRY[msg_type].create(message, username, context)
 
 
-def _process_messages_batch(messages_batch, username, db_dir) -> List:
-    """Helper function to process a batch of messages."""
-    processed = []
-    for message in parser_messages(messages_batch, username, db_dir):
-        processed.append(message)
-    return processed
+def _cacheable_row(message, cutoff, username):
+    # 一天以前、解析比较耗时的消息使用解析缓存
+    if message[5] >= cutoff:
+        return False
+    msg_type = _message_type(message, username)
+    return msg_type in FACTORY_REGISTRY and msg_type not in UNCACHED_TYPES
+
+
+def _restore_message(message, quote_server_id, username, context):
+    # 解析缓存中不保存联系人和引用的消息，按当前数据重新设置
+    contact = Singleton.get_contact(message.sender_id, context)
+    message.display_name = contact.remark
+    message.avatar_src = contact.small_head_img_url
+    if quote_server_id is not None:
+        if Singleton.resolver is not None:
+            message.quote_message = invalid_message(username)
+            Singleton.resolver.add_quote(message, quote_server_id)
+        else:
+            message.quote_message = Singleton.get_message_by_server_id(quote_server_id, username, context)
+    Singleton.add_message(message)
+    return message
+
+
+def _lazy_message(message, username, context) -> LazyMessage:
+    # 群聊消息的发送者需要解析BytesExtra，不作为直接读取的字段
+    msg_type = _message_type(message, username)
+    fields = {}
+    if not username.endswith('@chatroom'):
+        fields['sender_id'] = Me().wxid if message[4] else username
+    return LazyMessage(
+        partial(_create_message, message, username, context),
+        local_id=message[0],
+        server_id=message[9],
+        sort_seq=message[5],
+        timestamp=message[5],
+        str_time=message[8],
+        type=PARSED_TYPES.get(msg_type, MessageType.Unknown),
+        talker_id=username,
+        is_sender=message[4],
+        status=message[6],
+        **fields
+    )
 
 
 class DataBaseV3(DataBaseInterface):
@@ -188,29 +283,50 @@ class DataBaseV3(DataBaseInterface):
         self.open_contact_db = OpenIMContactDB('OpenIMContact.db')
         self.open_media_db = OpenIMMediaDB('OpenIMMedia.db')
         self.open_msg_db = OpenIMMsgDB('OpenIMMsg.db')
+        # 聊天界面分页缓存
+        self.page_cache = MessagePageCache(self._get_messages_by_num)
+        # 联系人目录，第一次用到联系人时一次性加载
+        self.contact_directory = ContactDirectory(
+            self.micro_msg_db.get_all_contacts,
+            self.micro_msg_db.get_chatroom_room_data,
+            self.micro_msg_db.get_label_map,
+            self.create_contact,
+            snapshot=ContactSnapshot(self.micro_msg_db)
+        )
+        # 消息解析缓存
+        self.parse_cache = ParseCache()
         # self.sns_db = Sns()
 
         # self.audio_to_text = Audio2TextDB()
         # self.public_msg_db = PublicMsg()
         # self.favorite_db = Favorite()
 
-    def init_database(self, db_dir=''):
+    def databases(self) -> dict:
+        return {
+            'misc': self.misc_db,
+            'msg': self.msg_db,
+            'public_msg': self.public_msg_db,
+            'micro_msg': self.micro_msg_db,
+            'hard_link_image': self.hard_link_image_db,
+            'hard_link_file': self.hard_link_file_db,
+            'hard_link_video': self.hard_link_video_db,
+            'emotion': self.emotion_db,
+            'media_msg': self.media_msg_db,
+            'open_contact': self.open_contact_db,
+            'open_media': self.open_media_db,
+            'open_msg': self.open_msg_db,
+        }
+
+    def init_database(self, db_dir='', warm_up=None):
         # print('初始化数据库', db_dir)
         Me().load_from_json(os.path.join(db_dir, 'info.json'))  # 加载自己的信息
         flag = True
         self.db_dir = db_dir
-        flag &= self.misc_db.init_database(db_dir)
-        flag &= self.msg_db.init_database(db_dir)
-        flag &= self.public_msg_db.init_database(db_dir)
-        flag &= self.micro_msg_db.init_database(db_dir)
-        flag &= self.hard_link_image_db.init_database(db_dir)
-        flag &= self.hard_link_file_db.init_database(db_dir)
-        flag &= self.hard_link_video_db.init_database(db_dir)
-        flag &= self.emotion_db.init_database(db_dir)
-        flag &= self.media_msg_db.init_database(db_dir)
-        flag &= self.open_contact_db.init_database(db_dir)
-        flag &= self.open_media_db.init_database(db_dir)
-        flag &= self.open_msg_db.init_database(db_dir)
+        for db in self.databases().values():
+            flag &= db.init_database(db_dir)
+        self.parse_cache.init_database(db_dir, f'{Me().wxid}-{Me().wx_dir}')
+        if warm_up:
+            self.warm_up(warm_up)
         return flag
         # self.sns_db.init_database(db_dir)
 
@@ -218,7 +334,21 @@ class DataBaseV3(DataBaseInterface):
         # self.public_msg_db.init_database(db_dir)
         # self.favorite_db.init_database(db_dir)
 
+    def warm_up(self, databases=None):
+        """
+        预先打开数据库连接
+        @param databases: True/None表示全部，或者数据库名称列表，例如 ['micro_msg', 'msg']
+        @return:
+        """
+        for name, db in self.databases().items():
+            if databases is None or databases is True or name in databases:
+                db.warm_up()
+
     def close(self):
+        if self.db_dir:
+            shutdown_parser_pools(self.db_dir, 3)
+        self.page_cache.close()
+        self.parse_cache.close()
         self.misc_db.close()
         self.msg_db.close()
         self.public_msg_db.close()
@@ -235,6 +365,22 @@ class DataBaseV3(DataBaseInterface):
         # self.audio_to_text.close()
         # self.public_msg_db.close()
 
+    def build_message_indexes(self, max_workers=None, analyze=True) -> dict:
+        """
+        为消息分库建立时间、类型、发送者索引（会修改解密后的数据库文件）
+        @param max_workers: 并行线程数
+        @param analyze: 是否执行ANALYZE
+        @return: {分库文件名: {"indexes": [...], "elapsed": 耗时}}
+        """
+        result = self.msg_db.build_indexes(max_workers, analyze)
+        self._update_registry_signature()
+        return result
+
+    def _update_registry_signature(self):
+        # 自己修改了数据库文件（建索引、改备注、合并等），不是外部更新，记录新的签名，共享对象不需要重新加载
+        from wxManager import database_registry
+        database_registry.update_signature(self)
+
     def get_session(self):
         """
         获取聊天会话窗口，在聊天界面显示
@@ -242,11 +388,23 @@ class DataBaseV3(DataBaseInterface):
         """
         return self.micro_msg_db.get_session()
 
+    def _parse_serial(self, username):
+        # 在当前进程解析，消息不多或者进程池不可用时使用
+        return lambda rows: list(parser_messages(rows, username, self.db_dir, context=self, deferred=True))
+
     def get_messages(
             self,
             username_: str,
             time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+            query: MessageQuery = None,
     ):
+        """
+        获取聊天记录
+        @param username_:
+        @param time_range:
+        @param query: 查询条件，类型、时间范围会在SQL中过滤，群成员在解析后筛选（发送者保存在BytesExtra里）
+        @return:
+        """
         # todo 改成yield进行操作，多进程处理加快速度
         import time
         st = time.time()
@@ -274,46 +432,77 @@ class DataBaseV3(DataBaseInterface):
         #     for message in self.parser_messages(messages, username_):
         #         res.append(message)
 
-        def split_list(lst, n):
-            k, m = divmod(len(lst), n)
-            return [lst[i * k + min(i, m):(i + 1) * k + min(i + 1, m)] for i in range(n)]
-
+        if query and not time_range:
+            time_range = query.time_range
         # # # Step 1: Retrieve raw message batches
         if username_.startswith('gh_'):
             messages = self.public_msg_db.get_messages_by_username(username_, time_range)
         elif username_.endswith('@openim'):
             messages = self.open_msg_db.get_messages_by_username(username_, time_range)
+        elif query:
+            messages = self.msg_db.get_messages_by_username(
+                username_, time_range,
+                type_pairs=get_type_pairs(query.source_types()),
+                need_payload=query.need_payload
+            )
         else:
             messages = self.msg_db.get_messages_by_username(username_, time_range)
 
-        if len(messages) < 20000:
-            for message in parser_messages(messages, username_, self.db_dir):
-                res.append(message)
+        if query and query.lazy:
+            # 只读取直接字段，不需要多进程解析
+            res = list(parser_messages(messages, username_, self.db_dir, context=self, lazy=True))
         else:
-            raw_message_batches = split_list(messages, len(messages) // 10000 + 1)
-            #
-            # # Step 2: Use multiprocessing to process the message batches
-            # res = []
-            # for batch in raw_message_batches:
-            #     print(len(batch))
-
-            with ProcessPoolExecutor(max_workers=min(len(raw_message_batches), 16)) as executor:
-                # Submit tasks
-                future_to_batch = {
-                    executor.submit(_process_messages_batch, batch, username_, self.db_dir): batch
-                    for batch in raw_message_batches
-                }
-
-                # Collect results
-                for future in future_to_batch.keys():
-                    res.extend(future.result())
+            # 消息多时交给常驻的解析进程池
+            res = parse_in_pool(messages, username_, self.db_dir, 3, self._parse_serial(username_))
 
         et = time.time()
         logger.error(f'获取聊天记录完成：{et}')
         logger.error(f'获取聊天记录耗时：{et - st:.2f}s/{len(res)}条消息')
+        if query:
+            res = [message for message in res if query.match(message)]
         res.sort()
         return res
 
+    def get_messages_iter(
+            self,
+            username_: str,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+            batch_size: int = 1000,
+            query: MessageQuery = None,
+    ) -> Iterator[Message]:
+        """
+        按时间顺序逐批读取、解析聊天记录，内存占用只与batch_size有关，适合导出大群
+        @param username_:
+        @param time_range:
+        @param batch_size: 每批读取和解析的消息数量
+        @param query: 查询条件，同get_messages
+        @return: 消息迭代器
+        """
+        if query and not time_range:
+            time_range = query.time_range
+        if username_.startswith('gh_') or username_.endswith('@openim'):
+            # 公众号、企业微信消息不多，整体读取后排序
+            db = self.public_msg_db if username_.startswith('gh_') else self.open_msg_db
+            rows = iter(sorted(db.get_messages_by_username(username_, time_range), key=itemgetter(5)))
+        elif query:
+            rows = self.msg_db.iter_messages_by_username(
+                username_, time_range,
+                type_pairs=get_type_pairs(query.source_types()),
+                need_payload=query.need_payload,
+                batch_size=batch_size
+            )
+        else:
+            rows = self.msg_db.iter_messages_by_username(username_, time_range, batch_size=batch_size)
+        lazy = bool(query and query.lazy)
+        for rows_batch in iter_batches(rows, batch_size):
+            if lazy:
+                messages = parser_messages(rows_batch, username_, self.db_dir, context=self, lazy=True)
+            else:
+                messages = parse_in_pool(rows_batch, username_, self.db_dir, 3, self._parse_serial(username_))
+            for message in messages:
+                if query is None or query.match(message):
+                    yield message
+
     def get_messages_by_num(self, username, start_sort_seq, msg_num=20):
         """
         获取小于start_sort_seq的msg_num个消息
@@ -322,6 +511,9 @@ class DataBaseV3(DataBaseInterface):
         @param msg_num:
         @return: messages, 最后一条消息的start_sort_seq
         """
+        return self.page_cache.get(username, start_sort_seq, msg_num)
+
+    def _get_messages_by_num(self, username, start_sort_seq, msg_num=20):
         if username.startswith('gh'):
             messages = self.public_msg_db.get_messages_by_num(username, start_sort_seq, msg_num)
         elif username.endswith('@openim'):
@@ -330,7 +522,7 @@ class DataBaseV3(DataBaseInterface):
             messages = self.msg_db.get_messages_by_num(username, start_sort_seq, msg_num)
         result = []
         for messages_ in messages:
-            for message in parser_messages(messages_, username, self.db_dir):
+            for message in parser_messages(messages_, username, self.db_dir, context=self, deferred=True):
                 result.append(message)
         result.sort(reverse=True)
         res = result[:msg_num]
@@ -338,34 +530,239 @@ class DataBaseV3(DataBaseInterface):
 
     def get_message_by_server_id(self, username, server_id):
         """
-        获取小于start_sort_seq的msg_num个消息
+        获取server_id对应的消息
         @param username:
         @param server_id:
-        @return: messages, 最后一条消息的start_sort_seq
+        @return: Message
         """
         message = self.msg_db.get_message_by_server_id(username, server_id)
         if message:
-            messages_iter = parser_messages([message], username, self.db_dir)
+            messages_iter = parser_messages([message], username, self.db_dir, context=self)
             return next(messages_iter)
         return None
 
+    def get_messages_by_server_ids(self, username, server_ids):
+        """
+        批量获取server_id对应的消息
+        @param username:
+        @param server_ids:
+        @return: {server_id: Message}
+        """
+        messages = self.msg_db.get_messages_by_server_ids(username, server_ids)
+        if not messages:
+            return {}
+        return {
+            message.server_id: message
+            for message in parser_messages(list(messages.values()), username, self.db_dir, context=self)
+        }
+
     def get_messages_all(self, time_range=None):
         return self.msg_db.get_messages_all(time_range)
 
     def get_messages_calendar(self, username_):
         return self.msg_db.get_messages_calendar(username_)
 
+    def build_search_index(self, max_workers=None) -> int:
+        """
+        建立/增量更新全文检索索引
+        @param max_workers: 并行提取文字的进程数
+        @return: 新增的文档数量
+        """
+        return self.msg_db.update_search_index(max_workers)
+
+    def _parse_search_result(self, hits) -> List:
+        # 同一个聊天对象的消息一起解析，再按检索结果的顺序返回
+        groups = {}
+        for index, (talker, message) in enumerate(hits):
+            groups.setdefault(talker, []).append((index, message))
+        result = [None] * len(hits)
+        for talker, items in groups.items():
+            messages = parser_messages([message for _, message in items], talker, self.db_dir, context=self)
+            for (index, _), message in zip(items, messages):
+                result[index] = message
+        return [message for message in result if message]
+
+    def search_messages(
+            self,
+            query: str,
+            talker: str = None,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+            page=1,
+            page_size=20
+    ) -> List:
+        """
+        全文检索聊天记录（文本、链接标题、文件名、引用内容），按相关度排序
+        @param query: 关键字
+        @param talker: 只检索某个聊天对象
+        @param time_range:
+        @param page: 页码，从1开始
+        @param page_size:
+        @return: List[Message]
+        """
+        hits = self.msg_db.search_messages(query, talker, time_range, page=page, page_size=page_size)
+        return self._parse_search_result(hits)
+
+    def get_messages_by_keyword(self, username_, keyword, num=5, max_len=10, time_range=None, year_='all'):
+        """
+        包含关键字的文本消息，按时间倒序
+        @param username_:
+        @param keyword:
+        @param num: 最多返回的消息数量
+        @param max_len: 消息的最大长度，过滤掉长消息
+        @param time_range:
+        @param year_: 只检索某一年
+        @return: List[Message]
+        """
+        if year_ and year_ != 'all':
+            time_range = (f'{year_}-01-01 00:00:00', f'{year_}-12-31 23:59:59')
+        result = []
+        page = 1
+        page_size = max(num, 1) * 4
+        while len(result) < num:
+            hits = self.msg_db.search_messages(
+                keyword, username_, time_range, local_types=[MessageType.Text],
+                page=page, page_size=page_size, order_by_time=True
+            )
+            for message in self._parse_search_result(hits):
+                if len(message.content) <= max_len:
+                    result.append(message)
+            if len(hits) < page_size:
+                break
+            page += 1
+        return result[:num]
+
+    def get_messages_by_days(
+            self,
+            username_,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+    ):
+        """
+        每天的消息数量
+        @param username_:
+        @param time_range:
+        @return: [('2024-12-01', 消息数量)]
+        """
+        return self.msg_db.get_stats().count_by_day(username_, convert_to_timestamp(time_range) if time_range else None)
+
+    def get_messages_by_month(
+            self,
+            username_,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+    ):
+        """
+        每月的消息数量
+        @param username_:
+        @param time_range:
+        @return: [('2024-12', 消息数量)]
+        """
+        return self.msg_db.get_stats().count_by_month(username_, convert_to_timestamp(time_range) if time_range else None)
+
+    def get_messages_by_hour(self, username_, time_range=None, year_='all'):
+        """
+        一天中每个小时的消息数量
+        @param username_:
+        @param time_range:
+        @param year_: 只统计某一年
+        @return: [('00', 消息数量)]
+        """
+        return self.msg_db.get_stats().count_by_hour(
+            username_, time_range=convert_to_timestamp(time_range) if time_range else None, year_=year_
+        )
+
+    def get_messages_number(
+            self,
+            username_,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+    ) -> int:
+        return self.msg_db.get_stats().count(username_, time_range=convert_to_timestamp(time_range) if time_range else None)
+
+    def get_messages_count(self, username_, query: MessageQuery = None) -> int:
+        query = query or MessageQuery()
+        if username_.startswith('gh_') or username_.endswith('@openim'):
+            # 公众号、企业微信消息不多，直接按解析后的类型计数
+            lazy_query = MessageQuery(types=query.types, senders=query.senders, time_range=query.time_range, lazy=True)
+            return sum(1 for _ in self.get_messages_iter(username_, query=lazy_query))
+        # 群成员在BytesExtra中，不能在SQL里筛选，按成员筛选时结果偏多
+        return self.msg_db.count_messages_by_username(
+            username_, query.time_range, type_pairs=get_type_pairs(query.source_types())
+        )
+
+    def get_messages_number_by_type(
+            self,
+            username_,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+    ) -> list:
+        """
+        每种消息类型的数量
+        @param username_:
+        @param time_range:
+        @return: [(MessageType, 消息数量)]
+        """
+        result = self.msg_db.get_stats().count_by_type(username_, convert_to_timestamp(time_range) if time_range else None)
+        res = {}
+        for local_type, num in result:
+            # SubType << 32 | Type -> 解析后的Message.type，与v4一致
+            type_ = PARSED_TYPES.get(type_name_dict.get((local_type & 0xFFFFFFFF, local_type >> 32)), MessageType.Unknown)
+            res[type_] = res.get(type_, 0) + num
+        return sorted(res.items(), key=lambda x: x[1], reverse=True)
+
+    def get_messages_number_by_sender(
+            self,
+            username_,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+    ) -> list:
+        """
+        每个发送者的消息数量（群聊发言排行）
+        @param username_:
+        @param time_range:
+        @return: [(wxid, 消息数量)]
+        """
+        return self.msg_db.get_stats().count_by_sender(username_, convert_to_timestamp(time_range) if time_range else None)
+
+    def get_chatted_top_contacts(
+            self,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+            contain_chatroom=False,
+            top_n=10
+    ) -> list:
+        """
+        聊天消息最多的联系人
+        @param time_range:
+        @param contain_chatroom: 是否包含群聊
+        @param top_n:
+        @return: [(wxid, 消息数量)]
+        """
+        return self.msg_db.get_stats().top_talkers(
+            convert_to_timestamp(time_range) if time_range else None, contain_chatroom, top_n
+        )
+
+    def get_send_messages_number_sum(
+            self,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+    ) -> int:
+        return self.msg_db.get_stats().count(
+            sender=Me().wxid, time_range=convert_to_timestamp(time_range) if time_range else None
+        )
+
+    def get_send_messages_number_by_hour(
+            self,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+    ) -> list:
+        """
+        自己发送的消息在一天中每个小时的数量
+        @param time_range:
+        @return: [('00', 消息数量)]
+        """
+        return self.msg_db.get_stats().count_by_hour(
+            sender=Me().wxid, time_range=convert_to_timestamp(time_range) if time_range else None
+        )
+
     def get_messages_by_type(
             self,
             username_,
             type_: MessageType,
             time_range: Tuple[int | float | str | date, int | float | str | date] = None,
     ):
-        def split_list(lst, n):
-            k, m = divmod(len(lst), n)
-            return [lst[i * k + min(i, m):(i + 1) * k + min(i + 1, m)] for i in range(n)]
-
-        res = []
         # # # Step 1: Retrieve raw message batches
         if username_.startswith('gh_'):
             messages = self.public_msg_db.get_messages_by_type(username_, type_, time_range)
@@ -374,20 +771,7 @@ class DataBaseV3(DataBaseInterface):
         else:
             messages = self.msg_db.get_messages_by_type(username_, type_, time_range)
 
-        if len(messages) < 20000:
-            for message in parser_messages(messages, username_, self.db_dir):
-                res.append(message)
-        else:
-            raw_message_batches = split_list(messages, len(messages) // 10000 + 1)
-            with ProcessPoolExecutor(max_workers=min(len(raw_message_batches), 16)) as executor:
-                # Submit tasks
-                future_to_batch = {
-                    executor.submit(_process_messages_batch, batch, username_, self.db_dir): batch
-                    for batch in raw_message_batches
-                }
-                # Collect results
-                for future in future_to_batch.keys():
-                    res.extend(future.result())
+        res = parse_in_pool(messages, username_, self.db_dir, 3, self._parse_serial(username_))
         res.sort()
         return res
 
@@ -483,7 +867,7 @@ class DataBaseV3(DataBaseInterface):
             remark = nickname
         gender = '未知'
         signature = ''
-        label_list = contact_info_list[10].split(',') if contact_info_list[10] else []
+        label_list = self.contact_directory.get_labels(contact_info_list[10]).split(',') if contact_info_list[10] else []
         region = ('', '', '')
         if detail:
             gender_code = detail.get('gender', 0)
@@ -563,11 +947,8 @@ class DataBaseV3(DataBaseInterface):
         return contact
 
     def get_contacts(self) -> List[Person]:
-        contacts = []
-        contact_lists = self.micro_msg_db.get_contact()
-        for contact_info_list in contact_lists:
-            contact = self.create_contact(contact_info_list)
-            contacts.append(contact)
+        # 与MicroMsg.get_contact一致，不返回Type为0和4的联系人
+        contacts = self.contact_directory.get_contacts(lambda row: row[2] != 4 and row[2] != 0)
 
         contact_lists = self.open_contact_db.get_contacts()
         for contact_info_list in contact_lists:
@@ -579,12 +960,18 @@ class DataBaseV3(DataBaseInterface):
         if username in self.contacts_map:
             self.contacts_map[username].remark = remark
         if username.endswith('@openim'):
-            return self.open_contact_db.set_remark(username, remark)
+            result = self.open_contact_db.set_remark(username, remark)
         else:
-            return self.micro_msg_db.set_remark(username, remark)
+            result = self.micro_msg_db.set_remark(username, remark)
+            self.contact_directory.invalidate()
+            self.chatroom_members_map.clear()
+        self._update_registry_signature()
+        return result
 
     def set_avatar_buffer(self, username, avatar_path):
-        return self.misc_db.set_avatar_buffer(username, avatar_path)
+        result = self.misc_db.set_avatar_buffer(username, avatar_path)
+        self._update_registry_signature()
+        return result
 
     def get_contact_by_username(self, wxid: str) -> Contact:
         if wxid.endswith('@openim'):
@@ -598,10 +985,8 @@ class DataBaseV3(DataBaseInterface):
                     remark=wxid
                 )
         else:
-            contact_info_list = self.micro_msg_db.get_contact_by_username(wxid)
-            if contact_info_list:
-                contact = self.create_contact(contact_info_list)
-            else:
+            contact = self.contact_directory.get_contact(wxid)
+            if contact is None:
                 contact = Contact(
                     wxid=wxid,
                     nickname=wxid,
@@ -618,18 +1003,15 @@ class DataBaseV3(DataBaseInterface):
         if chatroom_name in self.chatroom_members_map:
             return self.chatroom_members_map[chatroom_name]
         result = {}
-        chatroom = self.micro_msg_db.get_chatroom_info(chatroom_name)
-        if chatroom is None:
+        members = self.contact_directory.get_chatroom_members(chatroom_name)
+        if members is None:
             return result
-        # 解析RoomData数据
-        parsechatroom = ChatRoomData()
-        parsechatroom.ParseFromString(chatroom[1])
         # 群成员数据放入字典存储
-        for mem in parsechatroom.members:
-            contact = self.get_contact_by_username(mem.wxID)
+        for wxid, display_name in members:
+            contact = self.get_contact_by_username(wxid)
             if contact:
-                if mem.displayName:
-                    contact.remark = mem.displayName
+                if display_name:
+                    contact.remark = display_name
                 result[contact.wxid] = contact
         self.chatroom_members_map[chatroom_name] = result
         return result
@@ -640,22 +1022,19 @@ class DataBaseV3(DataBaseInterface):
         :param wxid:
         :return:
         """
-        chatroom = self.micro_msg_db.get_chatroom_info(wxid)
+        members = self.contact_directory.get_chatroom_members(wxid)
 
-        if chatroom is None:
+        if members is None:
             return ''
-        # 解析RoomData数据
-        parsechatroom = ChatRoomData()
-        parsechatroom.ParseFromString(chatroom[1])
         chatroom_name = ''
         # 群成员数据放入字典存储
-        for mem in parsechatroom.members[:5]:
-            if mem.wxID == Me().wxid:
+        for member_wxid, display_name in members[:5]:
+            if member_wxid == Me().wxid:
                 continue
-            if mem.displayName:
-                chatroom_name += f'{mem.displayName}、'
+            if display_name:
+                chatroom_name += f'{display_name}、'
             else:
-                contact = self.get_contact_by_username(mem.wxID)
+                contact = self.get_contact_by_username(member_wxid)
                 chatroom_name += f'{contact.remark}、'
         return chatroom_name.rstrip('、')
 
@@ -698,3 +1077,11 @@ class DataBaseV3(DataBaseInterface):
                     print(f"成功合并数据库: {path}")
                 except Exception as e:
                     print(f"合并 {path} 失败: {e}")
+        self.page_cache.invalidate()
+        self.parse_cache.invalidate()
+        self.contact_directory.invalidate()
+        self.chatroom_members_map.clear()
+        # 解析进程中打开的数据库已经过时
+        shutdown_parser_pools(self.db_dir, 3)
+        # 上面已经清除了缓存，不需要再重新加载整个数据库对象
+        self._update_registry_signature()
@@ -10,10 +10,12 @@
 """
 import concurrent
 import os
-from concurrent.futures import ProcessPoolExecutor, as_completed, ThreadPoolExecutor
+from concurrent.futures import as_completed, ThreadPoolExecutor
 from datetime import date, datetime
+from functools import partial
 from multiprocessing import Pool, cpu_count
-from typing import Tuple, List, Any
+from operator import itemgetter
+from typing import Tuple, List, Any, Iterator
 
 import zstandard as zstd
 
@@ -22,25 +24,37 @@ from wxManager.db_v4.biz_message import BizMessageDB
 from wxManager.db_v4.emotion import EmotionDB
 from wxManager.db_v4.media import MediaDB
 from wxManager.db_v4 import ContactDB, HeadImageDB, SessionDB, MessageDB, HardLinkDB
+from wxManager.db_v4.message import convert_to_timestamp
 from wxManager.db_main import DataBaseInterface, Context
 from wxManager.model.contact import Contact, ContactType, Person
-from wxManager.model import Me
-from wxManager.parser.util.protocbuf.roomdata_pb2 import ChatRoomData
-from wxManager.parser.wechat_v4 import FACTORY_REGISTRY, Singleton
+from wxManager.model import Me, Message, MessageQuery
+from wxManager.model.message import LazyMessage
+from wxManager.parser.wechat_v4 import FACTORY_REGISTRY, PARSED_TYPES, Singleton
 from wxManager.log import logger
+from wxManager.media_resolver import invalidate_media_trees
+from wxManager.page_cache import MessagePageCache
+from wxManager.parse_pool import iter_batches, parse_in_pool, shutdown_parser_pools
+from wxManager.parser.reference import ReferenceResolver, invalid_message
+from wxManager.contact_directory import ContactDirectory
+from wxManager.index.contact_snapshot import ContactSnapshot
+from wxManager.index.parse_cache import ParseCache, UNCACHED_TYPES
 from wxManager.parser.util.protocbuf import contact_pb2
-from google.protobuf.json_format import MessageToDict
+from wxManager.parser import zstd_decompress
 
 
 def decompress(data):
-    dctx = zstd.ZstdDecompressor()  # 创建解压对象
-    x = dctx.decompress(data)
-    return x.decode('utf-8')
-
-
-def parser_messages(messages, username, db_dir=''):
-    context = DataBaseV4()
-    context.init_database(db_dir)
+    return zstd_decompress.decompress(data).decode('utf-8')
+
+
+def parser_messages(messages, username, db_dir='', context=None, deferred=False, lazy=False):
+    """
+    @param deferred: 整批解析完后再批量处理引用消息和Rec目录（ReferenceResolver），适合一次解析大量消息
+    @param lazy: 返回LazyMessage，只需要时间、类型、发送者等字段时不解析消息内容
+    """
+    if context is None:
+        # 子进程中复用同一个数据库对象
+        from wxManager import database_registry
+        context = database_registry.get(db_dir, 4)
     if username.endswith('@chatroom'):
         contacts = context.get_chatroom_members(username)
     else:
@@ -50,20 +64,81 @@ def parser_messages(messages, username, db_dir=''):
         }
     # FACTORY_REGISTRY[-1].set_contacts(contacts) # 不知道为什么用对象修改类属性每个实例对象的contacts不一样
     Singleton.set_contacts(contacts)
-
-    for message in messages:
-        type_ = message[2]
-        if type_ not in FACTORY_REGISTRY:
-            type_ = -1
-        yield FACTORY_REGISTRY[type_].create(message, username, context)
-
-
-def _process_messages_batch(messages_batch, username, db_dir) -> List:
-    """Helper function to process a batch of messages."""
-    processed = []
-    for message in parser_messages(messages_batch, username, db_dir):
-        processed.append(message)
-    return processed
+    if lazy:
+        for message in messages:
+            yield _lazy_message(message, username, context)
+        return
+    if not isinstance(messages, list):
+        messages = list(messages)
+    # 整页消息内容一次解压，解析完后释放
+    with zstd_decompress.prefetch_batch([message[12] for message in messages]):
+        if not deferred:
+            for message in messages:
+                yield _create_message(message, username, context)
+            return
+        result = _parse_deferred(messages, username, context)
+    yield from result
+
+
+def _parse_deferred(messages, username, context):
+    parse_cache = getattr(context, 'parse_cache', None)
+    hits, misses = {}, {}
+    if parse_cache is not None:
+        hits, misses = parse_cache.lookup(username, messages, _cacheable_row)
+    resolver = ReferenceResolver()
+    with Singleton.defer_references(resolver):
+        result = [
+            _restore_message(*hits[index], username, context) if index in hits
+            else _create_message(message, username, context)
+            for index, message in enumerate(messages)
+        ]
+    resolver.resolve(result, username, context, Singleton.messages)
+    if misses:
+        parse_cache.store(username, misses, result)
+    return result
+
+
+def _create_message(message, username, context):
+    type_ = message[2]
+    if type_ not in FACTORY_REGISTRY:
+        type_ = -1
+    return FACTORY_REGISTRY[type_].create(message, username, context)
+
+
+def _cacheable_row(message, cutoff):
+    # 一天以前、解析比较耗时的消息使用解析缓存
+    return message[5] < cutoff and message[2] in FACTORY_REGISTRY and message[2] not in UNCACHED_TYPES
+
+
+def _restore_message(message, quote_server_id, username, context):
+    # 解析缓存中不保存联系人和引用的消息，按当前数据重新设置
+    contact = Singleton.get_contact(message.sender_id, context)
+    message.display_name = contact.remark
+    message.avatar_src = contact.small_head_img_url
+    if quote_server_id is not None:
+        if Singleton.resolver is not None:
+            message.quote_message = invalid_message(username)
+            Singleton.resolver.add_quote(message, quote_server_id)
+        else:
+            message.quote_message = Singleton.get_message_by_server_id(quote_server_id, username, context)
+    Singleton.add_message(message)
+    return message
+
+
+def _lazy_message(message, username, context) -> LazyMessage:
+    return LazyMessage(
+        partial(_create_message, message, username, context),
+        local_id=message[0],
+        server_id=message[1],
+        sort_seq=message[3],
+        timestamp=message[5],
+        str_time=message[6],
+        type=PARSED_TYPES.get(message[2], message[2]),
+        talker_id=username,
+        is_sender=message[4] == Me().wxid,
+        sender_id=message[4],
+        status=message[7],
+    )
 
 
 class DataBaseV4(DataBaseInterface):
@@ -82,27 +157,77 @@ class DataBaseV4(DataBaseInterface):
         self.media_db = MediaDB('message/media_0.db', is_series=True)
         self.hardlink_db = HardLinkDB('hardlink/hardlink.db')
         self.emotion_db = EmotionDB('emoticon/emoticon.db')
+        # 聊天界面分页缓存
+        self.page_cache = MessagePageCache(self._get_messages_by_num)
+        # 联系人目录，第一次用到联系人时一次性加载
+        self.contact_directory = ContactDirectory(
+            self.contact_db.get_all_contacts,
+            self.contact_db.get_chatroom_room_data,
+            self.contact_db.get_label_map,
+            self.create_contact,
+            snapshot=ContactSnapshot(self.contact_db)
+        )
+        # 消息解析缓存
+        self.parse_cache = ParseCache()
+
+    def databases(self) -> dict:
+        return {
+            'contact': self.contact_db,
+            'head_image': self.head_image_db,
+            'session': self.session_db,
+            'message': self.message_db,
+            'biz_message': self.biz_message_db,
+            'media': self.media_db,
+            'hardlink': self.hardlink_db,
+            'emotion': self.emotion_db,
+        }
 
-    def init_database(self, db_dir=''):
+    def init_database(self, db_dir='', warm_up=None):
         Me().load_from_json(os.path.join(db_dir, 'info.json'))  # 加载自己的信息
         # print('初始化数据库', db_dir)
         self.db_dir = db_dir
         flag = True
-        flag &= self.contact_db.init_database(db_dir)
-        flag &= self.head_image_db.init_database(db_dir)
-        flag &= self.session_db.init_database(db_dir)
-        flag &= self.message_db.init_database(db_dir)
-        flag &= self.biz_message_db.init_database(db_dir)
-        flag &= self.media_db.init_database(db_dir)
-        flag &= self.hardlink_db.init_database(db_dir)
-        flag &= self.emotion_db.init_database(db_dir)
+        for db in self.databases().values():
+            flag &= db.init_database(db_dir)
+        self.parse_cache.init_database(db_dir, f'{Me().wxid}-{Me().wx_dir}')
+        # 重新初始化（例如增量解密后刷新）时媒体目录可能也有新文件
+        invalidate_media_trees()
+        if warm_up:
+            self.warm_up(warm_up)
         return flag
 
+    def warm_up(self, databases=None):
+        """
+        预先打开数据库连接
+        @param databases: True/None表示全部，或者数据库名称列表，例如 ['contact', 'message']
+        @return:
+        """
+        for name, db in self.databases().items():
+            if databases is None or databases is True or name in databases:
+                db.warm_up()
+
     def close(self):
-        pass
+        shutdown_parser_pools(self.db_dir, 4)
+        self.page_cache.close()
+        self.parse_cache.close()
+        for db in self.databases().values():
+            db.close()
+
+    def build_message_indexes(self, max_workers=None, analyze=True) -> dict:
+        """
+        为消息分库建立时间、类型、发送者索引（会修改解密后的数据库文件）
+        @param max_workers: 并行线程数
+        @param analyze: 是否执行ANALYZE
+        @return: {分库文件名: {"indexes": [...], "elapsed": 耗时}}
+        """
+        result = self.message_db.build_indexes(max_workers, analyze)
+        self._update_registry_signature()
+        return result
 
-        # self.head_image_db.close()
-        # self.contact_db.close()
+    def _update_registry_signature(self):
+        # 自己修改了数据库文件（建索引、改备注、合并等），不是外部更新，记录新的签名，共享对象不需要重新加载
+        from wxManager import database_registry
+        database_registry.update_signature(self)
 
     def get_session(self):
         """
@@ -111,11 +236,23 @@ class DataBaseV4(DataBaseInterface):
         """
         return self.session_db.get_session()
 
+    def _parse_serial(self, username):
+        # 在当前进程解析，消息不多或者进程池不可用时使用
+        return lambda rows: list(parser_messages(rows, username, self.db_dir, context=self, deferred=True))
+
     def get_messages(
             self,
             username_: str,
             time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+            query: MessageQuery = None,
     ):
+        """
+        获取聊天记录
+        @param username_:
+        @param time_range:
+        @param query: 查询条件，类型、发送者、时间范围会在SQL中过滤
+        @return:
+        """
         # todo 改成yield进行操作，多进程处理加快速度
         import time
         st = time.time()
@@ -128,45 +265,77 @@ class DataBaseV4(DataBaseInterface):
         #     for message in parser_messages(messages_, username_, self.db_dir):
         #         res.append(message)
 
-        def split_list(lst, n):
-            k, m = divmod(len(lst), n)
-            return [lst[i * k + min(i, m):(i + 1) * k + min(i + 1, m)] for i in range(n)]
-
         #
         # # # Step 1: Retrieve raw message batches
+        if query and not time_range:
+            time_range = query.time_range
         if username_.startswith('gh_'):
             messages = self.biz_message_db.get_messages_by_username(username_, time_range)
+        elif query:
+            messages = self.message_db.get_messages_by_username(
+                username_, time_range,
+                local_types=query.source_types(),
+                senders=query.senders,
+                need_payload=query.need_payload
+            )
         else:
             messages = self.message_db.get_messages_by_username(username_, time_range)
 
-        if len(messages) < 20000:
-            for message in parser_messages(messages, username_, self.db_dir):
-                res.append(message)
+        if query and query.lazy:
+            # 只读取直接字段，不需要多进程解析
+            res = list(parser_messages(messages, username_, self.db_dir, context=self, lazy=True))
         else:
-            raw_message_batches = split_list(messages, len(messages) // 10000 + 1)
-            #
-            # # Step 2: Use multiprocessing to process the message batches
-            # res = []
-            # for batch in raw_message_batches:
-            #     print(len(batch))
-
-            with ProcessPoolExecutor(max_workers=min(len(raw_message_batches), 16)) as executor:
-                # Submit tasks
-                future_to_batch = {
-                    executor.submit(_process_messages_batch, batch, username_, self.db_dir): batch
-                    for batch in raw_message_batches
-                }
-
-                # Collect results
-                for future in future_to_batch.keys():
-                    res.extend(future.result())
+            # 消息多时交给常驻的解析进程池
+            res = parse_in_pool(messages, username_, self.db_dir, 4, self._parse_serial(username_))
 
         et = time.time()
         logger.error(f'获取聊天记录完成：{et}')
         logger.error(f'获取聊天记录耗时：{et - st:.2f}s/{len(res)}条消息 {username_}')
+        if query:
+            res = [message for message in res if query.match(message)]
         res.sort()
         return res
 
+    def get_messages_iter(
+            self,
+            username_: str,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+            batch_size: int = 1000,
+            query: MessageQuery = None,
+    ) -> Iterator[Message]:
+        """
+        按时间顺序逐批读取、解析聊天记录，内存占用只与batch_size有关，适合导出大群
+        @param username_:
+        @param time_range:
+        @param batch_size: 每批读取和解析的消息数量
+        @param query: 查询条件，同get_messages
+        @return: 消息迭代器
+        """
+        if query and not time_range:
+            time_range = query.time_range
+        if username_.startswith('gh_'):
+            # 公众号消息不多，整体读取后排序
+            rows = iter(sorted(self.biz_message_db.get_messages_by_username(username_, time_range), key=itemgetter(3)))
+        elif query:
+            rows = self.message_db.iter_messages_by_username(
+                username_, time_range,
+                local_types=query.source_types(),
+                senders=query.senders,
+                need_payload=query.need_payload,
+                batch_size=batch_size
+            )
+        else:
+            rows = self.message_db.iter_messages_by_username(username_, time_range, batch_size=batch_size)
+        lazy = bool(query and query.lazy)
+        for rows_batch in iter_batches(rows, batch_size):
+            if lazy:
+                messages = parser_messages(rows_batch, username_, self.db_dir, context=self, lazy=True)
+            else:
+                messages = parse_in_pool(rows_batch, username_, self.db_dir, 4, self._parse_serial(username_))
+            for message in messages:
+                if query is None or query.match(message):
+                    yield message
+
     def get_messages_by_num(self, username, start_sort_seq, msg_num=20):
         """
         获取小于start_sort_seq的msg_num个消息
@@ -175,13 +344,16 @@ class DataBaseV4(DataBaseInterface):
         @param msg_num:
         @return: messages, 最后一条消息的start_sort_seq
         """
+        return self.page_cache.get(username, start_sort_seq, msg_num)
+
+    def _get_messages_by_num(self, username, start_sort_seq, msg_num=20):
         result = []
         if username.startswith('gh_'):
             messages = self.biz_message_db.get_messages_by_num(username, start_sort_seq, msg_num)
         else:
             messages = self.message_db.get_messages_by_num(username, start_sort_seq, msg_num)
         for messages in messages:
-            for message in parser_messages(messages, username, self.db_dir):
+            for message in parser_messages(messages, username, self.db_dir, context=self, deferred=True):
                 result.append(message)
         result.sort(reverse=True)
         res = result[:msg_num]
@@ -189,48 +361,45 @@ class DataBaseV4(DataBaseInterface):
 
     def get_message_by_server_id(self, username, server_id):
         """
-        获取小于start_sort_seq的msg_num个消息
+        获取server_id对应的消息
         @param username:
         @param server_id:
-        @return: messages, 最后一条消息的start_sort_seq
+        @return: Message
         """
         message = self.message_db.get_message_by_server_id(username, server_id)
         if message:
-            messages_iter = parser_messages([message], username, self.db_dir)
+            messages_iter = parser_messages([message], username, self.db_dir, context=self)
             return next(messages_iter)
         return None
 
+    def get_messages_by_server_ids(self, username, server_ids):
+        """
+        批量获取server_id对应的消息
+        @param username:
+        @param server_ids:
+        @return: {server_id: Message}
+        """
+        messages = self.message_db.get_messages_by_server_ids(username, server_ids)
+        if not messages:
+            return {}
+        return {
+            message.server_id: message
+            for message in parser_messages(list(messages.values()), username, self.db_dir, context=self)
+        }
+
     def get_messages_by_type(
             self,
             username_,
             type_: MessageType,
             time_range: Tuple[int | float | str | date, int | float | str | date] = None,
     ):
-        def split_list(lst, n):
-            k, m = divmod(len(lst), n)
-            return [lst[i * k + min(i, m):(i + 1) * k + min(i + 1, m)] for i in range(n)]
-
-        res = []
         # # # Step 1: Retrieve raw message batches
         if username_.startswith('gh_'):
             messages = self.biz_message_db.get_messages_by_type(username_, time_range)
         else:
             messages = self.message_db.get_messages_by_type(username_, type_, time_range)
 
-        if len(messages) < 20000:
-            for message in parser_messages(messages, username_, self.db_dir):
-                res.append(message)
-        else:
-            raw_message_batches = split_list(messages, len(messages) // 10000 + 1)
-            with ProcessPoolExecutor(max_workers=min(len(raw_message_batches), 16)) as executor:
-                # Submit tasks
-                future_to_batch = {
-                    executor.submit(_process_messages_batch, batch, username_, self.db_dir): batch
-                    for batch in raw_message_batches
-                }
-                # Collect results
-                for future in future_to_batch.keys():
-                    res.extend(future.result())
+        res = parse_in_pool(messages, username_, self.db_dir, 4, self._parse_serial(username_))
         res.sort()
         return res
 
@@ -240,13 +409,199 @@ class DataBaseV4(DataBaseInterface):
         else:
             return self.message_db.get_messages_calendar(username_)
 
+    def build_search_index(self, max_workers=None) -> int:
+        """
+        建立/增量更新全文检索索引
+        @param max_workers: 并行提取文字的进程数
+        @return: 新增的文档数量
+        """
+        return self.message_db.update_search_index(max_workers)
+
+    def _parse_search_result(self, hits) -> List:
+        # 同一个聊天对象的消息一起解析，再按检索结果的顺序返回
+        groups = {}
+        for index, (talker, message) in enumerate(hits):
+            groups.setdefault(talker, []).append((index, message))
+        result = [None] * len(hits)
+        for talker, items in groups.items():
+            messages = parser_messages([message for _, message in items], talker, self.db_dir, context=self)
+            for (index, _), message in zip(items, messages):
+                result[index] = message
+        return [message for message in result if message]
+
+    def search_messages(
+            self,
+            query: str,
+            talker: str = None,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+            page=1,
+            page_size=20
+    ) -> List:
+        """
+        全文检索聊天记录（文本、链接标题、文件名、引用内容），按相关度排序
+        @param query: 关键字
+        @param talker: 只检索某个聊天对象
+        @param time_range:
+        @param page: 页码，从1开始
+        @param page_size:
+        @return: List[Message]
+        """
+        hits = self.message_db.search_messages(query, talker, time_range, page=page, page_size=page_size)
+        return self._parse_search_result(hits)
+
+    def get_messages_by_keyword(self, username_, keyword, num=5, max_len=10, time_range=None, year_='all'):
+        """
+        包含关键字的文本消息，按时间倒序
+        @param username_:
+        @param keyword:
+        @param num: 最多返回的消息数量
+        @param max_len: 消息的最大长度，过滤掉长消息
+        @param time_range:
+        @param year_: 只检索某一年
+        @return: List[Message]
+        """
+        if year_ and year_ != 'all':
+            time_range = (f'{year_}-01-01 00:00:00', f'{year_}-12-31 23:59:59')
+        result = []
+        page = 1
+        page_size = max(num, 1) * 4
+        while len(result) < num:
+            hits = self.message_db.search_messages(
+                keyword, username_, time_range, local_types=[MessageType.Text],
+                page=page, page_size=page_size, order_by_time=True
+            )
+            for message in self._parse_search_result(hits):
+                if len(message.content) <= max_len:
+                    result.append(message)
+            if len(hits) < page_size:
+                break
+            page += 1
+        return result[:num]
+
+    def get_messages_by_days(
+            self,
+            username_,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+    ):
+        """
+        每天的消息数量
+        @param username_:
+        @param time_range:
+        @return: [('2024-12-01', 消息数量)]
+        """
+        return self.message_db.get_stats().count_by_day(username_, convert_to_timestamp(time_range) if time_range else None)
+
+    def get_messages_by_month(
+            self,
+            username_,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+    ):
+        """
+        每月的消息数量
+        @param username_:
+        @param time_range:
+        @return: [('2024-12', 消息数量)]
+        """
+        return self.message_db.get_stats().count_by_month(username_, convert_to_timestamp(time_range) if time_range else None)
+
+    def get_messages_by_hour(self, username_, time_range=None, year_='all'):
+        """
+        一天中每个小时的消息数量
+        @param username_:
+        @param time_range:
+        @param year_: 只统计某一年
+        @return: [('00', 消息数量)]
+        """
+        return self.message_db.get_stats().count_by_hour(
+            username_, time_range=convert_to_timestamp(time_range) if time_range else None, year_=year_
+        )
+
+    def get_messages_number(
+            self,
+            username_,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+    ) -> int:
+        return self.message_db.get_stats().count(username_, time_range=convert_to_timestamp(time_range) if time_range else None)
+
+    def get_messages_count(self, username_, query: MessageQuery = None) -> int:
+        query = query or MessageQuery()
+        if username_.startswith('gh_'):
+            # 公众号消息不多，直接按解析后的类型计数
+            lazy_query = MessageQuery(types=query.types, senders=query.senders, time_range=query.time_range, lazy=True)
+            return sum(1 for _ in self.get_messages_iter(username_, query=lazy_query))
+        return self.message_db.count_messages_by_username(
+            username_, query.time_range, local_types=query.source_types(), senders=query.senders
+        )
+
+    def get_messages_number_by_type(
+            self,
+            username_,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+    ) -> list:
+        """
+        每种消息类型的数量
+        @param username_:
+        @param time_range:
+        @return: [(MessageType, 消息数量)]
+        """
+        result = self.message_db.get_stats().count_by_type(username_, convert_to_timestamp(time_range) if time_range else None)
+        res = {}
+        for local_type, num in result:
+            # 与解析后的Message.type一致（多种链接、小程序等合并为同一类型）
+            type_ = PARSED_TYPES.get(local_type, local_type)
+            res[type_] = res.get(type_, 0) + num
+        return sorted(res.items(), key=lambda x: x[1], reverse=True)
+
+    def get_messages_number_by_sender(
+            self,
+            username_,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+    ) -> list:
+        """
+        每个发送者的消息数量（群聊发言排行）
+        @param username_:
+        @param time_range:
+        @return: [(wxid, 消息数量)]
+        """
+        return self.message_db.get_stats().count_by_sender(username_, convert_to_timestamp(time_range) if time_range else None)
+
     def get_chatted_top_contacts(
             self,
             time_range: Tuple[int | float | str | date, int | float | str | date] = None,
             contain_chatroom=False,
             top_n=10
     ) -> list:
-        return []
+        """
+        聊天消息最多的联系人
+        @param time_range:
+        @param contain_chatroom: 是否包含群聊
+        @param top_n:
+        @return: [(wxid, 消息数量)]
+        """
+        return self.message_db.get_stats().top_talkers(
+            convert_to_timestamp(time_range) if time_range else None, contain_chatroom, top_n
+        )
+
+    def get_send_messages_number_sum(
+            self,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+    ) -> int:
+        return self.message_db.get_stats().count(
+            sender=Me().wxid, time_range=convert_to_timestamp(time_range) if time_range else None
+        )
+
+    def get_send_messages_number_by_hour(
+            self,
+            time_range: Tuple[int | float | str | date, int | float | str | date] = None,
+    ) -> list:
+        """
+        自己发送的消息在一天中每个小时的数量
+        @param time_range:
+        @return: [('00', 消息数量)]
+        """
+        return self.message_db.get_stats().count_by_hour(
+            sender=Me().wxid, time_range=convert_to_timestamp(time_range) if time_range else None
+        )
 
     def get_emoji_url(self, md5: str, thumb: bool = False) -> str | bytes:
         return self.emotion_db.get_emoji_url(md5, thumb)
@@ -301,19 +656,16 @@ class DataBaseV4(DataBaseInterface):
             try:
                 # 创建顶级消息对象
                 message = contact_pb2.ContactInfo()
-                # 解析二进制数据
+                # 解析二进制数据，直接读取需要的字段，不转换成字典
                 message.ParseFromString(contact_info_list[10])
-                # 转换为 JSON 格式
-                detail = MessageToDict(message)
-                gender_code = detail.get('gender', 0)
+                gender_code = message.gender
                 if gender_code == 1:
                     gender = '男'
                 elif gender_code == 2:
                     gender = '女'
-                label_list = detail.get('labelList', '').strip(',').split(',')
-                signature = detail.get('signature', '')
-                region = (detail.get('country', ''), detail.get('province', ''), detail.get('city', ''))
-                label_list = self.contact_db.get_labels(detail.get('labelList')).split(',')
+                signature = message.signature
+                region = (message.country, message.province, message.city)
+                label_list = self.contact_directory.get_labels(message.label_list).split(',')
             except:
                 pass
                 # logger.error(f'{wxid} {contact_info_list[5]}联系人解析失败\n{contact_info_list[10]}')
@@ -360,28 +712,26 @@ class DataBaseV4(DataBaseInterface):
         return contact
 
     def get_contacts(self) -> List[Person]:
-        contacts = []
-        contact_lists = self.contact_db.get_contacts()
-        for contact_info_list in contact_lists:
-            if contact_info_list:
-                contact = self.create_contact(contact_info_list)
-                contacts.append(contact)
-        return contacts
+        # 与ContactDB.get_contacts一致，只返回local_type为1、2、5的联系人
+        return self.contact_directory.get_contacts(lambda row: row[2] in (1, 2, 5))
 
     def set_remark(self, username: str, remark) -> bool:
         if username in self.contacts_map:
             self.contacts_map[username].remark = remark
-        return self.contact_db.set_remark(username, remark)
+        result = self.contact_db.set_remark(username, remark)
+        self.contact_directory.invalidate()
+        self.chatroom_members_map.clear()
+        self._update_registry_signature()
+        return result
 
     def set_avatar_buffer(self, username, avatar_path):
-        return self.head_image_db.set_avatar_buffer(username, avatar_path)
+        result = self.head_image_db.set_avatar_buffer(username, avatar_path)
+        self._update_registry_signature()
+        return result
 
     def get_contact_by_username(self, wxid: str) -> Person:
-        contact_info_list = self.contact_db.get_contact_by_username(wxid)
-        if contact_info_list:
-            contact = self.create_contact(contact_info_list)
-            return contact
-        else:
+        contact = self.contact_directory.get_contact(wxid)
+        if contact is None:
             contact = Contact(
                 wxid=wxid,
                 nickname=wxid,
@@ -398,40 +748,33 @@ class DataBaseV4(DataBaseInterface):
         if chatroom_name in self.chatroom_members_map:
             return self.chatroom_members_map[chatroom_name]
         result = {}
-        chatroom = self.contact_db.get_chatroom_info(chatroom_name)
-
-        if chatroom is None:
+        members = self.contact_directory.get_chatroom_members(chatroom_name)
+        if members is None:
             return result
-        # 解析RoomData数据
-        parsechatroom = ChatRoomData()
-        parsechatroom.ParseFromString(chatroom[1])
         # 群成员数据放入字典存储
-        for mem in parsechatroom.members:
-            contact = self.get_contact_by_username(mem.wxID)
+        for wxid, display_name in members:
+            contact = self.get_contact_by_username(wxid)
             if contact:
-                if mem.displayName:
-                    contact.remark = mem.displayName
+                if display_name:
+                    contact.remark = display_name
                 result[contact.wxid] = contact
         self.chatroom_members_map[chatroom_name] = result
         return result
 
     def _get_chatroom_name(self, wxid):
-        chatroom = self.contact_db.get_chatroom_info(wxid)
+        members = self.contact_directory.get_chatroom_members(wxid)
 
-        if chatroom is None:
+        if members is None:
             return ''
-        # 解析RoomData数据
-        parsechatroom = ChatRoomData()
-        parsechatroom.ParseFromString(chatroom[1])
         chatroom_name = ''
         # 群成员数据放入字典存储
-        for mem in parsechatroom.members[:5]:
-            if mem.wxID == Me().wxid:
+        for member_wxid, display_name in members[:5]:
+            if member_wxid == Me().wxid:
                 continue
-            if mem.displayName:
-                chatroom_name += f'{mem.displayName}、'
+            if display_name:
+                chatroom_name += f'{display_name}、'
             else:
-                contact = self.get_contact_by_username(mem.wxID)
+                contact = self.get_contact_by_username(member_wxid)
                 chatroom_name += f'{contact.remark}、'
         return chatroom_name.rstrip('、')
 
@@ -476,3 +819,12 @@ class DataBaseV4(DataBaseInterface):
                     print(f"成功合并数据库: {path}")
                 except Exception as e:
                     print(f"合并 {path} 失败: {e}")
+        self.page_cache.invalidate()
+        self.parse_cache.invalidate()
+        self.contact_directory.invalidate()
+        self.chatroom_members_map.clear()
+        invalidate_media_trees()
+        # 解析进程中打开的数据库已经过时
+        shutdown_parser_pools(self.db_dir, 4)
+        # 上面已经清除了缓存，不需要再重新加载整个数据库对象
+        self._update_registry_signature()
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2026/10/20 3:00
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-media_resolver.py
+@Description : 图片、视频、文件路径查找
+               hardlink表一次性读入内存（md5 -> 行），媒体目录树、聊天记录的Rec目录各扫描一次建立索引，查找时只做字典查询
+"""
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, Optional, Set, Tuple
+
+from wxManager.log import logger
+
+
+class Md5Table:
+    """
+    hardlink表的内存映射 {md5: 行}，第一次查询时加载整张表
+    同一个md5有多行时保留第一行（与原来 where md5=? 取第一条的结果一致）
+    """
+
+    def __init__(self, loader: Callable[[], Iterable[tuple]], name=''):
+        """
+        @param loader: 返回表中所有行，第一列为md5，其余列为原来按md5查询返回的列
+        @param name: 表名，用于日志
+        """
+        self.loader = loader
+        self.name = name
+        self.rows: Dict = {}
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        if self.loaded:
+            return
+        with self.lock:
+            if self.loaded:
+                return
+            st = time.time()
+            rows = {}
+            for row in self.loader():
+                if row[0] not in rows:
+                    rows[row[0]] = row[1:]
+            self.rows = rows
+            self.loaded = True
+            logger.info(f'{self.name} 加载完成：{len(rows)}条，耗时{time.time() - st:.3f}s')
+
+    def get(self, md5) -> Optional[tuple]:
+        if not md5:
+            return None
+        self.load()
+        return self.rows.get(md5)
+
+    def invalidate(self):
+        """
+        数据库合并后调用，下次查询时重新加载
+        @return:
+        """
+        with self.lock:
+            self.rows = {}
+            self.loaded = False
+
+    def __len__(self):
+        self.load()
+        return len(self.rows)
+
+
+def normalize_path(path) -> str:
+    # 与os.path.exists的判断方式保持一致：Windows下不区分大小写、分隔符统一
+    return os.path.normcase(os.path.normpath(path))
+
+
+class MediaFileTree:
+    """
+    媒体目录的文件索引
+    - root：微信账号目录（Me().wx_dir），sub_dirs：需要索引的子目录（msg/attach、msg/video、msg/file）
+    - 第一次查询时用os.scandir遍历一遍，之后exists只查集合
+    - mtimes：扫描时每个目录的修改时间，查不到文件且所在目录发生变化（微信新下载了文件）时只重新扫描这一个目录
+    - 不在这些子目录下的路径仍然使用os.path.exists
+    """
+
+    def __init__(self, root, sub_dirs: Tuple[str, ...]):
+        self.root = root
+        self.sub_dirs = tuple(normalize_path(sub_dir) for sub_dir in sub_dirs)
+        self.files: Set[str] = set()
+        self.mtimes: Dict[str, Optional[int]] = {}
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def _scan(self, rel_dir, files: Set[str], mtimes: Dict[str, Optional[int]], recursive=True):
+        stack = [rel_dir]
+        while stack:
+            rel_dir = stack.pop()
+            abs_dir = os.path.join(self.root, rel_dir)
+            try:
+                mtimes[normalize_path(rel_dir)] = os.stat(abs_dir).st_mtime_ns
+                with os.scandir(abs_dir) as it:
+                    for entry in it:
+                        rel_path = os.path.join(rel_dir, entry.name)
+                        try:
+                            if entry.is_dir():
+                                if recursive:
+                                    stack.append(rel_path)
+                            else:
+                                files.add(normalize_path(rel_path))
+                        except OSError:
+                            continue
+            except OSError:
+                mtimes[normalize_path(rel_dir)] = None
+                continue
+
+    def load(self):
+        if self.loaded:
+            return
+        with self.lock:
+            if self.loaded:
+                return
+            st = time.time()
+            files = set()
+            mtimes = {}
+            if self.root:
+                for sub_dir in self.sub_dirs:
+                    self._scan(sub_dir, files, mtimes)
+            self.files = files
+            self.mtimes = mtimes
+            self.loaded = True
+            logger.info(f'媒体文件索引完成：{len(files)}个文件，耗时{time.time() - st:.3f}s')
+
+    def indexed(self, key) -> bool:
+        return any(key == sub_dir or key.startswith(sub_dir + os.sep) for sub_dir in self.sub_dirs)
+
+    def exists(self, rel_path) -> bool:
+        """
+        @param rel_path: 相对于root的路径
+        @return:
+        """
+        if not rel_path:
+            return False
+        key = normalize_path(rel_path)
+        if not self.indexed(key):
+            return os.path.exists(os.path.join(self.root, rel_path))
+        self.load()
+        if key in self.files:
+            return True
+        # 没找到时看一下所在目录有没有变化，有变化才重新扫描这一个目录
+        rel_dir = os.path.dirname(key)
+        try:
+            mtime = os.stat(os.path.join(self.root, rel_dir)).st_mtime_ns
+        except OSError:
+            mtime = None
+        if rel_dir in self.mtimes and mtime == self.mtimes[rel_dir]:
+            return False
+        files = set()
+        mtimes = {}
+        self._scan(rel_dir, files, mtimes, recursive=False)
+        with self.lock:
+            self.files |= files
+            self.mtimes.update(mtimes)
+        return key in files
+
+    def invalidate(self):
+        with self.lock:
+            self.files = set()
+            self.mtimes = {}
+            self.loaded = False
+
+
+class RecDirectoryIndex:
+    """
+    合并转发消息（聊天记录）的附件目录索引
+    - 目录结构：msg/attach/{wxid_md5}/{month}/Rec/{local_id}_{xxx}/(Img|V|F)/...
+    - records：{Rec目录: {local_id: 记录目录名}}，第一次查询时用os.scandir把整个账号的Rec目录遍历一遍
+    - mtimes：扫描时Rec目录的修改时间，查不到记录且Rec目录发生变化时只重新扫描这一个Rec目录
+    """
+
+    def __init__(self, root):
+        """
+        @param root: 微信账号目录（Me().wx_dir）
+        """
+        self.root = root
+        self.records: Dict[str, Dict[str, str]] = {}
+        self.mtimes: Dict[str, Optional[int]] = {}
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(rec_dir):
+        return normalize_path(os.path.abspath(rec_dir))
+
+    @staticmethod
+    def _scan_rec_dir(rec_dir) -> Tuple[Dict[str, str], Optional[int]]:
+        records = {}
+        try:
+            mtime = os.stat(rec_dir).st_mtime_ns
+            with os.scandir(rec_dir) as it:
+                for entry in it:
+                    prefix, sep, _ = entry.name.partition('_')
+                    if sep:
+                        # 与原来遍历os.listdir的结果一致，同一个local_id保留最后一个
+                        records[prefix] = entry.name
+        except OSError:
+            return {}, None
+        return records, mtime
+
+    @staticmethod
+    def _sub_dirs(path):
+        try:
+            with os.scandir(path) as it:
+                return [entry.path for entry in it if entry.is_dir()]
+        except OSError:
+            return []
+
+    def load(self):
+        if self.loaded:
+            return
+        with self.lock:
+            if self.loaded:
+                return
+            st = time.time()
+            records = {}
+            mtimes = {}
+            if self.root:
+                attach_dir = os.path.join(self.root, 'msg', 'attach')
+                for talker_dir in self._sub_dirs(attach_dir):
+                    for month_dir in self._sub_dirs(talker_dir):
+                        rec_dir = os.path.join(month_dir, 'Rec')
+                        listing, mtime = self._scan_rec_dir(rec_dir)
+                        if mtime is not None:
+                            key = self._key(rec_dir)
+                            records[key] = listing
+                            mtimes[key] = mtime
+            self.records = records
+            self.mtimes = mtimes
+            self.loaded = True
+            logger.info(f'聊天记录目录索引完成：{len(records)}个Rec目录，耗时{time.time() - st:.3f}s')
+
+    def lookup(self, rec_dir, local_id) -> str:
+        """
+        @param rec_dir: msg/attach/{wxid_md5}/{month}/Rec 的完整路径
+        @param local_id: 合并转发消息的local_id
+        @return: 记录目录名 {local_id}_xxx，找不到时返回空字符串
+        """
+        self.load()
+        key = self._key(rec_dir)
+        local_id = str(local_id)
+        listing = self.records.get(key)
+        if listing and local_id in listing:
+            return listing[local_id]
+        # 没找到时看一下Rec目录有没有变化（微信新下载了聊天记录），有变化才重新扫描
+        try:
+            mtime = os.stat(rec_dir).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self.mtimes.get(key):
+            return ''
+        listing, mtime = self._scan_rec_dir(rec_dir)
+        with self.lock:
+            self.records[key] = listing
+            self.mtimes[key] = mtime
+        return listing.get(local_id, '')
+
+    def invalidate(self):
+        with self.lock:
+            self.records = {}
+            self.mtimes = {}
+            self.loaded = False
+
+
+V4_MEDIA_DIRS = (os.path.join('msg', 'attach'), os.path.join('msg', 'video'), os.path.join('msg', 'file'))
+
+# {(wx_dir, sub_dirs): MediaFileTree}，同一账号目录的数据库实例共用一个索引
+_file_trees: Dict[tuple, MediaFileTree] = {}
+# {wx_dir: RecDirectoryIndex}，所有解析器共用
+_rec_indexes: Dict[str, RecDirectoryIndex] = {}
+_file_trees_lock = threading.Lock()
+
+
+def get_media_tree(wx_dir, sub_dirs: Tuple[str, ...] = V4_MEDIA_DIRS) -> MediaFileTree:
+    key = (os.path.abspath(wx_dir) if wx_dir else '', sub_dirs)
+    with _file_trees_lock:
+        tree = _file_trees.get(key)
+        if tree is None:
+            tree = MediaFileTree(key[0], sub_dirs)
+            _file_trees[key] = tree
+        return tree
+
+
+def get_rec_index(wx_dir) -> RecDirectoryIndex:
+    key = os.path.abspath(wx_dir) if wx_dir else ''
+    with _file_trees_lock:
+        index = _rec_indexes.get(key)
+        if index is None:
+            index = RecDirectoryIndex(key)
+            _rec_indexes[key] = index
+        return index
+
+
+def invalidate_media_trees():
+    """
+    媒体目录发生变化后调用
+    @return:
+    """
+    with _file_trees_lock:
+        indexes = list(_file_trees.values()) + list(_rec_indexes.values())
+    for index in indexes:
+        index.invalidate()
+
+
+def _reset_after_fork():
+    # 子进程继承父进程已经建立的索引，只需要重建锁
+    global _file_trees_lock
+    _file_trees_lock = threading.Lock()
+    for index in list(_file_trees.values()) + list(_rec_indexes.values()):
+        index.lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+if __name__ == '__main__':
+    pass
@@ -11,8 +11,10 @@
 
 from .message import Message, MessageType, TextMessage, ImageMessage, FileMessage, VideoMessage, AudioMessage, \
     EmojiMessage, QuoteMessage, MergedMessage, LinkMessage, PositionMessage
-from .db_model import DataBaseBase
+from .message_batch import MessageBatch, StringTable
+from .db_model import DataBaseBase, set_connection_budget
 from .contact import Person, Contact, OpenIMContact, Me
+from .query import MessageQuery
 
 if __name__ == '__main__':
     pass
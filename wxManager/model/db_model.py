@@ -10,7 +10,216 @@
 """
 import os
 import sqlite3
+import threading
+import time
 import traceback
+import weakref
+from typing import Callable, List
+
+
+class ConnectionPool:
+    """
+    限制同时打开的数据库连接数（文件描述符预算）
+    - 新打开连接后，若超过max_open，关闭最久未使用且空闲超过idle_seconds的连接
+    - 仍有未释放游标的连接（正在使用）不会被关闭
+    """
+
+    def __init__(self, max_open=64, idle_seconds=60):
+        self.max_open = max_open
+        self.idle_seconds = idle_seconds
+        self.connections = weakref.WeakValueDictionary()
+        self.lock = threading.Lock()
+
+    def _idle_connections(self, idle_seconds):
+        now = time.monotonic()
+        idle = [
+            conn for conn in list(self.connections.values())
+            if not conn.in_use() and now - conn.last_used >= idle_seconds
+        ]
+        idle.sort(key=lambda conn: conn.last_used)
+        return idle
+
+    def opened(self, conn: 'LazyConnection'):
+        with self.lock:
+            self.connections[id(conn)] = conn
+            over = len(self.connections) - self.max_open
+            evict = self._idle_connections(self.idle_seconds)[:over] if over > 0 else []
+        for idle_conn in evict:
+            idle_conn.close_if_idle(self.idle_seconds)
+
+    def closed(self, conn: 'LazyConnection'):
+        with self.lock:
+            self.connections.pop(id(conn), None)
+
+    def close_idle(self, idle_seconds=None) -> int:
+        """
+        关闭所有空闲的连接（不考虑预算）
+        @param idle_seconds: 空闲阈值，默认使用self.idle_seconds
+        @return: 关闭的连接数
+        """
+        if idle_seconds is None:
+            idle_seconds = self.idle_seconds
+        with self.lock:
+            evict = self._idle_connections(idle_seconds)
+        return sum(idle_conn.close_if_idle(idle_seconds) for idle_conn in evict)
+
+    def open_count(self) -> int:
+        with self.lock:
+            return len(self.connections)
+
+    def reset(self):
+        # fork出的子进程不再管理父进程的连接
+        self.connections = weakref.WeakValueDictionary()
+        self.lock = threading.Lock()
+
+
+connection_pool = ConnectionPool()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=connection_pool.reset)
+
+
+def set_connection_budget(max_open=None, idle_seconds=None):
+    """
+    设置最多同时打开的数据库连接数和空闲阈值
+    @param max_open:
+    @param idle_seconds: 空闲超过该时间的连接才允许被关闭
+    @return:
+    """
+    if max_open is not None:
+        connection_pool.max_open = max_open
+    if idle_seconds is not None:
+        connection_pool.idle_seconds = idle_seconds
+
+
+class LazyConnection:
+    """
+    首次使用时才打开的sqlite3连接，用法和sqlite3.Connection相同
+    被连接池关闭后，下次使用时自动重新打开（并重新执行open_hooks，例如注册SQL函数）
+    """
+
+    def __init__(self, db_path, pool: ConnectionPool = None):
+        self.db_path = db_path
+        self.pool = pool or connection_pool
+        self.last_used = 0
+        self._conn = None
+        self._local = threading.local()  # self.cursor 使用的游标，每个线程一个
+        self._generation = 0  # 每次打开连接加一，用来判断线程里的游标是否属于当前连接
+        self._cursors = weakref.WeakSet()  # 通过cursor()创建且尚未释放的游标
+        self._open_hooks: List[Callable[[sqlite3.Connection], None]] = []
+        self._lock = threading.RLock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._conn is not None
+
+    def connection(self) -> sqlite3.Connection:
+        self.last_used = time.monotonic()
+        conn = self._conn
+        if conn is not None:
+            return conn
+        with self._lock:
+            if self._conn is None:
+                conn = sqlite3.connect(self.db_path, check_same_thread=False)
+                for hook in self._open_hooks:
+                    hook(conn)
+                self._conn = conn
+                self._generation += 1
+                opened = True
+            else:
+                opened = False
+            conn = self._conn
+        if opened:
+            self.pool.opened(self)
+        return conn
+
+    def add_open_hook(self, hook: Callable[[sqlite3.Connection], None]):
+        """
+        每次打开连接后执行，已经打开的连接立即执行
+        @param hook: hook(sqlite3.Connection)
+        @return:
+        """
+        with self._lock:
+            self._open_hooks.append(hook)
+            if self._conn is not None:
+                hook(self._conn)
+
+    def cursor(self) -> sqlite3.Cursor:
+        with self._lock:
+            cursor = self.connection().cursor()
+            self._cursors.add(cursor)
+        return cursor
+
+    def shared_cursor(self) -> sqlite3.Cursor:
+        """
+        当前线程的共享游标，多个线程共用一个DataBaseBase时互不干扰
+        @return:
+        """
+        with self._lock:
+            conn = self.connection()
+            cursor = getattr(self._local, 'cursor', None)
+            if cursor is None or getattr(self._local, 'generation', 0) != self._generation:
+                cursor = conn.cursor()
+                self._local.cursor = cursor
+                self._local.generation = self._generation
+            return cursor
+
+    def in_use(self) -> bool:
+        return len(self._cursors) > 0
+
+    def commit(self):
+        # 没有打开过的连接不需要提交
+        if self._conn is not None:
+            self._conn.commit()
+
+    def rollback(self):
+        if self._conn is not None:
+            self._conn.rollback()
+
+    def close_if_idle(self, idle_seconds) -> bool:
+        """
+        加锁后再次确认连接空闲，避免关闭刚被其他线程取走的连接
+        @param idle_seconds:
+        @return: 是否关闭
+        """
+        with self._lock:
+            if self._conn is None or self.in_use() or time.monotonic() - self.last_used < idle_seconds:
+                return False
+            self.close()
+            return True
+
+    def close(self):
+        with self._lock:
+            conn, self._conn = self._conn, None
+            if conn is None:
+                return
+            try:
+                conn.close()
+            except sqlite3.Error:
+                print(traceback.format_exc())
+        self.pool.closed(self)
+
+    def __getattr__(self, name):
+        # execute、create_function等其他方法交给真正的连接
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.connection(), name)
+
+
+class LazyCursor:
+    """
+    self.cursor 的替代品，使用时才打开连接，执行在连接的共享游标上
+    """
+
+    def __init__(self, connection: LazyConnection):
+        self.connection = connection
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.connection.shared_cursor(), name)
+
+    def __iter__(self):
+        return iter(self.connection.shared_cursor())
 
 
 class DataBaseBase:
@@ -21,14 +230,21 @@ class DataBaseBase:
         self.db_file_name = db_file_name
         self.is_series = is_series  # 是否是一系列数据库，例如MSG0、MSG1、MSG2······
         self.db_dir = ''
+        self.db_paths = []  # 每个数据库文件的完整路径，与self.DB一一对应
 
     def init_database(self, db_dir=''):
+        """
+        只查找数据库文件，连接在第一次使用时才打开（见LazyConnection）
+        @param db_dir:
+        @return:
+        """
         self.db_dir = db_dir
         db_path = os.path.join(db_dir, self.db_file_name)
         if not os.path.exists(db_path):
             return False
         db_file_name = self.db_file_name
         self.db_file_name = []
+        self.db_paths = []
         if self.is_series:
             self.DB = []
             self.cursor = []
@@ -37,31 +253,50 @@ class DataBaseBase:
                 db_path = os.path.join(db_dir, new_file_name)
                 if os.path.exists(db_path):
                     self.db_file_name.append(os.path.basename(new_file_name))
-                    # print('初始化数据库：', db_path)
-                    DB = sqlite3.connect(db_path, check_same_thread=False)
-                    cursor = DB.cursor()
+                    self.db_paths.append(db_path)
+                    DB = LazyConnection(db_path)
                     self.DB.append(DB)
-                    self.cursor.append(cursor)
+                    self.cursor.append(LazyCursor(DB))
                     self.open_flag = True
         else:
             if os.path.exists(db_path):
-                self.DB = sqlite3.connect(db_path, check_same_thread=False)
+                self.db_paths.append(db_path)
+                self.DB = LazyConnection(db_path)
                 # '''创建游标'''
-                self.cursor = self.DB.cursor()
+                self.cursor = LazyCursor(self.DB)
                 self.open_flag = True
         # print('初始化数据库完成：', db_path)
         self.self_init()
         return True
 
+    def connections(self) -> List[LazyConnection]:
+        if not self.DB:
+            return []
+        return self.DB if self.is_series else [self.DB]
+
+    def add_open_hook(self, hook: Callable[[sqlite3.Connection], None]):
+        """
+        在每个连接打开时执行，例如注册SQL函数
+        @param hook:
+        @return:
+        """
+        for db in self.connections():
+            db.add_open_hook(hook)
+
+    def warm_up(self):
+        """
+        预先打开所有连接
+        @return:
+        """
+        for db in self.connections():
+            db.connection()
+
     def self_init(self):
         pass
 
     def commit(self):
-        if self.is_series:
-            for db in self.DB:
-                db.commit()
-        else:
-            self.DB.commit()
+        for db in self.connections():
+            db.commit()
 
     def execute(self, sql, args):
         self.cursor.execute(sql, args)
@@ -70,12 +305,8 @@ class DataBaseBase:
         if self.open_flag:
             try:
                 self.open_flag = False
-                if self.is_series:
-                    for db in self.DB:
-                        db.close()
-                else:
-                    if self.DB:
-                        self.DB.close()
+                for db in self.connections():
+                    db.close()
             except:
                 print(traceback.format_exc())
             finally:
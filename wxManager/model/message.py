@@ -9,7 +9,7 @@
 @Description : 
 """
 from dataclasses import dataclass
-from typing import List
+from typing import Callable, List
 from datetime import datetime
 
 import xmltodict
@@ -81,6 +81,11 @@ class MessageType:
 
 @dataclass
 class Message:
+    # 没有__dict__，几百万条消息同时在内存中时节省空间；新增字段时要同时加到__slots__
+    __slots__ = (
+        'local_id', 'server_id', 'sort_seq', 'timestamp', 'str_time', 'type', 'talker_id', 'is_sender',
+        'sender_id', 'display_name', 'avatar_src', 'status', 'xml_content'
+    )
     local_id: int  # 消息ID
     server_id: int  # 消息的唯一ID
     sort_seq: int  # 排序用的id
@@ -131,6 +136,7 @@ class Message:
 @dataclass
 class TextMessage(Message):
     # 文本消息
+    __slots__ = ('content',)
     content: str
 
     def to_text(self):
@@ -145,6 +151,7 @@ class TextMessage(Message):
 @dataclass
 class QuoteMessage(TextMessage):
     # 引用消息
+    __slots__ = ('quote_message',)
     quote_message: Message
 
     def to_json(self) -> dict:
@@ -174,6 +181,7 @@ class QuoteMessage(TextMessage):
 @dataclass
 class FileMessage(Message):
     # 文件消息
+    __slots__ = ('path', 'md5', 'file_size', 'file_name', 'file_type')
     path: str
     md5: str
     file_size: int
@@ -230,6 +238,7 @@ class FileMessage(Message):
 @dataclass
 class ImageMessage(FileMessage):
     # 图片消息
+    __slots__ = ('thumb_path',)
     thumb_path: str
 
     def to_json(self) -> dict:
@@ -245,6 +254,7 @@ class ImageMessage(FileMessage):
 @dataclass
 class EmojiMessage(ImageMessage):
     # 表情包
+    __slots__ = ('url', 'thumb_url', 'description')
     url: str
     thumb_url: str
     description: str
@@ -266,6 +276,7 @@ class EmojiMessage(ImageMessage):
 @dataclass
 class VideoMessage(FileMessage):
     # 视频消息
+    __slots__ = ('thumb_path', 'duration', 'raw_md5')
     thumb_path: str
     duration: int
     raw_md5: str
@@ -288,6 +299,7 @@ class VideoMessage(FileMessage):
 @dataclass
 class AudioMessage(FileMessage):
     # 语音消息
+    __slots__ = ('duration', 'audio_text')
     duration: int
     audio_text: str
 
@@ -324,6 +336,7 @@ class AudioMessage(FileMessage):
 @dataclass
 class LinkMessage(Message):
     # 链接消息
+    __slots__ = ('href', 'title', 'description', 'cover_path', 'cover_url', 'app_name', 'app_icon', 'app_id')
     href: str  # 跳转链接
     title: str  # 标题
     description: str  # 描述/音乐作者
@@ -359,6 +372,10 @@ class LinkMessage(Message):
 @dataclass
 class WeChatVideoMessage(Message):
     # 视频号消息
+    __slots__ = (
+        'url', 'publisher_nickname', 'publisher_avatar', 'description', 'media_count', 'cover_path',
+        'cover_url', 'thumb_url', 'duration', 'width', 'height'
+    )
     url: str  # 下载地址
     publisher_nickname: str  # 视频发布者昵称
     publisher_avatar: str  # 视频发布者头像
@@ -395,6 +412,7 @@ class WeChatVideoMessage(Message):
 @dataclass
 class MergedMessage(Message):
     # 合并转发的聊天记录
+    __slots__ = ('title', 'description', 'messages', 'level')
     title: str
     description: str
     messages: List[Message]  # 嵌套子消息
@@ -421,6 +439,7 @@ class MergedMessage(Message):
 @dataclass
 class VoipMessage(Message):
     # 音视频通话
+    __slots__ = ('invite_type', 'display_content', 'duration')
     invite_type: int  # -1，1:语音通话，0:视频通话
     display_content: str  # 界面显示内容
     duration: int
@@ -443,6 +462,7 @@ class VoipMessage(Message):
 @dataclass
 class PositionMessage(Message):
     # 位置分享
+    __slots__ = ('x', 'y', 'label', 'poiname', 'scale')
     x: float  # 经度
     y: float  # 维度
     label: str  # 详细标签
@@ -473,6 +493,10 @@ class PositionMessage(Message):
 @dataclass
 class BusinessCardMessage(Message):
     # 名片消息
+    __slots__ = (
+        'is_open_im', 'username', 'nickname', 'alias', 'province', 'city', 'sign', 'sex', 'small_head_url',
+        'big_head_url', 'open_im_desc', 'open_im_desc_icon'
+    )
     is_open_im: bool  # 是否是企业微信
     username: str  # 名片的wxid
     nickname: str  # 名片昵称
@@ -533,6 +557,7 @@ class BusinessCardMessage(Message):
 @dataclass
 class TransferMessage(Message):
     # 转账
+    __slots__ = ('fee_desc', 'pay_memo', 'receiver_username', 'pay_subtype')
     fee_desc: str  # 金额
     pay_memo: str  # 备注
     receiver_username: str  # 收款人
@@ -571,6 +596,7 @@ class TransferMessage(Message):
 @dataclass
 class RedEnvelopeMessage(Message):
     # 红包
+    __slots__ = ('icon_url', 'title', 'inner_type')
     icon_url: str  # 红包logo
     title: str
     inner_type: int
@@ -592,6 +618,7 @@ class RedEnvelopeMessage(Message):
 @dataclass
 class FavNoteMessage(Message):
     # 收藏笔记
+    __slots__ = ('title', 'description', 'record_item')
     title: str
     description: str
     record_item: str
@@ -617,6 +644,7 @@ class FavNoteMessage(Message):
 @dataclass
 class PatMessage(Message):
     # 拍一拍
+    __slots__ = ('title', 'from_username', 'chat_username', 'patted_username', 'template')
     title: str
     from_username: str
     chat_username: str
@@ -637,6 +665,89 @@ class PatMessage(Message):
         return data
 
 
+class LazyMessage:
+    """
+    按需解析的消息
+    - 构造时只保存数据库中直接能读到的字段（local_id、timestamp、type、sender_id等）和一个解析函数
+    - 访问其他属性（content、xml_content、display_name、路径等）或调用to_json/to_text时才解析出完整的Message并缓存
+    - 行为与被代理的Message子类一致：isinstance、比较、复制、pickle得到的都是解析后的Message
+    """
+    __slots__ = ('_fields', '_loader', '_message')
+
+    def __init__(self, loader: Callable[[], Message], **fields):
+        """
+        @param loader: 解析函数，返回完整的Message
+        @param fields: 不需要解析就能得到的字段，值必须与解析结果一致
+        """
+        object.__setattr__(self, '_fields', fields)
+        object.__setattr__(self, '_loader', loader)
+        object.__setattr__(self, '_message', None)
+
+    @property
+    def materialized(self) -> bool:
+        return self._message is not None
+
+    def materialize(self) -> Message:
+        message = self._message
+        if message is None:
+            message = self._loader()
+            # 解析前修改过的字段以修改后的值为准
+            for name, value in self._fields.items():
+                if getattr(message, name, value) != value:
+                    setattr(message, name, value)
+            object.__setattr__(self, '_message', message)
+            object.__setattr__(self, '_loader', None)  # 释放数据库行
+        return message
+
+    def __getattr__(self, name):
+        # 只有__slots__之外的属性才会走到这里
+        message = self._message
+        if message is not None:
+            return getattr(message, name)
+        fields = self._fields
+        if name in fields:
+            return fields[name]
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.materialize(), name)
+
+    def __setattr__(self, name, value):
+        if self._message is not None:
+            setattr(self._message, name, value)
+        else:
+            self._fields[name] = value
+
+    @property
+    def __class__(self):
+        # isinstance(message, TextMessage)等判断需要知道真实类型
+        return type(self.materialize())
+
+    def is_chatroom(self) -> bool:
+        return self.talker_id.endswith('@chatroom')
+
+    def type_name(self):
+        return MessageType.name(self.type)
+
+    def __lt__(self, other):
+        return self.sort_seq < other.sort_seq
+
+    def __eq__(self, other):
+        if isinstance(other, LazyMessage):
+            other = other.materialize()
+        return self.materialize() == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        if self._message is None:
+            return f'LazyMessage({", ".join(f"{k}={v!r}" for k, v in self._fields.items())})'
+        return repr(self._message)
+
+    def __reduce_ex__(self, protocol):
+        # pickle、copy、deepcopy得到的是解析后的Message
+        return self.materialize().__reduce_ex__(protocol)
+
+
 if __name__ == '__main__':
     msg = TextMessage(
         local_id=1,
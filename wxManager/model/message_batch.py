@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2026/10/20 6:40
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-message_batch.py
+@Description : 按列保存的一批消息
+               - 数字字段保存在array中，会话、发送者、昵称、头像这些重复很多的字符串保存在字符串表里，每条消息只存下标
+               - 各消息类型特有的字段按行保存成tuple
+               - 遍历或者下标访问时才创建Message对象，统计分析可以直接读列，不需要创建Message
+"""
+from array import array
+from collections import Counter
+from dataclasses import fields
+from operator import attrgetter
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from .message import Message
+
+# Message基类的字段，顺序与构造函数的参数顺序一致
+COMMON_FIELDS = tuple(field.name for field in fields(Message))
+INT_FIELDS = ('local_id', 'server_id', 'sort_seq', 'timestamp', 'type', 'status')
+BOOL_FIELDS = ('is_sender',)
+INTERNED_FIELDS = ('talker_id', 'sender_id', 'display_name', 'avatar_src')
+_common_getter = attrgetter(*COMMON_FIELDS)
+
+_extra_fields: Dict[type, Tuple[str, ...]] = {}
+
+
+def extra_fields(cls) -> Tuple[str, ...]:
+    # 子类在Message基类之外的字段
+    names = _extra_fields.get(cls)
+    if names is None:
+        names = _extra_fields[cls] = tuple(field.name for field in fields(cls)[len(COMMON_FIELDS):])
+    return names
+
+
+class StringTable:
+    """
+    相同的字符串只保存一份，多个MessageBatch可以共用一个字符串表
+    """
+
+    def __init__(self):
+        self.values: List[str] = []
+        self.index: Dict[str, int] = {}
+
+    def intern(self, value) -> int:
+        code = self.index.get(value)
+        if code is None:
+            code = self.index[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def __getitem__(self, code):
+        return self.values[code]
+
+    def __len__(self):
+        return len(self.values)
+
+
+class MessageBatch:
+    def __init__(self, strings: StringTable = None):
+        """
+        @param strings: 共用的字符串表，None时新建
+        """
+        self.strings = strings if strings is not None else StringTable()
+        self.columns: Dict[str, array | list] = {}
+        for name in INT_FIELDS:
+            self.columns[name] = array('q')
+        for name in BOOL_FIELDS:
+            self.columns[name] = array('b')
+        for name in INTERNED_FIELDS:
+            self.columns[name] = array('I')
+        self.columns['str_time'] = []
+        self.columns['xml_content'] = []
+        self.classes: List[type] = []
+        self.class_codes = array('B')
+        self.extras: List[tuple] = []
+
+    @classmethod
+    def from_messages(cls, messages: Iterable[Message], strings: StringTable = None) -> 'MessageBatch':
+        batch = cls(strings)
+        batch.extend(messages)
+        return batch
+
+    def append(self, message: Message):
+        self.extend((message,))
+
+    def extend(self, messages: Iterable[Message]):
+        """
+        整批追加，按列写入
+        @param messages: LazyMessage会被解析（__class__是解析后的类型）
+        @return:
+        """
+        messages = list(messages)
+        if not messages:
+            return
+        columns = self.columns
+        values = dict(zip(COMMON_FIELDS, zip(*map(_common_getter, messages))))
+        for name in INT_FIELDS:
+            column = columns[name]
+            size = len(column)
+            try:
+                column.extend(values[name])
+            except (TypeError, OverflowError):
+                # 不是int64的值（例如没有转换的字符串类型）退化成list
+                del column[size:]
+                column = columns[name] = column.tolist()
+                column.extend(values[name])
+        columns['is_sender'].extend(map(bool, values['is_sender']))
+        intern = self.strings.intern
+        for name in INTERNED_FIELDS:
+            columns[name].extend(map(intern, values[name]))
+        columns['str_time'].extend(values['str_time'])
+        columns['xml_content'].extend(values['xml_content'])
+        class_index = {cls: code for code, cls in enumerate(self.classes)}
+        for message in messages:
+            cls = message.__class__
+            code = class_index.get(cls)
+            if code is None:
+                code = class_index[cls] = len(self.classes)
+                self.classes.append(cls)
+            self.class_codes.append(code)
+            self.extras.append(tuple(getattr(message, name) for name in extra_fields(cls)))
+
+    def __len__(self):
+        return len(self.class_codes)
+
+    def _row(self, index) -> tuple:
+        strings = self.strings.values
+        columns = self.columns
+        return tuple(
+            strings[columns[name][index]] if name in INTERNED_FIELDS
+            else bool(columns[name][index]) if name in BOOL_FIELDS
+            else columns[name][index]
+            for name in COMMON_FIELDS
+        )
+
+    def message(self, index) -> Message:
+        """
+        创建第index条消息，每次调用都会得到新的对象
+        @param index:
+        @return:
+        """
+        cls = self.classes[self.class_codes[index]]
+        return cls(*self._row(index), *self.extras[index])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.take(range(len(self))[index])
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('MessageBatch index out of range')
+        return self.message(index)
+
+    def __iter__(self) -> Iterator[Message]:
+        strings = self.strings.values
+        columns = [
+            [strings[code] for code in self.columns[name]] if name in INTERNED_FIELDS
+            else map(bool, self.columns[name]) if name in BOOL_FIELDS
+            else self.columns[name]
+            for name in COMMON_FIELDS
+        ]
+        classes = self.classes
+        for code, common, extra in zip(self.class_codes, zip(*columns), self.extras):
+            yield classes[code](*common, *extra)
+
+    def column(self, name) -> array | list:
+        """
+        读取一列，不创建Message
+        @param name: Message基类的字段名
+        @return: 数字字段返回array（或list），字符串字段返回list
+        """
+        if name in INTERNED_FIELDS:
+            strings = self.strings.values
+            return [strings[code] for code in self.columns[name]]
+        if name in BOOL_FIELDS:
+            return [bool(value) for value in self.columns[name]]
+        return self.columns[name]
+
+    def codes(self, name) -> Tuple[List[str], array]:
+        """
+        字符串字段的字符串表和下标，按发送者等分组统计时不需要比较字符串
+        @param name: talker_id/sender_id/display_name/avatar_src
+        @return: (字符串表, 下标)
+        """
+        return self.strings.values, self.columns[name]
+
+    def value_counts(self, name) -> Counter:
+        """
+        @param name: Message基类的字段名
+        @return: {值: 消息数量}
+        """
+        if name in INTERNED_FIELDS:
+            strings = self.strings.values
+            return Counter({strings[code]: count for code, count in Counter(self.columns[name]).items()})
+        return Counter(self.column(name))
+
+    def rows(self, *names) -> Iterator[tuple]:
+        """
+        按行读取几个基类字段，不创建Message
+        @param names:
+        @return:
+        """
+        return zip(*[self.column(name) for name in names])
+
+    def take(self, indexes: Iterable[int]) -> 'MessageBatch':
+        """
+        @param indexes: 消息下标
+        @return: 只包含这些消息的新批次（共用字符串表）
+        """
+        batch = MessageBatch(self.strings)
+        for name, column in self.columns.items():
+            batch.columns[name] = type(column)(column.typecode) if isinstance(column, array) else []
+        batch.classes = list(self.classes)
+        for index in indexes:
+            for name, column in self.columns.items():
+                batch.columns[name].append(column[index])
+            batch.class_codes.append(self.class_codes[index])
+            batch.extras.append(self.extras[index])
+        return batch
+
+    def filter_types(self, types) -> 'MessageBatch':
+        types = set(types)
+        return self.take(index for index, type_ in enumerate(self.columns['type']) if type_ in types)
+
+    def to_list(self) -> List[Message]:
+        return list(self)
+
+
+if __name__ == '__main__':
+    import pickle
+    import time
+    import tracemalloc
+
+    from wxManager.model import LinkMessage, MessageType, TextMessage
+
+    def make_messages(n=200000):
+        messages = []
+        for i in range(n):
+            common = dict(
+                local_id=i, server_id=10 ** 18 + i, sort_seq=i * 1000, timestamp=1700000000 + i,
+                str_time=f'2023-11-15 06:{i % 60:02d}:{i % 59:02d}', talker_id=''.join(['123', '@chatroom']),
+                is_sender=i % 3 == 0, sender_id=f'wxid_{i % 50}', display_name=f'群成员{i % 50}',
+                avatar_src=f'https://wx.qlogo.cn/mmhead/{i % 50}/132', status=2, xml_content='',
+            )
+            if i % 4:
+                messages.append(TextMessage(type=MessageType.Text, content=f'今天晚上一起吃饭吗？第{i}条消息', **common))
+            else:
+                messages.append(LinkMessage(
+                    type=MessageType.LinkMessage, href=f'https://mp.weixin.qq.com/s/{i}', title=f'标题{i}',
+                    description='描述', cover_path='', cover_url='', app_name='', app_icon='', app_id='', **common
+                ))
+        return messages
+
+    tracemalloc.start()
+    messages = make_messages()
+    list_size = tracemalloc.get_traced_memory()[0]
+    batch = MessageBatch.from_messages(messages)
+    del messages
+    batch_size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    # tracemalloc会拖慢内存分配，耗时单独测
+    messages = make_messages()
+    st = time.perf_counter()
+    MessageBatch.from_messages(messages)
+    t_build = time.perf_counter() - st
+    expected = [message.to_json() for message in messages]
+
+    st = time.perf_counter()
+    restored = list(batch)
+    t_iter = time.perf_counter() - st
+    assert [message.to_json() for message in restored] == expected
+    assert [message.to_json() for message in pickle.loads(pickle.dumps(batch))] == expected
+    assert batch[-1].to_json() == expected[-1] and len(batch[10:20]) == 10
+    st = time.perf_counter()
+    top = batch.value_counts('sender_id').most_common(3)
+    t_count = time.perf_counter() - st
+    print(f'{len(batch)}条消息：Message列表 {list_size / 1024 ** 2:.1f}MB，MessageBatch {batch_size / 1024 ** 2:.1f}MB，'
+          f'构建{t_build:.2f}s，遍历{t_iter:.2f}s，按发送者计数{t_count:.3f}s {top}')
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2026/10/19 22:10
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-query.py
+@Description : 消息查询条件，由数据库层翻译成每个分库的SQL条件和查询列，解析前就过滤掉不需要的消息
+"""
+from dataclasses import dataclass
+from datetime import date
+from typing import Set, Tuple, Optional
+
+from .message import MessageType, Message
+
+# 解析后的消息类型 -> 可能产生该类型的原始类型（FACTORY_REGISTRY的键）
+# 例如LinkMessageFactory会把LinkMessage2/4/5/6都解析成LinkMessage，FavNote在v4里被解析成Pat
+SOURCE_TYPES = {
+    MessageType.Text: {MessageType.Text, MessageType.Text2},
+    MessageType.LinkMessage: {
+        MessageType.LinkMessage, MessageType.LinkMessage2, MessageType.LinkMessage4,
+        MessageType.LinkMessage5, MessageType.LinkMessage6
+    },
+    MessageType.Applet: {MessageType.Applet, MessageType.Applet2},
+    MessageType.BusinessCard: {MessageType.BusinessCard, MessageType.OpenIMBCard},
+    MessageType.Pat: {MessageType.Pat, MessageType.FavNote},
+}
+
+
+@dataclass
+class MessageQuery:
+    """
+    get_messages的查询条件，所有条件都为空时等价于获取全部消息
+    """
+    types: Optional[Set[int]] = None  # 需要的消息类型（解析后的MessageType）
+    senders: Optional[Set[str]] = None  # 需要的发送者wxid（群聊成员筛选）
+    time_range: Optional[Tuple[int | float | str | date, int | float | str | date]] = None
+    need_payload: bool = True  # 是否需要图片/视频xml、packed_info_data等只用于定位媒体文件的数据
+    lazy: bool = False  # 返回LazyMessage，消息内容、路径等字段访问时才解析
+
+    def source_types(self) -> Optional[Set[int]]:
+        """
+        需要从数据库读取的原始消息类型
+        @return: 原始类型集合，None表示不能在SQL里按类型过滤
+        """
+        if not self.types or MessageType.Unknown in self.types:
+            # 未知类型可能来自任何未注册的原始类型
+            return None
+        result = set()
+        for type_ in self.types:
+            result |= SOURCE_TYPES.get(type_, {type_})
+        return result
+
+    def match(self, message: Message) -> bool:
+        """
+        解析后的精确筛选，SQL条件是它的超集
+        @param message:
+        @return:
+        """
+        if self.types and message.type not in self.types:
+            return False
+        if self.senders and message.sender_id not in self.senders:
+            return False
+        return True
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2026/10/20 0:50
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-page_cache.py
+@Description : 聊天界面分页缓存，缓存解析后的消息页，并在后台预取上一页（更早的消息）
+"""
+import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Callable, Dict, List, Tuple
+
+from wxManager.log import logger
+
+
+class MessagePageCache:
+    """
+    缓存 get_messages_by_num 的结果
+    - 键：(talker, start_sort_seq, msg_num)，值：(messages, 下一页的start_sort_seq)
+    - 缓存的消息总数超过max_messages时淘汰最久未使用的页（页的大小由调用者决定，按页数限制不住内存）
+    - 每次返回一页后，在后台线程加载下一页（更早的消息）
+    """
+
+    def __init__(self, loader: Callable[[str, int, int], Tuple[List, int]], max_messages=5000, prefetch=True):
+        """
+        @param loader: loader(talker, start_sort_seq, msg_num) -> (messages, 下一页的start_sort_seq)
+        @param max_messages: 最多缓存的消息条数
+        @param prefetch: 是否预取下一页
+        """
+        self.loader = loader
+        self.max_messages = max_messages
+        self.prefetch = prefetch
+        self.pages: OrderedDict = OrderedDict()
+        self.message_count = 0  # pages中的消息总数
+        self.pending: Dict[tuple, Future] = {}  # 正在预取的页
+        self.lock = threading.Lock()
+        # 加载过程串行，前台请求和后台预取不会重复加载同一页（解析器的缓存每个线程一份，互不影响）
+        self.load_lock = threading.Lock()
+        # 每次invalidate加1，加载开始后缓存被清除过的页不再写入缓存
+        self.generation = 0
+        self.executor = None
+        self.hits = 0
+        self.misses = 0
+        self.prefetches = 0
+
+    def _load(self, key):
+        with self.load_lock:
+            with self.lock:
+                if key in self.pages:
+                    return self.pages[key]
+                generation = self.generation
+            page = self.loader(*key)
+        self._put(key, page, generation)
+        return page
+
+    def _put(self, key, page, generation):
+        with self.lock:
+            if generation != self.generation:
+                # 加载期间数据库发生了变化，这一页可能已经过时
+                return
+            old_page = self.pages.pop(key, None)
+            if old_page is not None:
+                self.message_count -= len(old_page[0])
+            self.pages[key] = page
+            self.message_count += len(page[0])
+            # 至少保留刚放入的这一页
+            while self.message_count > self.max_messages and len(self.pages) > 1:
+                _, (messages, _) = self.pages.popitem(last=False)
+                self.message_count -= len(messages)
+
+    def _prefetch(self, talker, start_sort_seq, msg_num):
+        if not self.prefetch or not start_sort_seq:
+            return
+        key = (talker, start_sort_seq, msg_num)
+        with self.lock:
+            if key in self.pages or key in self.pending:
+                return
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='page_prefetch')
+            future = self.executor.submit(self._load, key)
+            self.pending[key] = future
+            self.prefetches += 1
+        future.add_done_callback(lambda f: self._prefetch_done(key, f))
+
+    def _prefetch_done(self, key, future):
+        with self.lock:
+            # invalidate之后同一页可能已经重新开始预取
+            if self.pending.get(key) is future:
+                del self.pending[key]
+        if future.cancelled():
+            return
+        if future.exception():
+            logger.error(f'预取聊天记录失败：{key}\n{"".join(traceback.format_exception(future.exception()))}')
+
+    def get(self, talker, start_sort_seq, msg_num=20) -> Tuple[List, int]:
+        """
+        获取小于start_sort_seq的msg_num个消息
+        @param talker:
+        @param start_sort_seq:
+        @param msg_num:
+        @return: messages, 最后一条消息的start_sort_seq
+        """
+        key = (talker, start_sort_seq, msg_num)
+        with self.lock:
+            page = self.pages.get(key)
+            future = self.pending.get(key)
+            if page is not None:
+                self.pages.move_to_end(key)
+                self.hits += 1
+            elif future is not None:
+                # 正在预取，等待结果即可
+                self.hits += 1
+            else:
+                self.misses += 1
+        if page is None:
+            if future is not None:
+                try:
+                    page = future.result()
+                except Exception:
+                    page = self._load(key)
+            else:
+                page = self._load(key)
+        messages, next_sort_seq = page
+        if len(messages) == msg_num:
+            # 还有更早的消息
+            self._prefetch(talker, next_sort_seq, msg_num)
+        return list(messages), next_sort_seq
+
+    def invalidate(self, talker=None):
+        """
+        清除缓存，数据库合并了新消息后需要调用
+        @param talker: 只清除某个聊天对象的缓存，None表示全部
+        @return:
+        """
+        with self.lock:
+            self.generation += 1
+            if talker is None:
+                self.pages.clear()
+                self.pending.clear()
+                self.message_count = 0
+            else:
+                for key in [key for key in self.pages if key[0] == talker]:
+                    self.message_count -= len(self.pages.pop(key)[0])
+                for key in [key for key in self.pending if key[0] == talker]:
+                    del self.pending[key]
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'prefetches': self.prefetches,
+                'hit_rate': self.hits / total if total else 0,
+                'pages': len(self.pages),
+                'messages': self.message_count,
+            }
+
+    def close(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+        self.invalidate()
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2026/10/20 5:30
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-parse_pool.py
+@Description : 常驻的消息解析进程池
+               - 每个数据库目录一个进程池，工作进程只在启动时打开一次数据库，之后一直复用联系人、解压器、hardlink等缓存
+               - 解析结果按列打包后传回主进程，不再逐个pickle消息对象
+"""
+import atexit
+import math
+import os
+import pickle
+import threading
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import fields
+from itertools import islice
+from operator import attrgetter
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+from wxManager.log import logger
+
+# 消息数量达到这个值才使用多进程解析
+PARALLEL_THRESHOLD = 10000
+# 每个任务最多包含的消息数量
+BATCH_SIZE = 5000
+MAX_WORKERS = min(os.cpu_count() or 1, 8)
+# 不同取值不超过总数的这个比例时，字符串列用字符串表+下标表示
+STRING_TABLE_RATIO = 0.5
+
+
+def _pack_column(values: list):
+    # 发送者、头像、类型名等重复很多的字符串只传一次
+    if len(values) >= 16 and all(type(value) is str for value in values):
+        table: Dict[str, int] = {}
+        indexes = [table.setdefault(value, len(table)) for value in values]
+        if len(table) <= len(values) * STRING_TABLE_RATIO:
+            return 's', list(table), array('I', indexes)
+    return 'v', values
+
+
+def _unpack_column(column) -> list:
+    if column[0] == 's':
+        table = column[1]
+        return [table[index] for index in column[2]]
+    return column[1]
+
+
+_fields: Dict[type, tuple] = {}
+
+
+def _field_names(cls) -> tuple:
+    names = _fields.get(cls)
+    if names is None:
+        names = _fields[cls] = tuple(field.name for field in fields(cls))
+    return names
+
+
+def pack_messages(messages: List) -> tuple:
+    """
+    消息按类型分组，每组按列保存（消息类没有__dict__，按dataclass字段读取）
+    @param messages: Message列表
+    @return: (分组信息[(cls, 列数据)], 每条消息所属分组的下标)
+    """
+    groups: Dict[type, int] = {}
+    rows: List[list] = []
+    order = array('H')
+    for message in messages:
+        cls = type(message)
+        index = groups.get(cls)
+        if index is None:
+            index = groups[cls] = len(rows)
+            rows.append([])
+        rows[index].append(message)
+        order.append(index)
+    packed_groups = []
+    for cls, group in zip(groups, rows):
+        values = zip(*map(attrgetter(*_field_names(cls)), group))
+        packed_groups.append((cls, [_pack_column(list(column)) for column in values]))
+    return packed_groups, order
+
+
+def unpack_messages(packed: tuple) -> List:
+    """
+    pack_messages的逆过程，消息顺序不变
+    @param packed:
+    @return:
+    """
+    packed_groups, order = packed
+    iterators = []
+    for cls, columns in packed_groups:
+        iterators.append(iter([cls(*values) for values in zip(*[_unpack_column(column) for column in columns])]))
+    return [next(iterators[index]) for index in order]
+
+
+def _init_worker(db_dir, db_version):
+    # 工作进程启动时打开一次数据库，后续任务复用
+    from wxManager import database_registry
+    database_registry.get(db_dir, db_version)
+
+
+def _parse_batch(rows, username, db_dir, db_version) -> tuple:
+    if db_version == 3:
+        from wxManager.manager_v3 import parser_messages
+    else:
+        from wxManager.manager_v4 import parser_messages
+    messages = list(parser_messages(rows, username, db_dir, deferred=True))
+    return pack_messages(messages)
+
+
+def iter_batches(rows: Iterable, size) -> Iterator[list]:
+    """
+    把行迭代器切成每批size条
+    @param rows:
+    @param size:
+    @return:
+    """
+    iterator = iter(rows)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def split_list(lst, n):
+    k, m = divmod(len(lst), n)
+    return [lst[i * k + min(i, m):(i + 1) * k + min(i + 1, m)] for i in range(n)]
+
+
+class ParserPool:
+    def __init__(self, db_dir, db_version=4, max_workers=MAX_WORKERS):
+        self.db_dir = db_dir
+        self.db_version = db_version
+        self.max_workers = max_workers
+        self.executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_init_worker,
+            initargs=(db_dir, db_version)
+        )
+
+    def parse(self, rows: list, username) -> List:
+        """
+        @param rows: 数据库中读出的原始消息
+        @param username: 会话
+        @return: 解析后的消息（顺序与rows一致）
+        """
+        n = max(self.max_workers, math.ceil(len(rows) / BATCH_SIZE))
+        futures = [
+            self.executor.submit(_parse_batch, batch, username, self.db_dir, self.db_version)
+            for batch in split_list(rows, n) if batch
+        ]
+        result = []
+        for future in futures:
+            result.extend(unpack_messages(future.result()))
+        return result
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait, cancel_futures=True)
+
+
+_pools: Dict[Tuple[str, int], ParserPool] = {}
+_lock = threading.Lock()
+
+
+def get_parser_pool(db_dir, db_version=4) -> ParserPool:
+    key = (os.path.abspath(db_dir), db_version)
+    with _lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ParserPool(db_dir, db_version)
+        return pool
+
+
+def shutdown_parser_pools(db_dir=None, db_version=None):
+    """
+    关闭进程池，数据库关闭或合并后调用，工作进程里打开的数据库随之关闭
+    @param db_dir: None表示全部
+    @param db_version:
+    @return:
+    """
+    with _lock:
+        keys = [
+            key for key in _pools
+            if db_dir is None or key[0] == os.path.abspath(db_dir) and (db_version is None or key[1] == db_version)
+        ]
+        pools = [_pools.pop(key) for key in keys]
+    for pool in pools:
+        pool.shutdown()
+
+
+def parse_in_pool(rows: list, username, db_dir, db_version, parse_serial) -> List:
+    """
+    消息足够多并且有多个CPU时交给进程池解析，否则（或进程池异常退出时）在当前进程解析
+    @param rows: 数据库中读出的原始消息
+    @param username:
+    @param db_dir:
+    @param db_version: 3或4
+    @param parse_serial: 当前进程解析的函数 rows -> List[Message]
+    @return:
+    """
+    if len(rows) < PARALLEL_THRESHOLD or MAX_WORKERS < 2:
+        return parse_serial(rows)
+    try:
+        return get_parser_pool(db_dir, db_version).parse(rows, username)
+    except BrokenProcessPool:
+        logger.error('解析进程异常退出，改为在当前进程解析')
+        shutdown_parser_pools(db_dir, db_version)
+        return parse_serial(rows)
+
+
+atexit.register(shutdown_parser_pools)
+if hasattr(os, 'register_at_fork'):
+    # 子进程不能使用父进程的进程池
+    os.register_at_fork(after_in_child=_pools.clear)
+
+if __name__ == '__main__':
+    import time
+
+    from wxManager.model import LinkMessage, MessageType, TextMessage
+
+    messages = []
+    for i in range(20000):
+        common = dict(
+            local_id=i, server_id=10 ** 18 + i, sort_seq=i * 1000, timestamp=1700000000 + i,
+            str_time=f'2023-11-15 06:{i % 60:02d}:00', talker_id='123@chatroom', is_sender=i % 3 == 0,
+            sender_id=f'wxid_{i % 50}', display_name=f'群成员{i % 50}',
+            avatar_src=f'https://wx.qlogo.cn/mmhead/{i % 50}/132', status=2, xml_content='',
+        )
+        if i % 4:
+            messages.append(TextMessage(type=MessageType.Text, content=f'今天晚上一起吃饭吗？第{i}条消息', **common))
+        else:
+            messages.append(LinkMessage(
+                type=MessageType.LinkMessage, href=f'https://mp.weixin.qq.com/s/{i}', title=f'标题{i}',
+                description='描述' * 20, cover_path='', cover_url=f'https://mmbiz.qpic.cn/{i}.jpg',
+                app_name='', app_icon='', app_id='', **common
+            ))
+
+    def best_of(func, repeat=5):
+        result, best = None, float('inf')
+        for _ in range(repeat):
+            st = time.perf_counter()
+            result = func()
+            best = min(best, time.perf_counter() - st)
+        return result, best
+
+    data, t_dump = best_of(lambda: pickle.dumps(messages, pickle.HIGHEST_PROTOCOL))
+    _, t_load = best_of(lambda: pickle.loads(data))
+    packed_data, t_pack = best_of(lambda: pickle.dumps(pack_messages(messages), pickle.HIGHEST_PROTOCOL))
+    restored, t_unpack = best_of(lambda: unpack_messages(pickle.loads(packed_data)))
+    assert [message.to_json() for message in restored] == [message.to_json() for message in messages]
+    assert [type(message) for message in restored] == [type(message) for message in messages]
+    print(f'{len(messages)}条消息：pickle {len(data) / 1024:.0f}KB 序列化{t_dump:.3f}s 反序列化{t_load:.3f}s；'
+          f'按列打包 {len(packed_data) / 1024:.0f}KB 序列化{t_pack:.3f}s 反序列化{t_unpack:.3f}s')
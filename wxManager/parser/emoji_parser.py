@@ -12,12 +12,13 @@ import base64
 import traceback
 
 import xmltodict
-from google.protobuf.json_format import MessageToDict
 
 from wxManager.log import logger
-from wxManager.parser.util.protocbuf import emoji_desc_pb2
+from wxManager.parser.payload_cache import memoize_payload
+from wxManager.parser.util.proto_fields import emoji_desc
 
 
+@memoize_payload
 def parser_emoji(xml_content):
     result = {
         'md5': 0,
@@ -40,14 +41,7 @@ def parser_emoji(xml_content):
         if desc_bs64:
             # 逆天微信，竟然把protobuf数据用base64编码后放入xml里
             desc_bytes_proto = base64.b64decode(desc_bs64)
-            message = emoji_desc_pb2.EmojiDescData()
-            # 解析二进制数据
-            message.ParseFromString(desc_bytes_proto)
-            dict_output = MessageToDict(message)
-            for item in dict_output.get('descItem', []):
-                desc = item.get('desc', '')
-                if desc:
-                    break
+            desc = emoji_desc(desc_bytes_proto)
         result = {
             'md5': md5,
             'url': emoji_dic.get('@cdnurl', ''),
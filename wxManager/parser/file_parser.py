@@ -38,6 +38,9 @@ def parse_video(xml_content):
     result = {
         'md5': 0
     }
+    if not xml_content:
+        # 查询时没有读取视频xml（MessageQuery.need_payload=False）
+        return result
     xml_content = xml_content.strip()
     try:
         xml_dict = xmltodict.parse(xml_content)
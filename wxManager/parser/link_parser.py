@@ -18,8 +18,40 @@ import xmltodict
 
 from wxManager.log import logger
 from wxManager.model import *
+from wxManager.parser.payload_cache import memoize_payload
+from wxManager.parser.xml_fields import compile_fields, fast_path, Fallback, MISSING
 
 
+# 各类消息的字段声明，取值规则与下面原解析函数中 xmltodict 的 .get 链一致
+_link_fields = compile_fields('msg', {
+    'title': 'appmsg/title',
+    'desc': 'appmsg/des',
+    'url': 'appmsg/url',
+    'thumburl': 'appmsg/thumburl',
+    'songalbumurl': 'appmsg/songalbumurl',
+    'sourcedisplayname': 'appmsg/sourcedisplayname',
+    'appname': 'appinfo/appname',
+    'appid': 'appmsg/@appid',
+    'sourceusername': 'appmsg/sourceusername',
+})
+
+
+def _fast_link(xml_content):
+    data = _link_fields(xml_content.strip())
+    return {
+        'title': data['title'],
+        'desc': data['desc'],
+        'url': data['url'],
+        'cover_url': data['thumburl'] or data['songalbumurl'],
+        'sourcedisplayname': data['sourcedisplayname'],
+        'appname': data['appname'],
+        'appid': data['appid'],
+        'sourceusername': data['sourceusername'],
+    }
+
+
+@memoize_payload
+@fast_path(_fast_link)
 def parser_link(xml_content):
     result = {
         'title': '',
@@ -55,6 +87,33 @@ def parser_link(xml_content):
         return result
 
 
+_voip_fields = compile_fields('voipdata', {
+    'type': ('voipmsg/@type', None),
+    'bubble_msg': 'voipmsg/VoIPBubbleMsg/msg',
+    'invite_type': ('voipinvitemsg/invite_type', '0'),
+    'duration': ('voiplocalinfo/duration', '0'),
+    'display_content': 'voiplocalinfo/diaplay_content',
+})
+
+
+def _fast_voip(xml_content):
+    if not xml_content:
+        raise Fallback()
+    data = _voip_fields(f'<voipdata>{xml_content.strip()}</voipdata>')
+    if data['type'] == 'VoIPBubbleMsg':
+        return {
+            'invite_type': -1,
+            'duration': 0,
+            'display_content': data['bubble_msg']
+        }
+    return {
+        'invite_type': int(data['invite_type']),
+        'duration': data['duration'],
+        'display_content': data['display_content']
+    }
+
+
+@fast_path(_fast_voip)
 def parser_voip(xml_content):
     result = {
         'invite_type': 0,
@@ -87,6 +146,38 @@ def parser_voip(xml_content):
         return result
 
 
+_applet_fields = compile_fields('msg', {
+    'title': 'appmsg/title',
+    'desc': 'appmsg/des',
+    'url': 'appmsg/url',
+    'appname': 'appmsg/sourcedisplayname',
+    'appid': 'appmsg/weappinfo/@appid',
+    'app_icon': 'appmsg/weappinfo/weappiconurl',
+    'thumb_url': 'appmsg/weappinfo/weapppagethumbrawurl',
+    'page_path': 'appmsg/weappinfo/pagepath',
+})
+
+
+def _fast_applet(xml_content):
+    data = _applet_fields(xml_content.strip())
+    cover_url = data['thumb_url']
+    if not cover_url:
+        for part in data['page_path'].split('&'):
+            if part.startswith('cover='):
+                cover_url = part.split('=')[1]
+    return {
+        'title': data['title'],
+        'desc': data['desc'],
+        'url': data['url'],
+        'appname': data['appname'],
+        'appid': data['appid'],
+        'app_icon': data['app_icon'],
+        'cover_url': cover_url,
+    }
+
+
+@memoize_payload
+@fast_path(_fast_applet)
 def parser_applet(xml_content):
     result = {
         'title': '',
@@ -128,6 +219,7 @@ def parser_applet(xml_content):
         return result
 
 
+@memoize_payload
 def parser_music(xml_content):
     if not xml_content:
         return {"type": 3, "title": "发生错误", "is_error": True}
@@ -163,6 +255,29 @@ def parser_music(xml_content):
         return {"type": 3, "title": "发生错误", "is_error": True}
 
 
+_business_fields = compile_fields('msg', {
+    'bigheadimgurl': ('@bigheadimgurl', None),
+    'smallheadimgurl': ('@smallheadimgurl', None),
+    'username': ('@username', None),
+    'nickname': ('@nickname', None),
+    'alias': ('@alias', None),
+    'province': ('@province', None),
+    'city': ('@city', None),
+    'sex': '@sex',
+    'sign': ('@sign', None),
+    'openimdesc': ('@openimdesc', None),
+    'openimdescicon': ('@openimdescicon', None),
+})
+
+
+def _fast_business(xml_content):
+    data = _business_fields(xml_content.strip().replace('&', '&amp;'))
+    data['sex'] = int(data['sex'])
+    return data
+
+
+@memoize_payload
+@fast_path(_fast_business)
 def parser_business(xml_content):
     result = {
         'bigheadimgurl': '',  # 头像原图
@@ -522,7 +637,25 @@ def parser_record_item(recorditem, output_dir, wxid, msg_time, level=0):
     return result
 
 
-def parser_merged_messages(xml, output_dir, wxid, msg_time, level=0):
+_merged_messages_fields = compile_fields('msg', {
+    'title': 'appmsg/title',
+    'desc': 'appmsg/des',
+    'recorditem': 'appmsg/recorditem',
+})
+
+
+def _fast_merged_messages(xml, output_dir='', wxid='', msg_time=0, level=0):
+    # 只替换外层appmsg的解析，recorditem（CDATA中的xml）仍然交给parser_record_item
+    data = _merged_messages_fields(xml)
+    return {
+        'title': data['title'],
+        'desc': data['desc'],
+        'messages': parser_record_item(data['recorditem'], output_dir, wxid, msg_time, level),
+    }
+
+
+@fast_path(_fast_merged_messages)
+def parser_merged_messages(xml, output_dir='', wxid='', msg_time=0, level=0):
     try:
         try:
             data_dic = xmltodict.parse(xml).get('msg', {})
@@ -554,6 +687,39 @@ def parser_merged_messages(xml, output_dir, wxid, msg_time, level=0):
         }
 
 
+_wechat_video_fields = compile_fields('msg', {
+    'sourcedisplayname': 'appmsg/finderFeed/nickname',
+    'weappiconurl': 'appmsg/finderFeed/avatar',
+    'authIconUrl': 'appmsg/finderFeed/authIconUrl',
+    'title': 'appmsg/finderFeed/desc',
+    'media_count': ('appmsg/finderFeed/mediaCount', '0'),
+})
+_wechat_video_media_fields = compile_fields('msg', {
+    'cover': 'appmsg/finderFeed/mediaList/media/coverUrl',
+    'duration': ('appmsg/finderFeed/mediaList/media/videoPlayDuration', 0),
+})
+
+
+def _fast_wechat_video(xml_content):
+    xml_content = xml_content.strip()
+    data = _wechat_video_fields(xml_content)
+    if data['media_count'] not in ('0', '1'):
+        # 多个media时是list；空节点、不是数字时原函数的比较会出错，都交给原函数
+        raise Fallback()
+    media = _wechat_video_media_fields(xml_content)
+    return {
+        'title': data['title'],
+        'url': '',
+        'sourcedisplayname': data['sourcedisplayname'],
+        'weappiconurl': data['weappiconurl'],
+        'cover': media['cover'],
+        'authIconUrl': data['authIconUrl'],
+        'duration': media['duration']
+    }
+
+
+@memoize_payload
+@fast_path(_fast_wechat_video)
 def parser_wechat_video(xml_content):
     result = {
         'appid': '',  # 暂时不用
@@ -593,6 +759,21 @@ def parser_wechat_video(xml_content):
         return result
 
 
+_position_fields = compile_fields('msg', {
+    'x': ('location/@x', MISSING),
+    'y': ('location/@y', MISSING),
+    'label': ('location/@label', None),
+    'poiname': ('location/@poiname', None),
+    'scale': ('location/@scale', None),
+})
+
+
+def _fast_position(xml_content):
+    return _position_fields(xml_content)
+
+
+@memoize_payload
+@fast_path(_fast_position)
 def parser_position(xml_content):
     result = {
         'x': '0',  # 经度
@@ -622,6 +803,22 @@ def parser_position(xml_content):
         return result
 
 
+_reply_fields = compile_fields('msg', {
+    'text': 'appmsg/title',
+    'svrid': ('appmsg/refermsg/svrid', 0),
+    'refermsg_type': ('appmsg/refermsg/type', '1'),
+})
+
+
+def _fast_reply(xml_content):
+    if not xml_content:
+        raise Fallback()
+    data = _reply_fields(xml_content.replace("&#01;", "").replace('&#20;', ''))
+    data['refermsg_type'] = int(data['refermsg_type'])
+    return data
+
+
+@fast_path(_fast_reply)
 def parser_reply(xml_content):
     """
     @param data:
@@ -757,6 +954,21 @@ def parser_reply(xml_content):
         }
 
 
+_transfer_fields = compile_fields('msg', {
+    'pay_subtype': ('appmsg/wcpayinfo/paysubtype', '-1'),
+    'pay_memo': 'appmsg/wcpayinfo/pay_memo',
+    'fee_desc': 'appmsg/wcpayinfo/feedesc',
+    'receiver_username': 'appmsg/wcpayinfo/receiver_username',
+})
+
+
+def _fast_transfer(xml_content):
+    data = _transfer_fields(xml_content)
+    data['pay_subtype'] = int(data['pay_subtype'])
+    return data
+
+
+@fast_path(_fast_transfer)
 def parser_transfer(xml_content):
     result = {
         'pay_subtype': 0,
@@ -784,6 +996,20 @@ def parser_transfer(xml_content):
         return result
 
 
+_red_envelop_fields = compile_fields('msg', {
+    'icon_url': 'appmsg/wcpayinfo/iconurl',
+    'title': 'appmsg/wcpayinfo/receivertitle',
+    'inner_type': ('appmsg/wcpayinfo/innertype', '0'),
+})
+
+
+def _fast_red_envelop(xml_content):
+    data = _red_envelop_fields(xml_content)
+    data['inner_type'] = int(data['inner_type'])
+    return data
+
+
+@fast_path(_fast_red_envelop)
 def parser_red_envelop(xml_content):
     result = {
         'icon_url': '',
@@ -809,6 +1035,23 @@ def parser_red_envelop(xml_content):
         return result
 
 
+_file_fields = compile_fields('msg', {
+    'file_name': 'appmsg/title',
+    'file_size': ('appmsg/appattach/totallen', None),
+    'md5': 'appmsg/md5',
+    'file_type': 'appmsg/appattach/fileext',
+    'app_name': 'appmsg/appinfo/appname',
+})
+
+
+def _fast_file(xml_content):
+    data = _file_fields(xml_content)
+    data['file_size'] = int(data['file_size'] or '0')
+    return data
+
+
+@memoize_payload
+@fast_path(_fast_file)
 def parser_file(xml_content):
     result = {
         'file_name': '',
@@ -863,6 +1106,20 @@ def parser_favorite_note(xml_content):
         return result
 
 
+_pat_fields = compile_fields('msg', {
+    'title': 'appmsg/title',
+    'from_username': 'appmsg/patinfo/fromusername',
+    'patted_username': 'appmsg/patinfo/pattedusername',
+    'chat_username': 'appmsg/patinfo/chatusername',
+    'template': 'appmsg/patinfo/template',
+})
+
+
+def _fast_pat(xml_content):
+    return _pat_fields(xml_content)
+
+
+@fast_path(_fast_pat)
 def parser_pat(xml_content):
     result = {
         'title': '',
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2026/10/20 6:10
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-payload_cache.py
+@Description : 重复出现的消息内容只解析一次
+               群聊里同一个链接、表情、小程序、名片经常被转发成百上千次，xml完全相同
+               按xml内容的哈希缓存解析结果（每个进程一个有上限的LRU），结果是只读的MappingProxyType，多条消息共享同一个对象
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import wraps
+from types import MappingProxyType
+from typing import Callable, Dict
+
+# 每个解析函数最多缓存的结果数量
+MAX_ENTRIES = 4096
+# 只缓存值都是不可变类型的结果，xmltodict解析出的dict/list等不缓存，避免被调用者修改后影响其他消息
+IMMUTABLE_TYPES = (str, int, float, bool, bytes, type(None))
+
+
+class PayloadCacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.uncacheable = 0
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
+
+    def to_json(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'uncacheable': self.uncacheable,
+            'hit_rate': self.hit_rate(),
+        }
+
+
+class PayloadCache:
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries: OrderedDict[bytes, MappingProxyType] = OrderedDict()
+        self.stats = PayloadCacheStats()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(payload) -> bytes:
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8', 'surrogatepass')
+        return hashlib.blake2b(payload, digest_size=16).digest()
+
+    def get(self, key):
+        with self.lock:
+            result = self.entries.get(key)
+            if result is None:
+                self.stats.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats.hits += 1
+            return result
+
+    def put(self, key, result):
+        with self.lock:
+            self.entries[key] = result
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.stats.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.stats = PayloadCacheStats()
+
+
+_caches: Dict[str, PayloadCache] = {}
+
+
+def memoize_payload(func: Callable[[str], dict] = None, *, max_entries=MAX_ENTRIES):
+    """
+    按第一个参数（xml内容）缓存解析结果，只用于结果只取决于xml内容的解析函数
+    缓存前的函数保存在 wrapper.uncached，缓存对象保存在 wrapper.cache
+    @param func:
+    @param max_entries:
+    @return:
+    """
+
+    def decorator(func):
+        cache = _caches[func.__name__] = PayloadCache(max_entries)
+
+        @wraps(func)
+        def wrapper(payload):
+            if not payload or not isinstance(payload, (str, bytes)):
+                return func(payload)
+            key = cache.key(payload)
+            result = cache.get(key)
+            if result is not None:
+                return result
+            result = func(payload)
+            if isinstance(result, dict) and all(isinstance(value, IMMUTABLE_TYPES) for value in result.values()):
+                result = MappingProxyType(result)
+                cache.put(key, result)
+            else:
+                cache.stats.uncacheable += 1
+            return result
+
+        wrapper.uncached = func
+        wrapper.cache = cache
+        return wrapper
+
+    return decorator(func) if func is not None else decorator
+
+
+def payload_cache_stats() -> Dict[str, dict]:
+    """
+    @return: {解析函数名: {'hits', 'misses', 'evictions', 'uncacheable', 'hit_rate'}}
+    """
+    return {name: cache.stats.to_json() for name, cache in _caches.items()}
+
+
+def clear_payload_caches():
+    for cache in _caches.values():
+        cache.clear()
+
+
+if __name__ == '__main__':
+    import random
+    import time
+
+    from wxManager.parser.emoji_parser import parser_emoji
+    from wxManager.parser.link_parser import parser_applet, parser_link
+
+    # 模拟群聊：少量热门内容被反复转发，混有一部分只出现一次的内容
+    random.seed(0)
+    padding = '<extinfo>' + 'x' * 1000 + '</extinfo>'
+    link_xml = ('<msg><appmsg appid="" sdkver="0"><title>标题{i}</title><des>描述{i}</des><type>5</type>'
+                '<url>https://mp.weixin.qq.com/s/{i}</url><thumburl>https://mmbiz.qpic.cn/{i}.jpg</thumburl>'
+                + padding + '</appmsg><appinfo><appname>公众号</appname></appinfo></msg>')
+    applet_xml = ('<msg><appmsg><title>小程序{i}</title><type>33</type><sourcedisplayname>小程序{i}</sourcedisplayname>'
+                  + padding + '<weappinfo><weappiconurl>https://wx.qlogo.cn/{i}</weappiconurl></weappinfo></appmsg></msg>')
+    emoji_xml = ('<msg><emoji fromusername="wxid_a" tousername="123@chatroom" type="2" md5="{i:032d}" '
+                 'cdnurl="http://wxapp.tc.qq.com/{i}" width="240" height="240" /></msg>')
+
+    def corpus(template, n=20000, hot=200):
+        return [template.format(i=random.randrange(hot) if random.random() < 0.9 else hot + k) for k in range(n)]
+
+    for func, template in ((parser_link, link_xml), (parser_applet, applet_xml), (parser_emoji, emoji_xml)):
+        data = corpus(template)
+        st = time.perf_counter()
+        expected = [func.uncached(xml) for xml in data]
+        t_uncached = time.perf_counter() - st
+        func.cache.clear()
+        st = time.perf_counter()
+        actual = [func(xml) for xml in data]
+        t_cached = time.perf_counter() - st
+        assert expected == actual
+        print(f'{func.__name__:<14} {len(data)}条：不缓存 {t_uncached:.3f}s，缓存 {t_cached:.3f}s '
+              f'（{t_uncached / t_cached:.1f}x，命中率{func.cache.stats.hit_rate():.0%}）')
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2026/10/20 2:30
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-reference.py
+@Description : 批量解析时延迟处理消息之间的引用
+               第一遍只记录引用消息的server_id，整批解析完后集中查询，第二遍回填
+               解析器的联系人、消息缓存和ReferenceResolver每个线程一份（ThreadLocalAttribute），后台预取、web请求同时解析时互不影响
+"""
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Tuple
+
+from wxManager.model import Message, MessageType, TextMessage
+
+
+def invalid_message(username) -> TextMessage:
+    # 找不到被引用的消息时使用
+    return TextMessage(
+        local_id=0,
+        server_id=0,
+        sort_seq=0,
+        timestamp=0,
+        str_time='',
+        type=MessageType.Text,
+        talker_id=username,
+        is_sender=False,
+        sender_id=username,
+        display_name=username,
+        avatar_src='',
+        status=0,
+        xml_content='',
+        content='无效的消息'
+    )
+
+
+def to_server_id(server_id) -> int:
+    if server_id and isinstance(server_id, str):
+        try:
+            return int(server_id)
+        except ValueError:
+            return 0
+    return server_id or 0
+
+
+class ThreadLocalAttribute:
+    """
+    每个线程一份的类属性，通过类和实例读写的都是当前线程的值
+    类属性直接赋值会覆盖这个描述符，需要修改时用set或者在实例上赋值
+    """
+
+    def __init__(self, factory: Callable = lambda: None):
+        """
+        @param factory: 线程第一次读取时创建初始值
+        """
+        self.factory = factory
+        self.local = threading.local()
+
+    def get(self):
+        try:
+            return self.local.value
+        except AttributeError:
+            value = self.local.value = self.factory()
+            return value
+
+    def set(self, value):
+        self.local.value = value
+
+    @contextmanager
+    def bind(self, value):
+        """
+        在with块中把当前线程的值替换为value，结束后恢复
+        @param value:
+        @return:
+        """
+        previous = self.get()
+        self.set(value)
+        try:
+            yield value
+        finally:
+            self.set(previous)
+
+    def __get__(self, instance, owner=None):
+        return self.get()
+
+    def __set__(self, instance, value):
+        self.set(value)
+
+
+class ReferenceResolver:
+    def __init__(self):
+        self.quotes: List[Tuple[Message, int]] = []  # [(引用消息, 被引用消息的server_id)]
+
+    def add_quote(self, message: Message, server_id):
+        self.quotes.append((message, to_server_id(server_id)))
+
+    def resolve(self, messages: List[Message], username, manager, cache=None):
+        """
+        @param messages: 本批解析出的消息，被引用的消息优先从这里找
+        @param username:
+        @param manager: DataBaseInterface
+        @param cache: 解析器缓存的消息 {server_id: Message}
+        @return:
+        """
+        self._resolve_quotes(messages, username, manager, cache)
+
+    def _resolve_quotes(self, messages, username, manager, cache):
+        if not self.quotes:
+            return
+        server_ids = {server_id for _, server_id in self.quotes if server_id}
+        found: Dict[int, Message] = {
+            message.server_id: message for message in messages if message.server_id in server_ids
+        }
+        if cache is not None:
+            for server_id in server_ids - found.keys():
+                if server_id in cache:
+                    found[server_id] = cache[server_id]
+        missing = server_ids - found.keys()
+        if missing:
+            # 剩下的一次批量查询
+            found.update(manager.get_messages_by_server_ids(username, list(missing)))
+        for message, server_id in self.quotes:
+            quote_message = found.get(server_id)
+            message.quote_message = quote_message if quote_message else invalid_message(username)
+        self.quotes = []
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2026/10/20 0:20
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-sql_functions.py
+@Description : 注册到消息分库连接上的SQLite函数，让解压、xml字段提取和文字提取在SQL里完成
+               wx_unzstd(blob)                   zstd解压，非压缩内容原样返回
+               wx_xml_text(xml, path)            xml节点文字，例如 wx_xml_text(content, 'appmsg/url')
+               wx_msg_text(type, content)        可检索的文字（文本、链接标题、文件名、引用内容）
+               wx_msg_text(type, content, wxid)  同上，先去掉群聊消息开头的 "<wxid>:"
+"""
+import sqlite3
+from functools import lru_cache
+
+import zstandard as zstd
+
+from wxManager.parser.text_parser import parse_xml, message_text
+from wxManager.parser.zstd_decompress import get_decompressor
+
+
+def wx_unzstd(data):
+    if not isinstance(data, bytes):
+        return data
+    try:
+        return get_decompressor().decompress(data).decode('utf-8', errors='ignore')
+    except zstd.ZstdError:
+        return None
+
+
+@lru_cache(maxsize=256)
+def _parse_xml(xml_content):
+    # 同一行经常会取多个字段（标题、链接、描述），缓存解析结果；只读使用，不会修改节点
+    return parse_xml(xml_content)
+
+
+def wx_xml_text(xml_content, path):
+    if isinstance(xml_content, bytes):
+        xml_content = wx_unzstd(xml_content)
+    if not xml_content or not path:
+        return None
+    root = _parse_xml(xml_content)
+    if root is None:
+        return None
+    return root.findtext(path)
+
+
+def wx_msg_text(local_type, content, sender=None):
+    if local_type is None:
+        return ''
+    if isinstance(content, bytes):
+        content = wx_unzstd(content)
+    if not content:
+        return ''
+    if sender and content.startswith(f'{sender}:'):
+        content = content[len(sender) + 1:].lstrip()
+    return message_text(local_type, content)
+
+
+def register_functions(db: sqlite3.Connection):
+    """
+    在数据库连接上注册函数（只对当前连接有效）
+    @param db:
+    @return:
+    """
+    db.create_function('wx_unzstd', 1, wx_unzstd, deterministic=True)
+    db.create_function('wx_xml_text', 2, wx_xml_text, deterministic=True)
+    db.create_function('wx_msg_text', 2, wx_msg_text, deterministic=True)
+    db.create_function('wx_msg_text', 3, wx_msg_text, deterministic=True)
+
+
+if __name__ == '__main__':
+    pass
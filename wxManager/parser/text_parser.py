@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2026/10/19 23:30
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-text_parser.py
+@Description : 从消息中提取可检索的文字（文本、链接标题、文件名、引用内容），不构造Message对象
+"""
+import lz4.block
+from lxml import etree
+
+TEXT_TYPE = 1  # 文本消息
+APP_MESSAGE_TYPE = 49  # 链接、文件、引用、小程序、聊天记录等xml消息的Type
+
+# <appmsg>中参与检索的字段
+APP_MESSAGE_PATHS = ('appmsg/title', 'appmsg/des', 'appmsg/refermsg/content')
+
+
+def decompress_lz4(data) -> str:
+    """
+    v3 CompressContent 解压
+    @param data:
+    @return:
+    """
+    if isinstance(data, str):
+        return data
+    if not data:
+        return ''
+    try:
+        return lz4.block.decompress(data, uncompressed_size=len(data) << 10).decode(errors='ignore').replace('\x00', '')
+    except (lz4.block.LZ4BlockError, ValueError):
+        return ''
+
+
+def parse_xml(xml_content):
+    if not xml_content:
+        return None
+    xml_content = xml_content.strip()
+    if not xml_content.startswith('<'):
+        # 群聊消息格式：<wxid>:\n<xml>
+        index = xml_content.find('<')
+        if index == -1:
+            return None
+        xml_content = xml_content[index:]
+    try:
+        return etree.fromstring(xml_content.encode('utf-8'), parser=etree.XMLParser(recover=True, huge_tree=True))
+    except (etree.XMLSyntaxError, ValueError):
+        return None
+
+
+def xml_text(xml_content, path) -> str:
+    """
+    获取xml中某个节点的文字
+    @param xml_content: 以<msg>为根节点的xml
+    @param path: 相对于根节点的路径，例如 appmsg/title
+    @return:
+    """
+    root = parse_xml(xml_content)
+    if root is None:
+        return ''
+    return root.findtext(path) or ''
+
+
+def app_message_text(xml_content) -> str:
+    """
+    Type=49的消息：链接标题和描述、文件名、引用消息的回复内容和被引用内容
+    @param xml_content:
+    @return:
+    """
+    root = parse_xml(xml_content)
+    if root is None:
+        return ''
+    texts = []
+    for path in APP_MESSAGE_PATHS:
+        text = root.findtext(path)
+        if text and text.strip():
+            texts.append(text.strip())
+    return '\n'.join(texts)
+
+
+def message_text(local_type, content) -> str:
+    """
+    提取消息中可检索的文字
+    @param local_type: v4的local_type或者v3的 SubType<<32 | Type（即MessageType）
+    @param content: 解压后的消息内容
+    @return: 没有文字时返回空字符串
+    """
+    if not content or not isinstance(content, str):
+        return ''
+    type_ = local_type & 0xFFFFFFFF
+    if type_ == TEXT_TYPE:
+        return content
+    if type_ == APP_MESSAGE_TYPE:
+        return app_message_text(content)
+    return ''
+
+
+if __name__ == '__main__':
+    pass
@@ -0,0 +1,470 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2026/10/20 5:20
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-proto_fields.py
+@Description : protobuf字段级读取
+               消息解析时只需要protobuf里的一两个字段，不再ParseFromString后用MessageToDict转换成字典：
+               - protobuf使用C实现（upb）时，解析后直接读取字段
+               - protobuf使用纯Python实现时解析很慢，直接按字段号扫描protobuf二进制（wire format），只解码用到的字段
+               扫描的取值规则与protobuf一致：标量字段重复出现时取最后一个，嵌套消息重复出现时合并
+"""
+from typing import Iterator, List, Optional, Tuple
+
+from google.protobuf.internal import api_implementation
+
+from wxManager.parser.util.protocbuf import (
+    emoji_desc_pb2, file_info_pb2, packed_info_data_img_pb2, packed_info_data_merged_pb2,
+    packed_info_data_pb2, roomdata_pb2
+)
+from wxManager.parser.util.protocbuf.msg_pb2 import MessageBytesExtra
+
+# 纯Python实现的ParseFromString比扫描慢数倍，C实现则比扫描快，按实际使用的实现选择
+USE_SCANNER = api_implementation.Type() == 'python'
+
+# wire type
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+START_GROUP = 3
+END_GROUP = 4
+FIXED32 = 5
+
+
+class WireError(ValueError):
+    # protobuf数据不完整或格式错误
+    pass
+
+
+def _varint(data: bytes, pos: int) -> Tuple[int, int]:
+    try:
+        b = data[pos]
+        if b < 0x80:
+            return b, pos + 1
+        result = b & 0x7f
+        shift = 7
+        pos += 1
+        while True:
+            b = data[pos]
+            result |= (b & 0x7f) << shift
+            pos += 1
+            if b < 0x80:
+                return result, pos
+            shift += 7
+            if shift >= 70:
+                raise WireError('varint太长')
+    except IndexError:
+        raise WireError('varint不完整')
+
+
+def _skip_group(data: bytes, pos: int, number: int) -> int:
+    end = len(data)
+    while pos < end:
+        key, pos = _varint(data, pos)
+        wire_type = key & 7
+        if wire_type == END_GROUP:
+            if key >> 3 != number:
+                raise WireError('group不匹配')
+            return pos
+        pos = _skip(data, pos, key >> 3, wire_type)
+    raise WireError('group不完整')
+
+
+def _skip(data: bytes, pos: int, number: int, wire_type: int) -> int:
+    if wire_type == VARINT:
+        return _varint(data, pos)[1]
+    if wire_type == LENGTH_DELIMITED:
+        length, pos = _varint(data, pos)
+        pos += length
+    elif wire_type == FIXED64:
+        pos += 8
+    elif wire_type == FIXED32:
+        pos += 4
+    elif wire_type == START_GROUP:
+        return _skip_group(data, pos, number)
+    else:
+        raise WireError(f'无效的wire type：{wire_type}')
+    if pos > len(data):
+        raise WireError('字段不完整')
+    return pos
+
+
+def iter_fields(data: bytes) -> Iterator[Tuple[int, int, object]]:
+    """
+    按顺序遍历protobuf中的字段
+    @param data: protobuf二进制
+    @return: (字段号, wire type, 值)，varint和定长字段的值为int，length-delimited字段的值为bytes，group的值为None
+    """
+    pos = 0
+    end = len(data)
+    while pos < end:
+        key, pos = _varint(data, pos)
+        number = key >> 3
+        wire_type = key & 7
+        if number == 0:
+            raise WireError('字段号为0')
+        if wire_type == LENGTH_DELIMITED:
+            length, pos = _varint(data, pos)
+            value_end = pos + length
+            if value_end > end:
+                raise WireError('字段不完整')
+            yield number, wire_type, data[pos:value_end]
+            pos = value_end
+        elif wire_type == VARINT:
+            value, pos = _varint(data, pos)
+            yield number, wire_type, value
+        elif wire_type == FIXED32 or wire_type == FIXED64:
+            size = 4 if wire_type == FIXED32 else 8
+            if pos + size > end:
+                raise WireError('字段不完整')
+            yield number, wire_type, int.from_bytes(data[pos:pos + size], 'little')
+            pos += size
+        elif wire_type == START_GROUP:
+            pos = _skip_group(data, pos, number)
+            yield number, wire_type, None
+        else:
+            raise WireError(f'无效的wire type：{wire_type}')
+
+
+def find_all(data: bytes, number: int) -> List[bytes]:
+    """
+    字段号为number的所有length-delimited字段（repeated嵌套消息、repeated string或者同一字段出现多次）
+    只关心一个字段时比iter_fields快，其余字段直接跳过
+    @param data:
+    @param number: 字段号
+    @return:
+    """
+    result = []
+    pos = 0
+    end = len(data)
+    target = (number << 3) | LENGTH_DELIMITED
+    try:
+        while pos < end:
+            key = data[pos]
+            if key < 0x80:
+                pos += 1
+            else:
+                key, pos = _varint(data, pos)
+            if key < 8:
+                raise WireError('字段号为0')
+            wire_type = key & 7
+            if wire_type == LENGTH_DELIMITED:
+                length = data[pos]
+                if length < 0x80:
+                    pos += 1
+                else:
+                    length, pos = _varint(data, pos)
+                value_end = pos + length
+                if value_end > end:
+                    raise WireError('字段不完整')
+                if key == target:
+                    result.append(data[pos:value_end])
+                pos = value_end
+            else:
+                pos = _skip(data, pos, key >> 3, wire_type)
+    except IndexError:
+        raise WireError('字段不完整')
+    return result
+
+
+def find_bytes(data: bytes, path: Tuple[int, ...]) -> Optional[bytes]:
+    """
+    按字段号路径查找length-delimited字段，例如 (5, 2) 表示 info.audioTxt
+    嵌套消息出现多次时protobuf会合并，相当于取最后一个包含该字段的值
+    @param data:
+    @param path: 字段号路径
+    @return: 不存在时返回None
+    """
+    if not data:
+        return None
+    values = find_all(data, path[0])
+    if len(path) == 1:
+        return values[-1] if values else None
+    result = None
+    for value in values:
+        value = find_bytes(value, path[1:])
+        if value is not None:
+            result = value
+    return result
+
+
+def find_string(data: bytes, path: Tuple[int, ...]) -> str:
+    """
+    按字段号路径读取string字段
+    @param data:
+    @param path:
+    @return: 不存在时返回空字符串（与proto3默认值一致）
+    """
+    value = find_bytes(data, path)
+    return value.decode('utf-8') if value else ''
+
+
+# 以下是解析消息时用到的字段，字段号见 protocbuf/*.proto
+# 传入空数据时返回默认值
+
+def packed_image_filename(packed_info_data: bytes) -> str:
+    """
+    v4图片消息的文件名 PackedInfoDataImg.filename
+    @param packed_info_data:
+    @return:
+    """
+    if not packed_info_data:
+        return ''
+    if USE_SCANNER:
+        return find_string(packed_info_data, (3,))
+    message = packed_info_data_img_pb2.PackedInfoDataImg()
+    message.ParseFromString(packed_info_data)
+    return message.filename
+
+
+def packed_audio_text(packed_info_data: bytes) -> str:
+    """
+    v4语音转文字结果 PackedInfoData.info.audioTxt
+    @param packed_info_data:
+    @return:
+    """
+    if not packed_info_data:
+        return ''
+    if USE_SCANNER:
+        return find_string(packed_info_data, (5, 2))
+    message = packed_info_data_pb2.PackedInfoData()
+    message.ParseFromString(packed_info_data)
+    return message.info.audioTxt
+
+
+def packed_merged_dir(packed_info_data: bytes) -> str:
+    """
+    v4合并转发消息的Rec子目录 PackedInfoData.info.dir（packed_info_data_merged.proto）
+    @param packed_info_data:
+    @return:
+    """
+    if not packed_info_data:
+        return ''
+    if USE_SCANNER:
+        return find_string(packed_info_data, (9, 1))
+    message = packed_info_data_merged_pb2.PackedInfoData()
+    message.ParseFromString(packed_info_data)
+    return message.info.dir
+
+
+def file_info_dir3(extra_buffer: bytes) -> str:
+    """
+    v4 hardlink表extra_buffer中的子目录 FileInfoData.dir3
+    @param extra_buffer:
+    @return:
+    """
+    if not extra_buffer:
+        return ''
+    if USE_SCANNER:
+        return find_string(extra_buffer, (1,))
+    message = file_info_pb2.FileInfoData()
+    message.ParseFromString(extra_buffer)
+    return message.dir3
+
+
+def emoji_desc(desc_bytes: bytes) -> str:
+    """
+    表情描述 EmojiDescData.descItem[].desc，取第一个不为空的
+    @param desc_bytes:
+    @return:
+    """
+    if not desc_bytes:
+        return ''
+    if USE_SCANNER:
+        descs = (find_string(item, (2,)) for item in find_all(desc_bytes, 1))
+    else:
+        message = emoji_desc_pb2.EmojiDescData()
+        message.ParseFromString(desc_bytes)
+        descs = (item.desc for item in message.descItem)
+    for desc in descs:
+        if desc:
+            return desc
+    return ''
+
+
+def _scan_pair(item: bytes, key_number: int, value_number: int):
+    # 嵌套消息中的一个varint字段和一个string字段，重复出现时取最后一个
+    key = 0
+    value = b''
+    for field_number, wire_type, field_value in iter_fields(item):
+        if field_number == key_number and wire_type == VARINT:
+            key = field_value
+        elif field_number == value_number and wire_type == LENGTH_DELIMITED:
+            value = field_value
+    return key, value.decode('utf-8') if value else ''
+
+
+def bytes_extra_items(bytes_extra: bytes) -> List[Tuple[int, str]]:
+    """
+    v3消息的BytesExtra：MessageBytesExtra.message2[] 的 (field1, field2)
+    field1：1 群聊消息发送者，3 缩略图路径，4 原图/视频路径，7 msgsource
+    @param bytes_extra:
+    @return:
+    """
+    if not bytes_extra:
+        return []
+    if USE_SCANNER:
+        return [_scan_pair(item, 1, 2) for item in find_all(bytes_extra, 3)]
+    message = MessageBytesExtra()
+    message.ParseFromString(bytes_extra)
+    return [(item.field1, item.field2) for item in message.message2]
+
+
+def bytes_extra_value(bytes_extra: bytes, key: int, last=False) -> Optional[str]:
+    """
+    BytesExtra中field1等于key的第一项（或最后一项）的field2
+    @param bytes_extra:
+    @param key: 见bytes_extra_items
+    @param last: 是否取最后一项
+    @return: 不存在时返回None
+    """
+    if not bytes_extra:
+        return None
+    result = None
+    if USE_SCANNER:
+        for item_key, value in bytes_extra_items(bytes_extra):
+            if item_key == key:
+                if not last:
+                    return value
+                result = value
+        return result
+    message = MessageBytesExtra()
+    message.ParseFromString(bytes_extra)
+    for item in message.message2:
+        if item.field1 == key:
+            if not last:
+                return item.field2
+            result = item.field2
+    return result
+
+
+def chatroom_members(room_data: bytes) -> List[Tuple[str, str]]:
+    """
+    群成员 ChatRoomData.members[] 的 (wxID, displayName)
+    @param room_data:
+    @return:
+    """
+    if not room_data:
+        return []
+    if USE_SCANNER:
+        members = []
+        for member in find_all(room_data, 1):
+            wxid = find_bytes(member, (1,))
+            display_name = find_bytes(member, (2,))
+            members.append((wxid.decode('utf-8') if wxid else '', display_name.decode('utf-8') if display_name else ''))
+        return members
+    message = roomdata_pb2.ChatRoomData()
+    message.ParseFromString(room_data)
+    return [(member.wxID, member.displayName) for member in message.members]
+
+
+if __name__ == '__main__':
+    import time
+
+    from google.protobuf.json_format import MessageToDict
+
+    # 原来的写法：ParseFromString后用MessageToDict转换成字典（BytesExtra和群成员原来就是直接读取字段）
+    def old_image_filename(data):
+        message = packed_info_data_img_pb2.PackedInfoDataImg()
+        message.ParseFromString(data)
+        return MessageToDict(message).get('filename', '')
+
+    def old_audio_text(data):
+        message = packed_info_data_pb2.PackedInfoData()
+        message.ParseFromString(data)
+        return MessageToDict(message).get('info', {}).get('audioTxt', '')
+
+    def old_merged_dir(data):
+        message = packed_info_data_merged_pb2.PackedInfoData()
+        message.ParseFromString(data)
+        return MessageToDict(message).get('info', {}).get('dir', '')
+
+    def old_emoji_desc(data):
+        message = emoji_desc_pb2.EmojiDescData()
+        message.ParseFromString(data)
+        for item in MessageToDict(message).get('descItem', []):
+            if item.get('desc', ''):
+                return item['desc']
+        return ''
+
+    def old_chatroom_sender(data):
+        message = MessageBytesExtra()
+        message.ParseFromString(data)
+        wxid = ''
+        for tmp in message.message2:
+            if tmp.field1 == 1:
+                wxid = tmp.field2
+        return wxid
+
+    def old_chatroom_members(data):
+        message = roomdata_pb2.ChatRoomData()
+        message.ParseFromString(data)
+        return [(member.wxID, member.displayName) for member in message.members]
+
+    def sample_image(i):
+        return packed_info_data_img_pb2.PackedInfoDataImg(field1=1, field2=i, filename=f'"{i:032x}.jpg"')
+
+    def sample_audio(i):
+        message = packed_info_data_pb2.PackedInfoData(field1=1, field2=2)
+        message.info.field1 = i
+        message.info.audioTxt = f'语音转文字{i}' if i % 3 else ''
+        return message
+
+    def sample_merged(i):
+        message = packed_info_data_merged_pb2.PackedInfoData(field1=1, field2=2)
+        message.field7.field1.field2 = 'x' * 40
+        message.field7.field2.field1 = 'y' * 40
+        message.info.dir = f'{i}_{i * 7919:x}'
+        return message
+
+    def sample_emoji(i):
+        message = emoji_desc_pb2.EmojiDescData()
+        for language, desc in (('default', ''), ('zh_cn', f'表情{i}'), ('en', f'emoji{i}')):
+            message.descItem.add(language=language, desc=desc)
+        return message
+
+    def sample_bytes_extra(i):
+        message = MessageBytesExtra()
+        message.message1.field1 = 16
+        for key, value in ((1, f'wxid_{i}:25319:1'), (7, '<msgsource>' + 'x' * 300 + '</msgsource>'), (2, f'{i:032x}'),
+                           (1, f'wxid_last{i}')):
+            message.message2.add(field1=key, field2=value)
+        return message
+
+    def sample_room(i):
+        message = roomdata_pb2.ChatRoomData(room_capacity=500)
+        for j in range(200):
+            message.members.add(wxID=f'wxid_{i}_{j}', displayName=f'群昵称{j}' if j % 2 else '', state=j)
+        return message
+
+    cases = [
+        ('图片文件名', sample_image, old_image_filename, packed_image_filename, lambda d: find_string(d, (3,)), 20000),
+        ('语音转文字', sample_audio, old_audio_text, packed_audio_text, lambda d: find_string(d, (5, 2)), 20000),
+        ('合并转发目录', sample_merged, old_merged_dir, packed_merged_dir, lambda d: find_string(d, (9, 1)), 20000),
+        ('表情描述', sample_emoji, old_emoji_desc, emoji_desc,
+         lambda d: next((x for x in (find_string(item, (2,)) for item in find_all(d, 1)) if x), ''), 20000),
+        ('v3群聊发送者', sample_bytes_extra, old_chatroom_sender, lambda d: bytes_extra_value(d, 1, last=True) or '',
+         lambda d: next((v for k, v in reversed([_scan_pair(item, 1, 2) for item in find_all(d, 3)]) if k == 1), ''),
+         20000),
+        ('群成员（200人）', sample_room, old_chatroom_members, chatroom_members,
+         lambda d: [((find_bytes(m, (1,)) or b'').decode(), (find_bytes(m, (2,)) or b'').decode()) for m in
+                    find_all(d, 1)], 500),
+    ]
+    print(f'protobuf实现：{api_implementation.Type()}，使用{"扫描" if USE_SCANNER else "直接读取字段"}')
+    for name, sample, old, new, scan, count in cases:
+        corpus = [sample(i).SerializeToString() for i in range(count)]
+        # 嵌套消息重复出现（protobuf合并）、未知字段、空数据
+        edge = [corpus[0] + corpus[1], corpus[0] + b'\xf8\x07\x01' + b'\xfa\x07\x03abc', b'']
+        for data in corpus + edge:
+            assert old(data) == new(data) == scan(data), (name, data)
+        timings = []
+        for func in (old, new, scan):
+            st = time.perf_counter()
+            for data in corpus:
+                func(data)
+            timings.append(time.perf_counter() - st)
+        print(f'{name:<10} {count}条：原来 {timings[0]:.3f}s，现在 {timings[1]:.3f}s '
+              f'（{timings[0] / timings[1]:.1f}x），扫描 {timings[2]:.3f}s（{timings[0] / timings[2]:.1f}x）')
@@ -19,12 +19,13 @@ from wxManager.model.message import BusinessCardMessage, VoipMessage, MergedMess
 from wxManager.parser.link_parser import parser_link, parser_applet, parser_business, parser_voip, \
     parser_merged_messages, parser_wechat_video, parser_position, parser_reply, parser_transfer, parser_red_envelop, \
     parser_file, parser_favorite_note, parser_pat, parser_music
-from wxManager.parser.util.protocbuf.msg_pb2 import MessageBytesExtra
-from wxManager.parser.wechat_v4 import LimitedDict
+from wxManager.parser.util.proto_fields import bytes_extra_value
+from wxManager.parser.wechat_v4 import LimitedDict, LRUDict, CONTACT_CACHE_SIZE
 from .audio_parser import parser_audio
 from .emoji_parser import parser_emoji
 from .file_parser import parse_video
 from wxManager.log import logger
+from wxManager.parser.reference import ReferenceResolver, ThreadLocalAttribute, invalid_message
 from wxManager.model import Message, TextMessage, ImageMessage, VideoMessage, EmojiMessage, LinkMessage, FileMessage, \
     AudioMessage, QuoteMessage, MessageType
 from wxManager.model import Me
@@ -77,8 +78,10 @@ class MessageFactory(ABC):
 # 单例基类
 class Singleton:
     _instances = {}
-    contacts = {}
-    messages = LimitedDict(100)
+    # 以下缓存每个线程一份，多个线程同时解析不同的聊天对象时互不干扰
+    contacts = ThreadLocalAttribute(lambda: LRUDict(CONTACT_CACHE_SIZE))
+    messages = ThreadLocalAttribute(lambda: LimitedDict(100))
+    resolver: ReferenceResolver = ThreadLocalAttribute()  # 不为None时，引用消息在整批解析完后统一查询
 
     def __new__(cls, *args, **kwargs):
         if cls not in cls._instances:
@@ -120,12 +123,8 @@ class Singleton:
             wxid = Me().wxid
         else:
             if username.endswith('@chatroom'):
-                msgbytes = MessageBytesExtra()
-                msgbytes.ParseFromString(message[10])
-                for tmp in msgbytes.message2:
-                    if tmp.field1 != 1:
-                        continue
-                    wxid = tmp.field2
+                # 有多个时取最后一个
+                wxid = bytes_extra_value(message[10], 1, last=True) or ''
                 # todo 解析还是有问题，会出现这种带:的东西
                 if ':' in wxid:  # wxid_ewi8gfgpp0eu22:25319:1
                     wxid = wxid.split(':')[0]
@@ -171,7 +170,16 @@ class Singleton:
 
     @classmethod
     def reset_messages(cls):
-        cls.messages = {}
+        vars(Singleton)['messages'].set(LimitedDict(100))
+
+    @classmethod
+    def defer_references(cls, resolver: ReferenceResolver):
+        """
+        with块中当前线程解析的引用消息交给resolver统一处理
+        @param resolver:
+        @return:
+        """
+        return vars(Singleton)['resolver'].bind(resolver)
 
     @classmethod
     def add_message(cls, message: Message):
@@ -672,7 +680,10 @@ class QuoteMessageFactory(MessageFactory, Singleton):
         is_sender, wxid, message_content = self.common_attribute(message, username, manager)
         info = parser_reply(message_content)
         # quote_message = manager.get_message_by_server_id(username, info.get('svrid', ''))  # todo 非常耗时
-        quote_message = self.get_message_by_server_id(info.get('svrid', ''), username, manager)
+        if self.resolver is None:
+            quote_message = self.get_message_by_server_id(info.get('svrid', ''), username, manager)
+        else:
+            quote_message = invalid_message(username)
         msg = QuoteMessage(
             local_id=message[0],
             server_id=message[9],
@@ -690,6 +701,8 @@ class QuoteMessageFactory(MessageFactory, Singleton):
             content=info.get('text'),
             quote_message=quote_message,
         )
+        if self.resolver is not None:
+            self.resolver.add_quote(msg, info.get('svrid', ''))
         self.add_message(msg)
         return msg
 
@@ -894,5 +907,17 @@ FACTORY_REGISTRY = {
     MessageType.Pat: PatMessageFactory(),
 }
 
+# type_name_dict得到的类型 -> 解析后Message.type，与各工厂创建的消息一致
+PARSED_TYPES = {type_: type_ for type_ in FACTORY_REGISTRY}
+PARSED_TYPES.update({
+    MessageType.Text2: MessageType.Text,
+    MessageType.LinkMessage2: MessageType.LinkMessage,
+    MessageType.LinkMessage4: MessageType.LinkMessage,
+    MessageType.LinkMessage5: MessageType.LinkMessage,
+    MessageType.LinkMessage6: MessageType.LinkMessage,
+    MessageType.Applet2: MessageType.Applet,
+    MessageType.OpenIMBCard: MessageType.BusinessCard,
+})
+
 if __name__ == '__main__':
     pass
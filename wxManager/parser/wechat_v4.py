@@ -17,18 +17,20 @@ from abc import ABC, abstractmethod
 
 import xmltodict
 import zstandard as zstd
-from google.protobuf.json_format import MessageToDict
 
 from wxManager.model.message import VoipMessage, BusinessCardMessage, MergedMessage, WeChatVideoMessage, \
     PositionMessage, TransferMessage, RedEnvelopeMessage, FavNoteMessage, PatMessage
 from wxManager.parser.link_parser import parser_link, parser_voip, parser_applet, parser_business, \
     parser_merged_messages, parser_wechat_video, parser_position, parser_reply, parser_transfer, parser_red_envelop, \
     parser_file, parser_favorite_note, parser_pat
-from wxManager.parser.util.protocbuf import packed_info_data_pb2, packed_info_data_merged_pb2,packed_info_data_img_pb2
+from wxManager.parser.util.proto_fields import packed_image_filename, packed_audio_text, packed_merged_dir
 from .audio_parser import parser_audio
 from .emoji_parser import parser_emoji
 from .file_parser import parse_video
 from wxManager.log import logger
+from wxManager.media_resolver import get_rec_index
+from wxManager.parser.reference import ReferenceResolver, ThreadLocalAttribute, invalid_message
+from wxManager.parser.zstd_decompress import decompress_text
 from wxManager.model import *
 from wxManager.model import Me
 from ..db_main import DataBaseInterface
@@ -41,9 +43,8 @@ source,message_content,compress_content"
 
 
 def decompress(data):
-    dctx = zstd.ZstdDecompressor()  # 创建解压对象
-    x = dctx.decompress(data).strip(b'\x00').strip()
-    return x.decode('utf-8').strip()
+    # 复用线程内的解压对象，parser_messages预解压过的直接取结果
+    return decompress_text(data)
 
 
 class LimitedDict:
@@ -77,6 +78,30 @@ class LimitedDict:
         return self.messages.get(key)
 
 
+class LRUDict(LimitedDict):
+    # 最近最少使用缓存，读取时移到末尾，超出k条时删除最久未使用的项
+    def __getitem__(self, key):
+        value = self.messages[key]
+        self.messages.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        if key in self.messages:
+            return self[key]
+        return default
+
+    def update(self, data: dict):
+        for key, value in data.items():
+            self[key] = value
+
+    def __len__(self):
+        return len(self.messages)
+
+
+# 解析器缓存的联系人数量上限（群聊最多500人，足够容纳当前聊天对象）
+CONTACT_CACHE_SIZE = 2048
+
+
 # 定义抽象工厂基类
 class MessageFactory(ABC):
     @abstractmethod
@@ -94,8 +119,10 @@ class MessageFactory(ABC):
 # 单例基类
 class Singleton:
     _instances = {}
-    contacts = {}
-    messages = LimitedDict(100)
+    # 以下缓存每个线程一份，多个线程同时解析不同的聊天对象时互不干扰
+    contacts = ThreadLocalAttribute(lambda: LRUDict(CONTACT_CACHE_SIZE))
+    messages = ThreadLocalAttribute(lambda: LimitedDict(100))
+    resolver: ReferenceResolver = ThreadLocalAttribute()  # 不为None时，引用消息和Rec目录在整批解析完后统一处理
 
     def __new__(cls, *args, **kwargs):
         if cls not in cls._instances:
@@ -148,7 +175,7 @@ class Singleton:
         if server_id in cls.messages:
             return cls.messages.get(server_id)
         else:
-            msg = manager.get_message_by_server_id(username, server_id)  # todo 非常耗时
+            msg = manager.get_message_by_server_id(username, server_id)  # 通过server_id索引定位
             if msg:
                 cls.add_message(msg)
             else:
@@ -172,7 +199,16 @@ class Singleton:
 
     @classmethod
     def reset_messages(cls):
-        cls.messages = {}
+        vars(Singleton)['messages'].set(LimitedDict(100))
+
+    @classmethod
+    def defer_references(cls, resolver: ReferenceResolver):
+        """
+        with块中当前线程解析的引用消息交给resolver统一处理
+        @param resolver:
+        @return:
+        """
+        return vars(Singleton)['resolver'].bind(resolver)
 
     @classmethod
     def add_message(cls, message: Message):
@@ -249,11 +285,7 @@ class ImageMessageFactory(MessageFactory, Singleton):
         filename = ''
         try:
             # 2025年3月微信测试版修改了img命名方式才有了这个东西
-            packed_info_data_proto = packed_info_data_img_pb2.PackedInfoDataImg()
-            packed_info_data_proto.ParseFromString(message[14])
-            # 转换为 JSON 格式
-            packed_info_data = MessageToDict(packed_info_data_proto)
-            filename = packed_info_data.get('filename', '').strip().strip('"').strip()
+            filename = packed_image_filename(message[14]).strip().strip('"').strip()
         except:
             pass
         msg = ImageMessage(
@@ -295,11 +327,7 @@ class AudioMessageFactory(MessageFactory, Singleton):
         audio_length = audio_dic.get('audio_length', 0)
         audio_text = audio_dic.get('audio_text', '')
         if not audio_text:
-            packed_info_data_proto = packed_info_data_pb2.PackedInfoData()
-            packed_info_data_proto.ParseFromString(message[14])
-            # 转换为 JSON 格式
-            packed_info_data = MessageToDict(packed_info_data_proto)
-            audio_text = packed_info_data.get('info', {}).get('audioTxt', '')
+            audio_text = packed_audio_text(message[14])
         msg = AudioMessage(
             local_id=message[0],
             server_id=message[1],
@@ -574,22 +602,14 @@ class MergedMessageFactory(MessageFactory, Singleton):
             messages=info.get('messages', []),
             level=0
         )
-        packed_info_data_proto = packed_info_data_merged_pb2.PackedInfoData()
-        packed_info_data_proto.ParseFromString(message[14])
-        # 转换为 JSON 格式
-        packed_info_data = MessageToDict(packed_info_data_proto)
-        dir0 = packed_info_data.get('info', {}).get('dir', '')
+        dir0 = packed_merged_dir(message[14])
         month = msg.str_time[:7]  # 2025-03
         rec_dir = os.path.join(Me().wx_dir, 'msg', 'attach', hashlib.md5(username.encode("utf-8")).hexdigest(), month,
                                'Rec')
-        if not dir0 and os.path.exists(rec_dir):
-            for file in os.listdir(rec_dir):
-                if file.startswith(f'{msg.local_id}_'):
-                    dir0 = file
+        wxid_md5 = hashlib.md5(username.encode("utf-8")).hexdigest()
 
-        def parser_merged(merged_messages, level):
+        def parser_merged(merged_messages, level, dir0):
             for index, inner_msg in enumerate(merged_messages):
-                wxid_md5 = hashlib.md5(username.encode("utf-8")).hexdigest()
                 if inner_msg.type == MessageType.Image:
                     if dir0:
                         inner_msg.path = os.path.join('msg', 'attach',
@@ -631,9 +651,12 @@ class MergedMessageFactory(MessageFactory, Singleton):
                     else:
                         inner_msg.path = manager.get_file(inner_msg.md5)
                 elif inner_msg.type == MessageType.MergedMessages:
-                    parser_merged(inner_msg.messages, f'{index}' if not level else f'{level}_{index}')
+                    parser_merged(inner_msg.messages, f'{index}' if not level else f'{level}_{index}', dir0)
+
+        if not dir0:
+            dir0 = get_rec_index(Me().wx_dir).lookup(rec_dir, msg.local_id)
 
-        parser_merged(msg.messages, '')
+        parser_merged(msg.messages, '', dir0)
         self.add_message(msg)
         return msg
 
@@ -714,7 +737,10 @@ class QuoteMessageFactory(MessageFactory, Singleton):
         is_sender, wxid, message_content = self.common_attribute(message, username, manager)
         info = parser_reply(message_content)
         # quote_message = manager.get_message_by_server_id(username, info.get('svrid', ''))  # todo 非常耗时
-        quote_message = self.get_message_by_server_id(info.get('svrid', ''), username, manager)
+        if self.resolver is None:
+            quote_message = self.get_message_by_server_id(info.get('svrid', ''), username, manager)
+        else:
+            quote_message = invalid_message(username)
         msg = QuoteMessage(
             local_id=message[0],
             server_id=message[1],
@@ -732,6 +758,8 @@ class QuoteMessageFactory(MessageFactory, Singleton):
             content=info.get('text'),
             quote_message=quote_message,
         )
+        if self.resolver is not None:
+            self.resolver.add_quote(msg, info.get('svrid', ''))
         self.add_message(msg)
         return msg
 
@@ -943,5 +971,17 @@ FACTORY_REGISTRY = {
     MessageType.Pat: PatMessageFactory(),
 }
 
+# 原始类型（local_type） -> 解析后Message.type，与各工厂创建的消息一致，不在表中的类型保持原始类型
+PARSED_TYPES = {type_: type_ for type_ in FACTORY_REGISTRY if type_ != -1}
+PARSED_TYPES.update({
+    MessageType.LinkMessage2: MessageType.LinkMessage,
+    MessageType.LinkMessage4: MessageType.LinkMessage,
+    MessageType.LinkMessage5: MessageType.LinkMessage,
+    MessageType.LinkMessage6: MessageType.LinkMessage,
+    MessageType.Applet2: MessageType.Applet,
+    MessageType.OpenIMBCard: MessageType.BusinessCard,
+    MessageType.FavNote: MessageType.Pat,
+})
+
 if __name__ == '__main__':
     pass
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2026/10/20 4:40
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-xml_fields.py
+@Description : appmsg等xml消息的字段提取快速路径
+               每种消息只声明需要的字段（FieldSpec），用lxml解析后按路径直接取值，不构建xmltodict的完整字典树
+               取值规则与xmltodict一致；遇到xmltodict会得到dict/list的节点（重复节点、带属性的文本节点等）时放弃快速路径，
+               交给原来的解析函数处理，保证结果完全一致
+"""
+import threading
+from functools import wraps
+from typing import Callable, Dict, Optional, Tuple
+
+from lxml import etree
+
+_local = threading.local()
+
+MISSING = object()  # 字段必须存在，不存在时原函数会抛出异常（例如 data['location']['@x']）
+
+
+class Fallback(Exception):
+    # 快速路径无法确定结果，交给原来的解析函数
+    pass
+
+
+def _parser() -> etree.XMLParser:
+    # lxml的解析器对象不能在线程间共享
+    parser = getattr(_local, 'parser', None)
+    if parser is None:
+        # 与expat一致：不容错、不加载外部实体
+        parser = etree.XMLParser(recover=False, resolve_entities=False, no_network=True, huge_tree=True)
+        _local.parser = parser
+    return parser
+
+
+def parse_root(xml_content: str):
+    """
+    @param xml_content:
+    @return: 根节点，解析失败时抛出Fallback（由原函数按原来的方式报错）
+    """
+    if not xml_content or not isinstance(xml_content, str):
+        raise Fallback()
+    head = xml_content[:200]
+    if '<!DOCTYPE' in head or '<!ENTITY' in xml_content:
+        raise Fallback()
+    if head.startswith('<?xml'):
+        declaration = head[:head.find('?>') + 2].lower()
+        # xmltodict按utf-8解析字符串，忽略声明中的编码
+        if 'encoding' in declaration and 'utf-8' not in declaration and 'utf8' not in declaration:
+            raise Fallback()
+    try:
+        return etree.fromstring(xml_content.encode('utf-8'), parser=_parser())
+    except (etree.XMLSyntaxError, ValueError, UnicodeError):
+        raise Fallback()
+
+
+def _is_dict(node) -> bool:
+    # xmltodict中节点有属性或者子元素时才是dict，只有文本时是str或None
+    if node.attrib:
+        return True
+    for child in node:
+        if isinstance(child.tag, str):
+            return True
+    return False
+
+
+def _only_child(node, tag):
+    found = None
+    for child in node.iterchildren(tag):
+        if found is not None:
+            # 重复节点在xmltodict中是list
+            raise Fallback()
+        found = child
+    return found
+
+
+def _text(node):
+    if node.attrib or len(node):
+        # 有属性、子元素或注释时xmltodict得到dict或拼接后的文本
+        raise Fallback()
+    text = node.text
+    if text is None:
+        return None
+    text = text.strip()
+    return text if text else None
+
+
+class FieldSpec:
+    """
+    一个字段：相对于根节点的路径，最后一级以@开头时表示属性
+    例如 'appmsg/title'、'appmsg/@appid'，与 dic.get('appmsg', {}).get('title', default) 等价
+    """
+    __slots__ = ('tags', 'attr', 'default')
+
+    def __init__(self, path: str, default=''):
+        parts = tuple(path.split('/'))
+        if parts[-1].startswith('@'):
+            self.tags = parts[:-1]
+            self.attr = parts[-1][1:]
+        else:
+            self.tags = parts
+            self.attr = None
+        self.default = default
+
+    def extract(self, root):
+        node = root
+        last = len(self.tags) - 1 if self.attr is None else len(self.tags)
+        for index, tag in enumerate(self.tags):
+            child = _only_child(node, tag)
+            if child is None:
+                if self.default is MISSING:
+                    raise Fallback()
+                return self.default
+            if index < last and not _is_dict(child):
+                # 中间节点不是dict，原函数调用.get会出错
+                raise Fallback()
+            node = child
+        if self.attr is not None:
+            value = node.get(self.attr)
+            if value is None:
+                if self.default is MISSING:
+                    raise Fallback()
+                return self.default
+            return value
+        return _text(node)
+
+
+def compile_fields(root_tag: str, fields: Dict[str, str | Tuple[str, object]]) -> Callable[[str], Dict]:
+    """
+    把字段声明编译成提取函数
+    @param root_tag: 根节点名，根节点不是它时原函数得到的是默认值，交给原函数处理
+    @param fields: {字段名: 路径} 或 {字段名: (路径, 默认值)}，默认值为空字符串
+    @return: extract(xml_content) -> {字段名: 值}，无法确定时抛出Fallback
+    """
+    specs = []
+    for name, value in fields.items():
+        path, default = value if isinstance(value, tuple) else (value, '')
+        specs.append((name, FieldSpec(path, default)))
+
+    def extract(xml_content):
+        root = parse_root(xml_content)
+        if root.tag != root_tag or not _is_dict(root):
+            raise Fallback()
+        return {name: spec.extract(root) for name, spec in specs}
+
+    return extract
+
+
+class FastPathStats:
+    def __init__(self):
+        self.hits = 0
+        self.fallbacks = 0
+
+    def hit_rate(self):
+        total = self.hits + self.fallbacks
+        return self.hits / total if total else 0
+
+
+def fast_path(fast: Callable[[str], Optional[dict]]):
+    """
+    给原来的解析函数加上快速路径：fast抛出Fallback（或任何异常）时调用原函数
+    原函数保存在 wrapper.slow，用于一致性校验
+    @param fast:
+    @return:
+    """
+
+    def decorator(func):
+        stats = FastPathStats()
+
+        @wraps(func)
+        def wrapper(xml_content, *args, **kwargs):
+            try:
+                result = fast(xml_content, *args, **kwargs)
+            except Exception:
+                result = None
+            if result is not None:
+                stats.hits += 1
+                return result
+            stats.fallbacks += 1
+            return func(xml_content, *args, **kwargs)
+
+        wrapper.slow = func
+        wrapper.stats = stats
+        return wrapper
+
+    return decorator
+
+
+if __name__ == '__main__':
+    import random
+    import time
+
+    from wxManager.parser import link_parser
+
+    # 差分测试：合成语料覆盖正常消息和各种边界情况（空节点、带属性的文本节点、重复节点、缺字段、注释、CDATA、非法xml），
+    # 快速路径与原函数的结果必须完全一致
+    random.seed(0)
+    noisy = True
+    words = ['标题', 'title', ' 前后空格 ', '&amp;转义&lt;', '<![CDATA[cdata<b>]]>', '', '   ', '中文 English 123']
+
+    def pick(options):
+        # 测试吞吐量时只生成正常消息
+        return random.choice(options) if noisy else options[0]
+
+    def word():
+        return random.choice(words) if noisy else random.choice(words[:4] + words[7:])
+
+    def node(tag, value=None):
+        # 随机生成：正常文本、空节点、缺失、带属性、重复、注释
+        value = word() if value is None else value
+        kind = random.random() if noisy else 0
+        if kind < 0.6:
+            return f'<{tag}>{value}</{tag}>'
+        if kind < 0.7:
+            return f'<{tag} />'
+        if kind < 0.8:
+            return ''
+        if kind < 0.87:
+            return f'<{tag} lang="zh">{value}</{tag}>'
+        if kind < 0.94:
+            return f'<{tag}>{value}</{tag}><{tag}>{value}</{tag}>'
+        return f'<{tag}>{value}<!-- c --></{tag}>'
+
+    def padding():
+        # 真实的appmsg中有大量解析时用不到的字段
+        if noisy:
+            return ''
+        return ''.join(f'<field{i}><sub a="1">{i}</sub><text>内容{i}</text></field{i}>' for i in range(30))
+
+    def link_xml():
+        appmsg = ''.join(node(tag) for tag in (
+            'title', 'des', 'url', 'thumburl', 'songalbumurl', 'sourcedisplayname', 'sourceusername'
+        ))
+        appid = pick(['appid="wx123" ', '', 'appid="" '])
+        return f'<msg><appmsg {appid}sdkver="0">{appmsg}{padding()}</appmsg><appinfo>{node("appname")}</appinfo></msg>'
+
+    def voip_xml():
+        if noisy and random.random() < 0.3:
+            return f'<voipmsg type="VoIPBubbleMsg"><VoIPBubbleMsg>{node("msg")}</VoIPBubbleMsg></voipmsg>'
+        return (f'<voipinvitemsg>{node("invite_type", pick(["0", "1", "x"]))}</voipinvitemsg>'
+                f'<voiplocalinfo>{node("duration", "12")}{node("diaplay_content")}</voiplocalinfo>')
+
+    def applet_xml():
+        weappinfo = node('pagepath', pick(['pages/a?cover=http://x/1.jpg', 'pages/a', 'a?b=1'])) + \
+                    node('weappiconurl') + node('weapppagethumbrawurl')
+        return (f'<msg><appmsg appid="wx1">{node("title")}{node("des")}{node("url")}'
+                f'<weappinfo>{weappinfo}</weappinfo></appmsg><appinfo>{node("appname")}</appinfo></msg>')
+
+    def business_xml():
+        attrs = ' '.join(
+            f'{name}="{word().strip() or "v"}"' for name in ('username', 'nickname', 'alias', 'province', 'city', 'sign')
+            if not noisy or random.random() < 0.8
+        )
+        sex = pick(['sex="1" ', 'sex="2" ', '', 'sex="" '])
+        return f'<msg bigheadimgurl="http://a?x=1&y=2" {sex}{attrs} />'
+
+    def wechat_video_xml():
+        count = pick(['0', '1', '2', ''])
+        media = f'<media>{node("coverUrl")}{node("thumbUrl")}{node("videoPlayDuration", "30")}</media>'
+        media_list = pick([media, media * 2, '', node('mediaList')])
+        return (f'<msg><appmsg><finderFeed>{node("nickname")}{node("avatar")}{node("authIconUrl")}{node("desc")}'
+                f'{node("mediaCount", count)}<mediaList>{media_list}</mediaList></finderFeed></appmsg></msg>')
+
+    def position_xml():
+        attrs = ' '.join(
+            f'{name}="{value}"' for name, value in (('x', '22.5'), ('y', '113.9'), ('label', '深圳'), ('poiname', 'a'),
+                                                    ('scale', '15')) if not noisy or random.random() < 0.85
+        )
+        return pick([f'<msg><location {attrs} /></msg>', f'<msg><location {attrs}>t</location></msg>',
+                              f'<msg><location {attrs}/><location x="1" y="2"/></msg>'])
+
+    def reply_xml():
+        refermsg = f'<refermsg>{node("type", pick(["1", "3", "49", "x"]))}{node("svrid", "123456")}' \
+                   f'{node("displayname")}</refermsg>'
+        return f'<msg><appmsg>{node("title", "回复&#01;内容&#20;")}{pick([refermsg, "", "<refermsg/>"])}</appmsg></msg>'
+
+    def transfer_xml():
+        wcpayinfo = node('paysubtype', pick(['1', '3', '4', ''])) + node('pay_memo') + node('feedesc') + \
+                    node('receiver_username')
+        return f'<msg><appmsg><wcpayinfo>{wcpayinfo}</wcpayinfo></appmsg></msg>'
+
+    def red_envelop_xml():
+        wcpayinfo = node('iconurl') + node('sendertitle') + node('receivertitle') + \
+                    node('innertype', pick(['0', '1', '']))
+        return f'<msg><appmsg><wcpayinfo>{wcpayinfo}</wcpayinfo></appmsg></msg>'
+
+    def file_xml():
+        appattach = node('totallen', pick(['1024', '0', ''])) + node('fileext')
+        return (f'<msg><appmsg>{node("title")}{node("md5")}<appattach>{appattach}</appattach>'
+                f'<appinfo>{node("appname")}</appinfo></appmsg></msg>')
+
+    def pat_xml():
+        patinfo = node('fromusername') + node('pattedusername') + node('chatusername') + node('template')
+        return f'<msg><appmsg>{node("title")}<patinfo>{patinfo}</patinfo></appmsg></msg>'
+
+    def merged_messages_xml():
+        item = (f'<dataitem datatype="1">{node("datadesc")}<sourcename>a</sourcename>'
+                f'<srcMsgCreateTime>1700000000</srcMsgCreateTime><sourcetime>2023-11-15 06:13:20</sourcetime></dataitem>')
+        recordinfo = f'<recordinfo><datalist count="2">{item}{item}</datalist></recordinfo>'
+        recorditem = pick([f'<recorditem><![CDATA[{recordinfo}]]></recorditem>', f'<recorditem>{recordinfo}</recorditem>',
+                           '<recorditem />', ''])
+        return f'<msg><appmsg>{node("title")}{node("des")}{recorditem}</appmsg></msg>'
+
+    broken = ['', ' ', '<msg>', '<msg></msg>', '<msg>text</msg>', '<other><appmsg/></other>', '<msg><appmsg>x</appmsg></msg>',
+              '<?xml version="1.0" encoding="UTF-8"?><msg><appmsg><title>a</title></appmsg></msg>',
+              '<?xml version="1.0" encoding="gbk"?><msg><appmsg><title>a</title></appmsg></msg>',
+              '<!DOCTYPE msg [<!ENTITY e "x">]><msg><appmsg><title>&e;</title></appmsg></msg>',
+              '<msg><appmsg><title>&nbsp;</title></appmsg></msg>', '<msg/>', '<msg a="1"/>']
+
+    cases = [
+        (link_parser.parser_link, link_xml),
+        (link_parser.parser_voip, voip_xml),
+        (link_parser.parser_applet, applet_xml),
+        (link_parser.parser_business, business_xml),
+        (link_parser.parser_wechat_video, wechat_video_xml),
+        (link_parser.parser_position, position_xml),
+        (link_parser.parser_reply, reply_xml),
+        (link_parser.parser_transfer, transfer_xml),
+        (link_parser.parser_red_envelop, red_envelop_xml),
+        (link_parser.parser_file, file_xml),
+        (link_parser.parser_pat, pat_xml),
+        (link_parser.parser_merged_messages, merged_messages_xml),
+    ]
+    # 原函数解析失败时会打印错误日志，测试时关掉
+    link_parser.logger.disabled = True
+    for func, generate in cases:
+        # 比较的是快速路径本身，去掉外层的结果缓存
+        func = getattr(func, 'uncached', func)
+        corpus = [generate() for _ in range(2000)] + broken
+        func.stats.hits = func.stats.fallbacks = 0
+        mismatches = 0
+        for xml in corpus:
+            try:
+                expected = func.slow(xml)
+            except Exception as e:
+                expected = type(e)
+            try:
+                actual = func(xml)
+            except Exception as e:
+                actual = type(e)
+            if expected != actual:
+                mismatches += 1
+                if mismatches <= 3:
+                    print(func.__name__, repr(xml), expected, actual, sep='\n    ')
+        assert mismatches == 0, f'{func.__name__} 不一致：{mismatches}条'
+
+        # 吞吐量：使用正常消息（来自微信的消息绝大部分都能走快速路径）
+        noisy = False
+        normal = [generate().replace('<appmsg>', f'<appmsg>{padding()}') for _ in range(2000)]
+        noisy = True
+        st = time.perf_counter()
+        for xml in normal:
+            func.slow(xml)
+        t_slow = time.perf_counter() - st
+        func.stats.hits = func.stats.fallbacks = 0
+        st = time.perf_counter()
+        for xml in normal:
+            func(xml)
+        t_fast = time.perf_counter() - st
+        print(f'{func.__name__:<20} {len(normal)}条 一致；xmltodict {t_slow:.3f}s，快速路径 {t_fast:.3f}s '
+              f'（{t_slow / t_fast:.1f}x，命中率{func.stats.hit_rate():.0%}）')
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+@Time        : 2026/10/20 4:00
+@Author      : SiYuan
+@Email       : 863909694@qq.com
+@File        : wxManager-zstd_decompress.py
+@Description : v4 消息内容（message_content）的zstd解压
+               - 每个线程复用一个ZstdDecompressor，不再每条消息创建一次
+               - 一页消息用multi_decompress_to_buffer一次解压，结果是指向同一块内存的分段，解码成字符串时不额外复制
+               - prefetch预先解压一页，解析器逐条调用decompress_text时直接取结果，prefetch_batch在这一页解析完后释放结果
+"""
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional
+
+import zstandard as zstd
+
+_local = threading.local()
+
+# 每个线程预解压结果最多保留的条数，超过后整体丢弃（内容相同的压缩数据解压结果一定相同，丢弃只影响命中率）
+PREFETCH_LIMIT = 50000
+# 单线程时批量解压与逐条复用解压对象的速度相当（还多一次字典查询），只有多核并且一页足够大时才预解压
+PREFETCH_MIN_SIZE = 1000
+PREFETCH_THREADS = min((os.cpu_count() or 1) - 1, 4)
+
+
+def get_decompressor() -> zstd.ZstdDecompressor:
+    """
+    ZstdDecompressor不能在多个线程中同时使用，每个线程复用一个
+    @return:
+    """
+    decompressor = getattr(_local, 'decompressor', None)
+    if decompressor is None:
+        decompressor = zstd.ZstdDecompressor()
+        _local.decompressor = decompressor
+    return decompressor
+
+
+def _prefetched() -> Dict[bytes, str]:
+    prefetched = getattr(_local, 'prefetched', None)
+    if prefetched is None:
+        prefetched = {}
+        _local.prefetched = prefetched
+    return prefetched
+
+
+def decompress(data: bytes) -> bytes:
+    return get_decompressor().decompress(data)
+
+
+def to_text(buffer) -> str:
+    """
+    解压结果转换成字符串，与原来的 decompress(data).strip(b'\\x00').strip().decode('utf-8').strip() 一致
+    @param buffer: bytes或者multi_decompress_to_buffer返回的分段（支持缓冲区协议，直接解码不复制）
+    @return:
+    """
+    return str(buffer, 'utf-8').strip('\x00').strip()
+
+
+def decompress_text(data: bytes) -> str:
+    """
+    解压一条消息内容，先查当前线程预解压的结果
+    @param data: zstd压缩数据
+    @return:
+    """
+    text = _prefetched().get(data)
+    if text is None:
+        text = to_text(decompress(data))
+    return text
+
+
+def decompress_many(blobs: List[bytes], threads=0) -> List[Optional[object]]:
+    """
+    批量解压
+    @param blobs: zstd压缩数据
+    @param threads: multi_decompress_to_buffer使用的线程数，0表示在当前线程解压
+    @return: 与blobs一一对应，成功时是支持缓冲区协议的分段（可以memoryview()或者to_text()），失败时为None
+    """
+    if not blobs:
+        return []
+    decompressor = get_decompressor()
+    if hasattr(decompressor, 'multi_decompress_to_buffer'):
+        try:
+            # 所有帧都在头部记录了解压后大小时才能一次解压，否则逐条处理
+            collection = decompressor.multi_decompress_to_buffer(blobs, threads=threads)
+            return [collection[i] for i in range(len(collection))]
+        except (zstd.ZstdError, ValueError, TypeError):
+            pass
+    result = []
+    for data in blobs:
+        try:
+            result.append(decompressor.decompress(data))
+        except zstd.ZstdError:
+            result.append(None)
+    return result
+
+
+def _prefetch(blobs: Iterable, threads=None) -> List[bytes]:
+    auto = threads is None
+    if auto:
+        if PREFETCH_THREADS <= 0:
+            return []
+        threads = PREFETCH_THREADS
+    pending = []
+    prefetched = _prefetched()
+    for data in blobs:
+        if isinstance(data, bytes) and data and data not in prefetched:
+            pending.append(data)
+    if not pending or auto and len(pending) < PREFETCH_MIN_SIZE:
+        return []
+    if len(prefetched) + len(pending) > PREFETCH_LIMIT:
+        prefetched.clear()
+    added = []
+    for data, buffer in zip(pending, decompress_many(pending, threads)):
+        if buffer is None:
+            continue
+        try:
+            prefetched[data] = to_text(buffer)
+            added.append(data)
+        except UnicodeDecodeError:
+            # 交给逐条解压时报错，保持原来的行为
+            continue
+    return added
+
+
+def prefetch(blobs: Iterable, threads=None) -> int:
+    """
+    预先解压一页消息，之后当前线程的decompress_text直接使用结果
+    @param blobs: 可以包含非bytes的值（未压缩的消息），会被忽略
+    @param threads: multi_decompress_to_buffer使用的线程数，None表示按CPU核数决定，核数不够时不预解压
+    @return: 预解压的条数
+    """
+    return len(_prefetch(blobs, threads))
+
+
+@contextmanager
+def prefetch_batch(blobs: Iterable, threads=None):
+    """
+    预先解压一页消息，退出时释放这一页的结果，避免解压后的字符串一直占用线程的内存
+    只删除本次加入的结果，嵌套使用（例如解析引用消息时再解析一条消息）不影响外层
+    @param blobs: 同prefetch
+    @param threads: 同prefetch
+    @return:
+    """
+    added = _prefetch(blobs, threads)
+    try:
+        yield len(added)
+    finally:
+        prefetched = _prefetched()
+        for data in added:
+            prefetched.pop(data, None)
+
+
+def clear_prefetched():
+    _prefetched().clear()
+
+
+if __name__ == '__main__':
+    import time
+
+    compressor = zstd.ZstdCompressor()
+    link_xml = (
+        '<msg><appmsg appid="" sdkver="0"><title>标题{i}</title><des>描述描述描述{i}</des><type>5</type>'
+        '<url>https://mp.weixin.qq.com/s/{i}</url><thumburl>https://mmbiz.qpic.cn/{i}.jpg</thumburl>'
+        + '<extinfo>' + 'x' * 1500 + '</extinfo>' + '</appmsg><fromusername>wxid_{i}</fromusername></msg>'
+    )
+    datasets = {
+        '文本消息': [compressor.compress(f'今天晚上一起吃饭吗？第{i}条消息'.encode('utf-8')) for i in range(20000)],
+        '链接消息': [compressor.compress(link_xml.format(i=i).encode('utf-8')) for i in range(20000)],
+    }
+
+    def old_decompress(data):
+        dctx = zstd.ZstdDecompressor()
+        x = dctx.decompress(data).strip(b'\x00').strip()
+        return x.decode('utf-8').strip()
+
+    def best_of(func, repeat=5):
+        # 取多次运行的最短时间，减少GC和其他进程的干扰
+        result, best = None, float('inf')
+        for _ in range(repeat):
+            st = time.perf_counter()
+            result = func()
+            best = min(best, time.perf_counter() - st)
+        return result, best
+
+    def batched(blobs, threads):
+        clear_prefetched()
+        prefetch(blobs, threads)
+        return [decompress_text(data) for data in blobs]
+
+    for name, blobs in datasets.items():
+        expected, t_old = best_of(lambda: [old_decompress(data) for data in blobs])
+        reused, t_reused = best_of(lambda: [to_text(decompress(data)) for data in blobs])
+        threads = max(PREFETCH_THREADS, 0)
+        batch, t_batch = best_of(lambda: batched(blobs, threads))
+        segments, t_segments = best_of(lambda: decompress_many(blobs, threads))
+        assert expected == reused == batch == [to_text(segment) for segment in segments]
+        print(f'{name} {len(blobs)}条：每条新建 {t_old:.3f}s，线程复用 {t_reused:.3f}s，'
+              f'批量预解压（{threads}线程） {t_batch:.3f}s（其中multi_decompress_to_buffer {t_segments:.3f}s）')